@@ -139,6 +139,22 @@ rule FilterCompleteContigs:
 ##################################################################################################
 # Get various coverage files (performed after completeness-aware binning steps)
 
+rule ReadStats:
+    input:
+        os.path.join(CWD, "inputs", "{sample}.fasta")
+    output:
+        os.path.join(CWD, "2-bam", "{sample}.read-stats.txt")
+    conda:
+        "envs/python.yml"
+    threads: 
+        1
+    log: 
+        os.path.join(CWD, "logs", "{sample}.ReadStats.log")
+    benchmark: 
+        os.path.join(CWD, "benchmarks", "{sample}.ReadStats.tsv")
+    shell:
+        "python scripts/read_stats.py -f {input} -o {output} &> {log}"
+
 rule MinimapIndex:
     input:
         reads = os.path.join(CWD, "inputs", "{sample}.fasta"),
@@ -613,6 +629,7 @@ rule MAGMappingPlots:
         contig_mags = os.path.join(CWD, "2-bam", "{sample}.MAG_contigs.txt"),
         contig_bins = os.path.join(CWD, "2-bam", "{sample}.bin_contigs.txt"),
         reads = os.path.join(CWD, "inputs", "{sample}.fasta"),
+        stats = os.path.join(CWD, "2-bam", "{sample}.read-stats.txt"),
         paf = os.path.join(CWD, "2-bam", "{sample}.paf")
     output:
         o1 = os.path.join(CWD, "8-summary", "{sample}", "{sample}.ReadsMapped.pdf"),
@@ -625,7 +642,7 @@ rule MAGMappingPlots:
         os.path.join(CWD, "logs", "{sample}.MAGMappingPlots.log")
     shell:
         "python scripts/paf-mapping-summary.py -p {input.paf} -r {input.reads} -c1 {input.contig_bins} "
-        "-c2 {input.contig_mags} -o1 {output.o1} -o2 {output.o2} &> {log}"
+        "-c2 {input.contig_mags} -s {input.stats} -o1 {output.o1} -o2 {output.o2} &> {log}"
 
 
 # Checkpoint 2: Fork 2 - Bins passed filters; GTDBTkAnalysis -> GTDBTkCleanup -> MAGSummary -> MAGCopy -> MAGContigNames -> MAGmappingPlots -> MAGPlots
@@ -4,6 +4,7 @@ import pysam
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
+from read_stats import load_read_count
 
 def get_args():
     """
@@ -34,6 +35,11 @@ def get_args():
                         required=False,
                         default=None,
                         help="Read number to skip fasta counting.")
+    parser.add_argument("-s", "--read_stats",
+                        required=False,
+                        default=None,
+                        help="Read statistics file from read_stats.py to take the read number from, "
+                             "to skip fasta counting.")
     return parser.parse_args()
 
 def get_paf_df(f):
@@ -163,10 +169,13 @@ def write_table(df_plot, out_table):
 def main():
     args = get_args()
     df = get_paf_df_lite(args.paf)
-    if args.count is None:
-        read_count = get_read_count(args.reads_fasta)
-    else:
+    if args.count is not None:
         read_count = int(args.count)
+    elif args.read_stats is not None:
+        read_count = load_read_count(args.read_stats)
+        print("\tRead count from {}: {:,} reads".format(args.read_stats, read_count))
+    else:
+        read_count = get_read_count(args.reads_fasta)
     contig_names_1 = get_contig_names(args.contig_list_1)
     contig_names_2 = get_contig_names(args.contig_list_2)
     df_plot = count_mapped_reads(df, read_count, contig_names_1, contig_names_2)
@@ -1,27 +1,34 @@
 import os
 
 localrules: 
-    ReadCounts, SplitFasta, MergeSam, UpdateNCBI, TaxonomyFiltered, TaxonomyUnfiltered
+    ReadCounts, PlanChunks, SplitFasta, MergeSam, BuildTaxonomySnapshot, TaxonomyReports
  
 configfile: "config.yaml"
 
 SAMPLES = config['samplenames']
-CHUNKS = [str(i) for i in list(range(0,config['diamond']['chunks']))]
 CWD = os.getcwd()
+# sam2rma reads gzip compressed SAM files, so the merged SAM can stay compressed
+MERGED = "{sample}.merged.sam.gz" if config['sam2rma']['compressed'] else "{sample}.merged.sam"
+# the functional classifications, and the rma2info classification and class count format
+# of the taxonomies, which are all exported from an RMA file by one rule
+FUNCTIONAL = ["EC", "EGGNOG", "INTERPRO2GO", "SEED"]
+TAXONOMY = ["NCBI", "GTDB"]
+CLASSIFICATIONS = {"NCBI": "Taxonomy", "GTDB": "GTDB"}
+C2C_FORMATS = {"NCBI": "ranks", "GTDB": "names"}
 
 rule all:
     input:
         expand(os.path.join(CWD, "5-r2c", "{sample}.{type}.reads.txt"), sample = SAMPLES, 
-                type = ["EC", "EGGNOG", "INTERPRO2GO", "SEED"]),
+                type = FUNCTIONAL),
                 
         expand(os.path.join(CWD, "6-c2c", "{sample}.{type}.counts.txt"), sample = SAMPLES, 
-                type = ["EC", "EGGNOG", "INTERPRO2GO", "SEED"]),
+                type = FUNCTIONAL),
                 
         expand(os.path.join(CWD, "5-r2c", "{sample}.{type}.reads.{filt}.txt"), sample = SAMPLES, 
-                type = ["NCBI", "GTDB"], filt = ["unfiltered", "filtered"]),
+                type = TAXONOMY, filt = ["unfiltered", "filtered"]),
                 
         expand(os.path.join(CWD, "6-c2c", "{sample}.{type}.counts.{filt}.txt"), sample = SAMPLES, 
-                type = ["NCBI", "GTDB"], filt = ["unfiltered", "filtered"]),
+                type = TAXONOMY, filt = ["unfiltered", "filtered"]),
 
         expand(os.path.join(CWD, "7-kraken-mpa-reports", "{sample}.diamond_megan.kreport.filtered.txt"), sample = SAMPLES),
         expand(os.path.join(CWD, "7-kraken-mpa-reports", "{sample}.diamond_megan.mpa.filtered.txt"), sample = SAMPLES),
@@ -29,42 +36,86 @@ rule all:
         expand(os.path.join(CWD, "7-kraken-mpa-reports", "{sample}.diamond_megan.mpa.unfiltered.txt"), sample = SAMPLES)
 
 
+# the read count is taken from the read statistics written by SplitFasta
 rule ReadCounts:
     input: 
-        os.path.join(CWD, "inputs", "{sample}.fasta")
+        os.path.join(CWD, "1-chunks", "{sample}.read-stats.txt")
     output: 
         os.path.join(CWD, "4-rma", "{sample}.readcounts.txt")
-    threads: 2
+    threads: 1
     benchmark: 
         os.path.join(CWD, "benchmarks", "{sample}.ReadCounts.tsv")
     shell:
-        "grep -c '>' {input} > {output}"
+        "awk '$1 == \"reads\" {{print $2}}' {input} > {output}"
 
 
 ##################################################
 # Diamond prep and run
 
-rule SplitFasta:
+# the number of chunks is planned for each sample from its size, the cores and memory,
+# the database index size and the benchmarks of earlier runs (unless fixed in config.yaml)
+rule PlanChunks:
     input: 
         os.path.join(CWD, "inputs", "{sample}.fasta")
     output: 
-        temp(expand(os.path.join(CWD, "1-chunks", "{{sample}}.fasta_chunk_000000{piece}"), piece = CHUNKS))
+        os.path.join(CWD, "1-chunks", "{sample}.chunk-plan.txt")
     conda:
-        "envs/exonerate.yml"
-    threads: 2
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.SplitFasta.tsv")
+        "envs/python.yml"
+    threads: 1
     params:
         chunks = config['diamond']['chunks'],
-        outdir = os.path.join(CWD, "1-chunks", "")
+        db = config['diamond']['db'],
+        threads = config['diamond']['threads'],
+        cores = workflow.cores,
+        mem = config['diamond']['mem_mb'],
+        maxbases = config['diamond']['max_chunk_bases'],
+        perslot = config['diamond']['chunks_per_slot'],
+        minbases = config['diamond']['min_chunk_bases'],
+        benchmarks = os.path.join(CWD, "benchmarks"),
+        statsdir = os.path.join(CWD, "1-chunks")
+    log: 
+        os.path.join(CWD, "logs", "{sample}.PlanChunks.log")
     shell:
-        "fastasplit -c {params.chunks} -f {input} -o {params.outdir}"
-
+        "python scripts/Plan-Chunks.py -f {input} -o {output} -n {params.chunks} -d {params.db} "
+        "-t {params.threads} -c {params.cores} -m {params.mem} -x {params.maxbases} "
+        "--chunks_per_slot {params.perslot} --min_chunk_bases {params.minbases} "
+        "-b {params.benchmarks} -r RunDiamond -s {params.statsdir} &> {log}"
+
+# the chunks are written to a directory, and the DAG is expanded to the planned chunks
+# once this checkpoint has run
+checkpoint SplitFasta:
+    input: 
+        fasta = os.path.join(CWD, "inputs", "{sample}.fasta"),
+        plan = os.path.join(CWD, "1-chunks", "{sample}.chunk-plan.txt")
+    output: 
+        chunks = temp(directory(os.path.join(CWD, "1-chunks", "{sample}.chunks"))),
+        stats = os.path.join(CWD, "1-chunks", "{sample}.read-stats.txt")
+    conda:
+        "envs/python.yml"
+    threads: 1
+    log: 
+        os.path.join(CWD, "logs", "{sample}.SplitFasta.log")
+    benchmark: 
+        os.path.join(CWD, "benchmarks", "{sample}.SplitFasta.tsv")
+    shell:
+        "python scripts/Split-Fasta-by-Bases.py -f {input.fasta} -p {input.plan} -o {output.chunks} "
+        "-s {output.stats} -l {log}"
+
+def get_chunks(wildcards):
+    # chunk files of the sample, in chunk order, as written by the SplitFasta checkpoint
+    chunkdir = checkpoints.SplitFasta.get(sample=wildcards.sample).output.chunks
+    pieces = glob_wildcards(os.path.join(chunkdir, wildcards.sample + ".fasta_chunk_{piece}")).piece
+    return expand(os.path.join(chunkdir, "{sample}.fasta_chunk_{piece}"), sample = wildcards.sample, 
+                  piece = sorted(pieces))
+
+# each chunk is aligned in its own job, so chunks run in parallel (or on separate nodes),
+# and the output of diamond is screened for illegal CIGAR strings and pre-filtered as it
+# is written to a compressed chunk SAM; only the first chunk SAM keeps the header lines
 rule RunDiamond:
     input:
-        os.path.join(CWD, "1-chunks", "{sample}.fasta_chunk_000000{piece}")
+        os.path.join(CWD, "1-chunks", "{sample}.chunks", "{sample}.fasta_chunk_{piece}")
     output:
-        temp(os.path.join(CWD, "2-diamond", "{sample}.{piece}.sam"))
+        temp(os.path.join(CWD, "2-diamond", "{sample}.{piece}.sam.gz"))
     conda:
         "envs/diamond.yml"
     threads: 
@@ -72,23 +123,34 @@ rule RunDiamond:
     params:
         db = config['diamond']['db'],
         block = config['diamond']['block_size'],
-        hits = config['diamond']['hit_limit']
+        hits = config['diamond']['hit_limit'],
+        top = config['sam2rma']['prefilterTopPercent'],
+        maxhits = config['sam2rma']['prefilterMaxHits'],
+        headers = lambda wildcards: "" if int(wildcards.piece) == 0 else "--no_headers"
     log: 
-        os.path.join(CWD, "logs", "{sample}.{piece}.RunDiamond.log")
+        diamond = os.path.join(CWD, "logs", "{sample}.{piece}.RunDiamond.log"),
+        screen = os.path.join(CWD, "logs", "{sample}.{piece}.ScreenSam.log")
     benchmark: 
         os.path.join(CWD, "benchmarks", "{sample}.{piece}.RunDiamond.tsv")
     shell:
-        "diamond blastx -d {params.db} -q {input} -o {output} -f 101 -F 5000 "
-        "--range-culling {params.hits} -b {params.block} -p {threads} 2> {log}"
-
-##################################################
-# MEGAN RMA prep and run
-
+        "python scripts/sam-merger-screen-cigar.py -i {input} -o {output} "
+        "-c \"diamond blastx -d {params.db} -q {{}} -f 101 -F 5000 "
+        "--range-culling {params.hits} -b {params.block} -p {threads}\" "
+        "--top_percent {params.top} --max_hits {params.maxhits} {params.headers} "
+        "-l {log.screen} 2> {log.diamond}"
+
+def get_chunk_sams(wildcards):
+    # screened chunk SAMs of the sample, in chunk order
+    pieces = [os.path.basename(chunk).rsplit("_", 1)[1] for chunk in get_chunks(wildcards)]
+    return expand(os.path.join(CWD, "2-diamond", "{sample}.{piece}.sam.gz"), sample = wildcards.sample,
+                  piece = pieces)
+
+# the screened chunk SAMs are appended in chunk order without being read again
 rule MergeSam:
     input:
-        expand(os.path.join(CWD, "2-diamond", "{{sample}}.{piece}.sam"), piece = CHUNKS)
+        get_chunk_sams
     output:
-        os.path.join(CWD, "3-merged", "{sample}.merged.sam")
+        os.path.join(CWD, "3-merged", MERGED)
     conda:
         "envs/python.yml"
     threads: 1
@@ -97,11 +159,14 @@ rule MergeSam:
     benchmark: 
         os.path.join(CWD, "benchmarks", "{sample}.MergeSam.tsv")
     shell:
-        "python scripts/sam-merger-screen-cigar.py -i {input} -o {output} -l {log}"
-        
+        "python scripts/sam-merger-screen-cigar.py -i {input} -o {output} --screened -l {log}"
+
+##################################################
+# MEGAN RMA prep and run
+
 rule MakeRMAfiltered:
     input:
-        sam = os.path.join(CWD, "3-merged", "{sample}.merged.sam"),
+        sam = os.path.join(CWD, "3-merged", MERGED),
         reads = os.path.join(CWD, "inputs", "{sample}.fasta")
     output:
         expand(os.path.join(CWD, "4-rma", "{{sample}}_filtered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
@@ -123,7 +188,7 @@ rule MakeRMAfiltered:
 
 rule MakeRMAunfiltered:
     input:
-        sam =  os.path.join(CWD, "3-merged", "{sample}.merged.sam"),
+        sam =  os.path.join(CWD, "3-merged", MERGED),
         reads =  os.path.join(CWD, "inputs", "{sample}.fasta")
     output:
         expand(os.path.join(CWD, "4-rma", "{{sample}}_unfiltered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
@@ -143,363 +208,110 @@ rule MakeRMAunfiltered:
         "-v 2> {log}"
 
 ##################################################
-# MEGAN RMA summaries - Read classification
-
-rule RunR2CforEC:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_unfiltered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "5-r2c", "{sample}.EC.reads.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunR2CforEC.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunR2CforEC.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -r2c EC &> {log}"
-        
-rule RunR2CforEGGNOG:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_unfiltered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "5-r2c", "{sample}.EGGNOG.reads.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunR2CforEGGNOG.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunR2CforEGGNOG.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -r2c EGGNOG &> {log}"
-
-rule RunR2CforINTERPRO2GO:
+# MEGAN RMA summaries - Read classifications and class counts
+
+def export_args(output, functional):
+    """
+    Return the exports of Export-RMA-Classifications.py for the outputs
+    of an export rule, as -e MODE CLASSIFICATION FORMAT OUTPUT arguments.
+    """
+    exports = []
+    if functional:
+        exports += [("r2c", c, "ids", f) for c, f in zip(FUNCTIONAL, output.r2c)]
+        exports += [("c2c", c, "paths", f) for c, f in zip(FUNCTIONAL, output.c2c)]
+    exports += [("r2c", CLASSIFICATIONS[t], "names", f) for t, f in zip(TAXONOMY, output.tax_r2c)]
+    exports += [("c2c", CLASSIFICATIONS[t], C2C_FORMATS[t], f) for t, f in zip(TAXONOMY, output.tax_c2c)]
+    return " ".join("-e {} {} {} {}".format(*export) for export in exports)
+
+rule ExportRMAunfiltered:
     input:
         expand(os.path.join(CWD, "4-rma", "{{sample}}_unfiltered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
     output:
-        os.path.join(CWD, "5-r2c", "{sample}.INTERPRO2GO.reads.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunR2CforINTERPRO2GO.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunR2CforINTERPRO2GO.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -r2c INTERPRO2GO &> {log}"
-
-rule RunR2CforSEED:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_unfiltered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "5-r2c", "{sample}.SEED.reads.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunR2CforSEED.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunR2CforSEED.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -r2c SEED &> {log}"     
-
-rule RunR2CforKEGG:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_unfiltered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "5-r2c", "{sample}.KEGG.reads.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunR2CforKEGG.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunR2CforKEGG.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -r2c KEGG &> {log}"     
-
-rule RunR2CforNCBIfiltered:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_filtered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "5-r2c", "{sample}.NCBI.reads.filtered.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunR2CforNCBIfiltered.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunR2CforNCBIfiltered.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -r2c Taxonomy -n &> {log}"
-
-rule RunR2CforNCBIunfiltered:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_unfiltered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "5-r2c", "{sample}.NCBI.reads.unfiltered.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunR2CforNCBIunfiltered.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunR2CforNCBIunfiltered.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -r2c Taxonomy -n &> {log}"
-
-rule RunR2CforGTDBfiltered:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_filtered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "5-r2c", "{sample}.GTDB.reads.filtered.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunR2CforGTDBfiltered.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunR2CforGTDBfiltered.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -r2c GTDB -n &> {log}"
-
-rule RunR2CforGTDBunfiltered:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_unfiltered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "5-r2c", "{sample}.GTDB.reads.unfiltered.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunR2CforGTDBunfiltered.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunR2CforGTDBunfiltered.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -r2c GTDB -n &> {log}"
-
-
-
-##################################################
-# MEGAN RMA summaries - Class counts
-
-rule RunC2CforEC:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_unfiltered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "6-c2c", "{sample}.EC.counts.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunC2CforEC.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunC2CforEC.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -c2c EC -p &> {log}"
-
-rule RunC2CforEGGNOG:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_unfiltered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "6-c2c", "{sample}.EGGNOG.counts.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunC2CforEGGNOG.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunC2CforEGGNOG.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -c2c EGGNOG -p &> {log}"
-
-rule RunC2CforINTERPRO2GO:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_unfiltered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "6-c2c", "{sample}.INTERPRO2GO.counts.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunC2CforINTERPRO2GO.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunC2CforINTERPRO2GO.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -c2c INTERPRO2GO -p &> {log}"
-
-rule RunC2CforSEED:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_unfiltered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "6-c2c", "{sample}.SEED.counts.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunC2CforSEED.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunC2CforSEED.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -c2c SEED -p &> {log}"
-
-rule RunC2CforKEGG:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_unfiltered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "6-c2c", "{sample}.KEGG.counts.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunC2CforKEGG.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunC2CforKEGG.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -c2c KEGG -p &> {log}"     
-
-rule RunC2CforGTDBfiltered:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_filtered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "6-c2c", "{sample}.GTDB.counts.filtered.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunC2CforGTDBfiltered.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunC2CforGTDBfiltered.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -c2c GTDB -n &> {log}"
-
-rule RunC2CforGTDBunfiltered:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_unfiltered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "6-c2c", "{sample}.GTDB.counts.unfiltered.txt")
+        r2c = expand(os.path.join(CWD, "5-r2c", "{{sample}}.{type}.reads.txt"), type = FUNCTIONAL),
+        c2c = expand(os.path.join(CWD, "6-c2c", "{{sample}}.{type}.counts.txt"), type = FUNCTIONAL),
+        tax_r2c = expand(os.path.join(CWD, "5-r2c", "{{sample}}.{type}.reads.unfiltered.txt"), type = TAXONOMY),
+        tax_c2c = expand(os.path.join(CWD, "6-c2c", "{{sample}}.{type}.counts.unfiltered.txt"), type = TAXONOMY)
+    conda:
+        "envs/python.yml"
     threads: 
         config['rma2info']['threads']
     params:
-        rma2info = config['rma2info']['path']
+        rma2info = config['rma2info']['path'],
+        exports = lambda wildcards, output: export_args(output, True)
     log: 
-        os.path.join(CWD, "logs", "{sample}.RunC2CforGTDBunfiltered.log")
+        os.path.join(CWD, "logs", "{sample}.ExportRMAunfiltered.log")
     benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunC2CforGTDBunfiltered.tsv")
+        os.path.join(CWD, "benchmarks", "{sample}.ExportRMAunfiltered.tsv")
     shell:
-        "{params.rma2info} -i {input} -o {output} -c2c GTDB -n &> {log}"
+        "python scripts/Export-RMA-Classifications.py -i {input} -x {params.rma2info} "
+        "{params.exports} -l {log}"
 
-rule RunC2CforNCBIfiltered:
+rule ExportRMAfiltered:
     input:
         expand(os.path.join(CWD, "4-rma", "{{sample}}_filtered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
     output:
-        os.path.join(CWD, "6-c2c", "{sample}.NCBI.counts.filtered.txt")
-    threads: 
-        config['rma2info']['threads']
-    params:
-        rma2info = config['rma2info']['path']
-    log: 
-        os.path.join(CWD, "logs", "{sample}.RunC2CforNCBIfiltered.log")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunC2CforNCBIfiltered.tsv")
-    shell:
-        "{params.rma2info} -i {input} -o {output} -c2c Taxonomy -n -r &> {log}"
-        
-rule RunC2CforNCBIunfiltered:
-    input:
-        expand(os.path.join(CWD, "4-rma", "{{sample}}_unfiltered.protein.{mode}.rma"), mode = config['sam2rma']['readassignmentmode'])
-    output:
-        os.path.join(CWD, "6-c2c", "{sample}.NCBI.counts.unfiltered.txt")
+        tax_r2c = expand(os.path.join(CWD, "5-r2c", "{{sample}}.{type}.reads.filtered.txt"), type = TAXONOMY),
+        tax_c2c = expand(os.path.join(CWD, "6-c2c", "{{sample}}.{type}.counts.filtered.txt"), type = TAXONOMY)
+    conda:
+        "envs/python.yml"
     threads: 
         config['rma2info']['threads']
     params:
-        rma2info = config['rma2info']['path']
+        rma2info = config['rma2info']['path'],
+        exports = lambda wildcards, output: export_args(output, False)
     log: 
-        os.path.join(CWD, "logs", "{sample}.RunC2CforNCBIunfiltered.log")
+        os.path.join(CWD, "logs", "{sample}.ExportRMAfiltered.log")
     benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.RunC2CforNCBIunfiltered.tsv")
+        os.path.join(CWD, "benchmarks", "{sample}.ExportRMAfiltered.tsv")
     shell:
-        "{params.rma2info} -i {input} -o {output} -c2c Taxonomy -n -r &> {log}"
+        "python scripts/Export-RMA-Classifications.py -i {input} -x {params.rma2info} "
+        "{params.exports} -l {log}"
 
 ##################################################
 # Make taxonomic reports
 
-rule UpdateNCBI:
+rule BuildTaxonomySnapshot:
     input:
-        expand(os.path.join(CWD, "6-c2c", "{sample}.NCBI.counts.unfiltered.txt"), sample = SAMPLES)
+        config['taxonomy']['taxdump']
     output:
-        dummy = os.path.join(CWD, "7-kraken-mpa-reports", "NCBI-updated.txt"),
-        taxdump = temp(os.path.join(CWD, "taxdump.tar.gz"))
+        os.path.join(CWD, "7-kraken-mpa-reports", "NCBI-taxonomy.snapshot")
     conda:
         "envs/python.yml"
     threads: 
         1
+    params:
+        store = config['taxonomy']['store']
     log: 
-        os.path.join(CWD, "logs", "UpdateNCBI.prot.log")
+        os.path.join(CWD, "logs", "BuildTaxonomySnapshot.log")
     benchmark: 
-        os.path.join(CWD, "benchmarks", "UpdateNCBI.prot.tsv")
+        os.path.join(CWD, "benchmarks", "BuildTaxonomySnapshot.tsv")
     shell:
-        "python scripts/Run_ete3_NCBI_update.py -i {input} -o {output.dummy} &> {log}"
+        "python scripts/taxonomy_store.py -t {input} -s {params.store} -o {output} &> {log}"
 
-rule TaxonomyUnfiltered:
-    input:
-        c2c = os.path.join(CWD, "6-c2c", "{sample}.NCBI.counts.unfiltered.txt"),
-        ncbiready = os.path.join(CWD, "7-kraken-mpa-reports", "NCBI-updated.txt"),
-        taxdump = os.path.join(CWD, "taxdump.tar.gz"),
-        readcount = os.path.join(CWD, "4-rma", "{sample}.readcounts.txt")
-    output:
-        inter1 = temp(os.path.join(CWD, "7-kraken-mpa-reports", "{sample}.diamond_megan.unfiltered.taxnames.txt")),
-        inter2 = temp(os.path.join(CWD, "7-kraken-mpa-reports", "{sample}.diamond_megan.unfiltered.taxids.txt")),
-        kreport = os.path.join(CWD, "7-kraken-mpa-reports", "{sample}.diamond_megan.kreport.unfiltered.txt"),
-        mpa = os.path.join(CWD, "7-kraken-mpa-reports", "{sample}.diamond_megan.mpa.unfiltered.txt")
-    conda:
-        "envs/python.yml"
-    threads: 
-        1
-    log: 
-        os.path.join(CWD, "logs", "{sample}.TaxonomyUnfilteredlog")
-    benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.TaxonomyUnfiltered.tsv")
-    shell:
-        "python scripts/Convert_MEGAN_RMA_NCBI_c2c-snake.py -i {input.c2c} -o1 {output.inter1} "
-        "-o2 {output.inter2} -m {output.mpa} -k {output.kreport} -r {input.readcount} &> {log}"
+# all samples and filter settings are converted in one batch, so the
+# taxonomy is loaded and the taxon names are resolved only once
+TAXONOMY_RUNS = [(sample, filt) for sample in SAMPLES for filt in ["unfiltered", "filtered"]]
 
-rule TaxonomyFiltered:
+rule TaxonomyReports:
     input:
-        c2c = os.path.join(CWD, "6-c2c", "{sample}.NCBI.counts.filtered.txt"),
-        ncbiready = os.path.join(CWD, "7-kraken-mpa-reports", "NCBI-updated.txt"),
-        taxdump = os.path.join(CWD, "taxdump.tar.gz"),
-        readcount = os.path.join(CWD, "4-rma", "{sample}.readcounts.txt")
+        c2c = [os.path.join(CWD, "6-c2c", "{}.NCBI.counts.{}.txt".format(s, f)) for s, f in TAXONOMY_RUNS],
+        snapshot = os.path.join(CWD, "7-kraken-mpa-reports", "NCBI-taxonomy.snapshot"),
+        readcount = expand(os.path.join(CWD, "4-rma", "{sample}.readcounts.txt"), sample = SAMPLES)
     output:
-        inter1 = temp(os.path.join(CWD, "7-kraken-mpa-reports", "{sample}.diamond_megan.filtered.taxnames.txt")),
-        inter2 = temp(os.path.join(CWD, "7-kraken-mpa-reports", "{sample}.diamond_megan.filtered.taxids.txt")),
-        kreport = os.path.join(CWD, "7-kraken-mpa-reports", "{sample}.diamond_megan.kreport.filtered.txt"),
-        mpa = os.path.join(CWD, "7-kraken-mpa-reports", "{sample}.diamond_megan.mpa.filtered.txt")
+        kreport = [os.path.join(CWD, "7-kraken-mpa-reports", "{}.diamond_megan.kreport.{}.txt".format(s, f)) for s, f in TAXONOMY_RUNS],
+        mpa = [os.path.join(CWD, "7-kraken-mpa-reports", "{}.diamond_megan.mpa.{}.txt".format(s, f)) for s, f in TAXONOMY_RUNS]
+    params:
+        cache = os.path.join(config['taxonomy']['store'], "lookup-cache.sqlite"),
+        readcount = [os.path.join(CWD, "4-rma", "{}.readcounts.txt".format(s)) for s, f in TAXONOMY_RUNS]
     conda:
         "envs/python.yml"
     threads: 
-        1
+        4
     log: 
-        os.path.join(CWD, "logs", "{sample}.TaxonomyFilteredlog")
+        os.path.join(CWD, "logs", "TaxonomyReports.log")
     benchmark: 
-        os.path.join(CWD, "benchmarks", "{sample}.TaxonomyFiltered.tsv")
+        os.path.join(CWD, "benchmarks", "TaxonomyReports.tsv")
     shell:
-        "python scripts/Convert_MEGAN_RMA_NCBI_c2c-snake.py -i {input.c2c} -o1 {output.inter1} "
-        "-o2 {output.inter2} -m {output.mpa} -k {output.kreport} -r {input.readcount} &> {log}"
+        "python scripts/Convert_MEGAN_RMA_NCBI_c2c-snake.py -i {input.c2c} -m {output.mpa} "
+        "-k {output.kreport} -r {params.readcount} -t {input.snapshot} --cache {params.cache} "
+        "-p {threads} &> {log}"
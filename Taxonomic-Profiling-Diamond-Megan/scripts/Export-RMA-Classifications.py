@@ -0,0 +1,81 @@
+import argparse
+import logging
+import subprocess
+from collections import OrderedDict
+from compressed_io import check_process
+
+# rma2info options for each output format
+FORMATS = OrderedDict([("ids", []), ("names", ["-n"]), ("paths", ["-p"]), ("ranks", ["-n", "-r"])])
+MODES = ("r2c", "c2c")
+
+def get_args():
+    """
+    Get arguments from command line with argparse.
+    """
+    parser = argparse.ArgumentParser(
+        prog='Export-RMA-Classifications.py',
+        description="""Export the read classifications (r2c) and class counts (c2c) of
+        several classifications from one RMA file, so that all exports of the RMA file are
+        made by a single workflow job. rma2info is run once for each export, writing its
+        output file directly, exactly as a separate rule per classification would.""")
+
+    parser.add_argument("-i", "--rma",
+                        required=True,
+                        help="The RMA file to export.")
+    parser.add_argument("-x", "--rma2info",
+                        required=False,
+                        default="rma2info",
+                        help="The full path to the rma2info tool [rma2info].")
+    parser.add_argument("-e", "--export",
+                        required=True,
+                        action='append',
+                        nargs=4,
+                        metavar=('MODE', 'CLASSIFICATION', 'FORMAT', 'OUTPUT'),
+                        help="An export, given by the mode ({}), the rma2info classification "
+                             "(e.g., EC or Taxonomy), the format ({}), and the output file. "
+                             "Can be given several times.".format(", ".join(MODES), ", ".join(FORMATS)))
+    parser.add_argument("-l", "--logfile",
+                        required=True,
+                        help="The name of the log file to write.")
+
+    return parser.parse_args()
+
+def build_command(rma2info, rma, mode, classification, fmt, output):
+    """
+    Return the rma2info command of one export.
+
+    :param rma2info: path to rma2info
+    :param rma: RMA file
+    :param mode: r2c or c2c
+    :param classification: rma2info classification
+    :param fmt: output format
+    :param output: output file
+    :return: command as list
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown mode {}, expected one of {}.".format(mode, ", ".join(MODES)))
+    if fmt not in FORMATS:
+        raise ValueError("Unknown format {}, expected one of {}.".format(fmt, ", ".join(FORMATS)))
+    return [rma2info, "-i", rma, "-o", output, "-{}".format(mode), classification] + FORMATS[fmt]
+
+def setup_logging(logfile):
+    # set up logging to file
+    logging.basicConfig(filename=logfile,
+                        format="%(levelname)s: %(asctime)s: %(message)s",
+                        datefmt='%d-%b-%y %H:%M:%S',
+                        level=logging.DEBUG)
+
+def main():
+    args = get_args()
+    setup_logging(args.logfile)
+    commands = [build_command(args.rma2info, args.rma, *export) for export in args.export]
+    logging.info("main: Exporting {} classifications from {}.".format(len(commands), args.rma))
+    with open(args.logfile, 'a') as fherr:
+        for cmd in commands:
+            logging.info("main: Running {}".format(" ".join(cmd)))
+            fherr.flush()
+            proc = subprocess.Popen(cmd, stdout=fherr, stderr=fherr)
+            check_process(proc, args.rma)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import argparse
+import logging
+import os
+from read_stats import BIN_SIZE, ReadStats, load_stat
+
+# number of bytes buffered when writing chunk files
+BUFFER_SIZE = 16 * 1024 * 1024
+
+def get_args():
+    """
+    Get arguments from command line with argparse.
+    """
+    parser = argparse.ArgumentParser(
+        prog='Split-Fasta-by-Bases.py',
+        description="""Split a fasta file into chunks of consecutive records with similar
+        numbers of bases, rather than similar numbers of records, so that chunks of long
+        reads take similar time to align. The chunks are written in a single pass, which
+        also collects the read statistics of the fasta (read count, N50 and a read length
+        histogram). Chunks are named as FASTA_chunk_0000000, FASTA_chunk_0000001, etc.""")
+
+    parser.add_argument("-f", "--fasta",
+                        required=True,
+                        help="The fasta file to split.")
+    parser.add_argument("-n", "--chunks",
+                        required=False,
+                        type=int,
+                        default=None,
+                        help="The number of chunks to write.")
+    parser.add_argument("-p", "--plan",
+                        required=False,
+                        default=None,
+                        help="A chunk plan file from Plan-Chunks.py to take the number of chunks "
+                             "from, instead of --chunks.")
+    parser.add_argument("-o", "--outdir",
+                        required=True,
+                        help="The directory to write the chunks to.")
+    parser.add_argument("-s", "--statsfile",
+                        required=True,
+                        help="The name of the output read statistics file (example: SAMPLE.read-stats.txt).")
+    parser.add_argument("-b", "--binsize",
+                        required=False,
+                        type=int,
+                        default=BIN_SIZE,
+                        help="The width of the read length histogram bins in bp [1000].")
+
+    parser.add_argument("-l", "--logfile",
+                        required=True,
+                        help="The name of the log file to write.")
+
+    return parser.parse_args()
+
+def setup_logging(logfile):
+    # set up logging to file
+    logging.basicConfig(filename=logfile,
+                        format="%(levelname)s: %(asctime)s: %(message)s",
+                        datefmt='%d-%b-%y %H:%M:%S',
+                        level=logging.DEBUG)
+
+def chunk_name(fasta, outdir, chunk):
+    return os.path.join(outdir, "{}_chunk_{:07d}".format(os.path.basename(fasta), chunk))
+
+def split_fasta(fasta, outdir, chunks):
+    """
+    Write the records of the fasta file to chunks of consecutive records.
+    A new chunk is started at the first record beginning after the
+    current chunk's share of the file size, so that each chunk holds
+    about the same number of bytes, and hence of bases, within one
+    record. The order of the records is kept, which the merge of the
+    aligner outputs relies on. Every chunk file is written, even if
+    there are fewer records than chunks.
+
+    :param fasta: path to fasta file
+    :param outdir: directory to write chunks to
+    :param chunks: number of chunks
+    :return: ReadStats of all records
+    """
+    size = os.path.getsize(fasta)
+    stats = ReadStats()
+    chunk, pos, start, length, records = 0, 0, 0, None, 0
+    bound = size // chunks
+    fhout = open(chunk_name(fasta, outdir, chunk), 'wb', buffering=BUFFER_SIZE)
+    try:
+        with open(fasta, 'rb') as fhin:
+            for line in fhin:
+                if line.startswith(b'>'):
+                    if length is not None:
+                        stats.add(length)
+                    if pos >= bound and chunk < chunks - 1:
+                        fhout.close()
+                        logging.info("split_fasta: Wrote {:,} records ({:,} bytes) to chunk {}.".format(
+                            records, pos - start, chunk))
+                        chunk, start = chunk + 1, pos
+                        bound = size * (chunk + 1) // chunks
+                        fhout = open(chunk_name(fasta, outdir, chunk), 'wb', buffering=BUFFER_SIZE)
+                        records = 0
+                    length = 0
+                    records += 1
+                else:
+                    length += len(line.rstrip())
+                fhout.write(line)
+                pos += len(line)
+        if length is not None:
+            stats.add(length)
+        logging.info("split_fasta: Wrote {:,} records ({:,} bytes) to chunk {}.".format(
+            records, pos - start, chunk))
+    finally:
+        fhout.close()
+    for empty in range(chunk + 1, chunks):
+        open(chunk_name(fasta, outdir, empty), 'wb').close()
+        logging.warning("split_fasta: Wrote empty chunk {}, as there are too few records.".format(empty))
+    return stats
+
+def main():
+    args = get_args()
+    setup_logging(args.logfile)
+    if args.plan is not None:
+        args.chunks = load_stat(args.plan, "chunks")
+        logging.info("Splitting into {} chunks planned in {}.".format(args.chunks, args.plan))
+    if args.chunks is None or args.chunks < 1:
+        raise ValueError("The number of chunks must be at least 1.")
+    os.makedirs(args.outdir, exist_ok=True)
+    stats = split_fasta(args.fasta, args.outdir, args.chunks)
+    stats.write(args.statsfile, args.fasta, args.binsize)
+    logging.info("Found {:,} reads with {:,} bases, N50 = {:,} bp.".format(stats.reads, stats.bases, stats.n50()))
+
+if __name__ == '__main__':
+    main()
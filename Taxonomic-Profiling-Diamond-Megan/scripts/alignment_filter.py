@@ -0,0 +1,164 @@
+import logging
+import re
+
+# SAM flags of the alignments other than the primary alignment of a read
+NOT_PRIMARY = 0x100 | 0x800
+# CIGAR operations that consume the query, and those that clip it
+CIGAR_OPS = re.compile(rb'(\d+)([MIDNSHP=X])')
+ALIGNED_OPS = (b'M', b'I', b'=', b'X')
+CLIP_OPS = (b'S', b'H')
+
+def query_cover(cigar):
+    """
+    Return the percent of the read covered by an alignment, from the
+    aligned and clipped query bases in its CIGAR string. Aligners that
+    do not report the unaligned ends of the read as clipping give 100.
+
+    :param cigar: CIGAR string (bytes)
+    :return: percent of the read covered
+    """
+    aligned, clipped = 0, 0
+    for n, op in CIGAR_OPS.findall(cigar):
+        if op in ALIGNED_OPS:
+            aligned += int(n)
+        elif op in CLIP_OPS:
+            clipped += int(n)
+    if aligned + clipped == 0:
+        return 100.0
+    return 100.0 * aligned / (aligned + clipped)
+
+def get_score(fields):
+    for field in fields[11:]:
+        if field.startswith(b'AS:i:'):
+            return int(field[5:])
+    return 0
+
+class AlignmentFilter:
+    """
+    A writer that removes alignments MEGAN would not use from a SAM
+    stream grouped by read name, before they are written to the output.
+    The alignments of each read are held until the read name changes,
+    and are then filtered by query coverage, by the score difference to
+    the best alignment of the read, and by the number of alignments per
+    read. The primary alignment of a read, the only line with its
+    sequence, is always kept, and so is the best alignment by score if it
+    is another one (within max_hits), so no read is removed, no read is
+    left with secondary alignments only, and the reads file of the merge
+    stays valid. Data can be
+    written in any pieces, which are split into lines here.
+    """
+
+    def __init__(self, fhout, min_cover=0, top_percent=0, max_hits=0):
+        """
+        :param fhout: binary file object of output SAM
+        :param min_cover: minimum percent of the read covered by an alignment, or 0
+        :param top_percent: maximum percent below the best score of the read, or 0
+        :param max_hits: maximum number of alignments per read, or 0
+        """
+        self.fhout = fhout
+        self.min_cover = min_cover
+        self.top_percent = top_percent
+        self.max_hits = max_hits
+        self.partial = b''
+        self.qname = None
+        self.group = []
+        self.alignments, self.removed = int(0), int(0)
+        self.nbytes, self.removed_bytes = int(0), int(0)
+
+    @property
+    def active(self):
+        return self.min_cover > 0 or self.top_percent > 0 or self.max_hits > 0
+
+    def write(self, data):
+        data = self.partial + bytes(data)
+        lines = data.split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.add_line(line + b'\n')
+
+    def add_line(self, line):
+        if line.startswith(b'@'):
+            self.flush_group()
+            self.fhout.write(line)
+            return
+        qname = line[:line.find(b'\t')]
+        if qname != self.qname:
+            self.flush_group()
+            self.qname = qname
+        self.group.append(line)
+
+    def filter_group(self, lines):
+        """
+        Select the alignments of one read to keep, in their original order.
+        The thresholds are relative to the best score of the read, but the
+        primary alignment is kept even if a secondary or supplementary
+        alignment scores higher, and takes the first of the max_hits.
+
+        :param lines: SAM lines of the read
+        :return: kept SAM lines
+        """
+        alns, primary = [], None
+        for i, line in enumerate(lines):
+            fields = line.rstrip(b'\n').split(b'\t')
+            alns.append((get_score(fields), i, fields[5] if len(fields) > 5 else b'*'))
+            if primary is None and len(fields) > 1 and not int(fields[1]) & NOT_PRIMARY:
+                primary = alns[-1]
+        best = max(alns, key=lambda aln: (aln[0], -aln[1]))
+        kept = (best,) if primary is None else (primary, best)
+        keep = alns
+        if self.min_cover > 0:
+            keep = [aln for aln in keep if aln in kept or query_cover(aln[2]) >= self.min_cover]
+        if self.top_percent > 0:
+            bound = best[0] * (1 - self.top_percent / 100.0)
+            keep = [aln for aln in keep if aln is primary or aln[0] >= bound]
+        if self.max_hits > 0 and len(keep) > self.max_hits:
+            keep = sorted(keep, key=lambda aln: (aln is not primary, -aln[0], aln[1]))[:self.max_hits]
+            keep.sort(key=lambda aln: aln[1])
+        return [lines[aln[1]] for aln in keep]
+
+    def flush_group(self):
+        if not self.group:
+            return
+        kept = self.filter_group(self.group) if len(self.group) > 1 or self.min_cover > 0 else self.group
+        size = sum(len(line) for line in self.group)
+        kept_size = sum(len(line) for line in kept)
+        self.alignments += len(self.group)
+        self.nbytes += size
+        self.removed += len(self.group) - len(kept)
+        self.removed_bytes += size - kept_size
+        self.fhout.writelines(kept)
+        self.group = []
+
+    def close(self):
+        """
+        Write the alignments of the last read. The output file itself is
+        left open.
+        """
+        if self.partial:
+            self.add_line(self.partial + b'\n')
+            self.partial = b''
+        self.flush_group()
+        self.qname = None
+
+    def add_counts(self, other):
+        self.alignments += other[0]
+        self.removed += other[1]
+        self.nbytes += other[2]
+        self.removed_bytes += other[3]
+
+    def counts(self):
+        return self.alignments, self.removed, self.nbytes, self.removed_bytes
+
+def log_filter(counts):
+    """
+    Log the alignments and bytes removed by the pre-filter.
+
+    :param counts: (alignments, removed alignments, bytes, removed bytes)
+    :return: None
+    """
+    alignments, removed, nbytes, removed_bytes = counts
+    logging.info("log_filter: Pre-filter removed {:,} of {:,} alignments ({}%) and {:,} of {:,} "
+                 "bytes ({}%).".format(removed, alignments,
+                                       round(100.0 * removed / alignments, 2) if alignments else 0.0,
+                                       removed_bytes, nbytes,
+                                       round(100.0 * removed_bytes / nbytes, 2) if nbytes else 0.0))
@@ -0,0 +1,150 @@
+import argparse
+import os
+from collections import Counter
+
+# width of the bins of the read length histogram, in bp
+BIN_SIZE = 1000
+
+def get_args():
+    """
+    Get arguments from command line with argparse.
+    """
+    parser = argparse.ArgumentParser(
+        prog='read_stats.py',
+        description="""Write the read statistics of a fasta file: the number of reads and
+        bases, the mean, minimum, maximum and N50 read length, and a read length histogram.
+        The statistics file is tab-delimited, and the read count can be read back with
+        load_read_count() or on the command line with: awk '$1 == "reads" {print $2}'.""")
+
+    parser.add_argument("-f", "--fasta",
+                        required=True,
+                        help="The fasta file with the reads.")
+    parser.add_argument("-o", "--outfile",
+                        required=True,
+                        help="The name of the output statistics file (example: SAMPLE.read-stats.txt).")
+    parser.add_argument("-b", "--binsize",
+                        required=False,
+                        type=int,
+                        default=BIN_SIZE,
+                        help="The width of the read length histogram bins in bp [1000].")
+
+    return parser.parse_args()
+
+class ReadStats:
+    """
+    Read statistics collected while the reads are streamed. The exact
+    read lengths are counted, which takes little memory because read
+    lengths span a limited range, and gives an exact N50.
+    """
+
+    def __init__(self):
+        self.lengths = Counter()
+
+    def add(self, length):
+        self.lengths[length] += 1
+
+    @property
+    def reads(self):
+        return sum(self.lengths.values())
+
+    @property
+    def bases(self):
+        return sum(length * count for length, count in self.lengths.items())
+
+    def n50(self):
+        """
+        Return the read length at which the reads of this length or
+        longer contain at least half of all bases.
+
+        :return: N50 read length, or 0 without reads
+        """
+        bases, running = self.bases, int(0)
+        for length in sorted(self.lengths, reverse=True):
+            running += length * self.lengths[length]
+            if running * 2 >= bases:
+                return length
+        return 0
+
+    def histogram(self, binsize):
+        """
+        Count the reads and bases in read length bins.
+
+        :param binsize: width of the bins in bp
+        :return: sorted list of (bin start, bin end, reads, bases)
+        """
+        bins = {}
+        for length, count in self.lengths.items():
+            start = length // binsize * binsize
+            reads, bases = bins.get(start, (0, 0))
+            bins[start] = (reads + count, bases + length * count)
+        return [(start, start + binsize - 1, reads, bases) for start, (reads, bases) in sorted(bins.items())]
+
+    def write(self, outfile, fasta, binsize=BIN_SIZE):
+        """
+        Write the statistics as tab-delimited key and value lines,
+        followed by the histogram lines.
+
+        :param outfile: name of statistics file to write
+        :param fasta: name of the fasta file, written in the first line
+        :param binsize: width of the histogram bins in bp
+        :return: None
+        """
+        reads, bases = self.reads, self.bases
+        with open(outfile, 'w') as fh:
+            fh.write("# read statistics of {}\n".format(os.path.basename(fasta)))
+            fh.write("reads\t{}\n".format(reads))
+            fh.write("bases\t{}\n".format(bases))
+            fh.write("mean_length\t{}\n".format(round(bases / reads, 1) if reads else 0))
+            fh.write("min_length\t{}\n".format(min(self.lengths) if reads else 0))
+            fh.write("max_length\t{}\n".format(max(self.lengths) if reads else 0))
+            fh.write("n50\t{}\n".format(self.n50()))
+            fh.write("# histogram: bin start (bp), bin end (bp), reads, bases\n")
+            for row in self.histogram(binsize):
+                fh.write("histogram\t{}\n".format("\t".join(str(x) for x in row)))
+
+def load_stat(statsfile, key):
+    """
+    Read an integer value from a file of tab-delimited key and value
+    lines, such as a statistics file.
+
+    :param statsfile: name of statistics file
+    :param key: name of the value
+    :return: value
+    """
+    prefix = "{}\t".format(key)
+    with open(statsfile, 'r') as fh:
+        for line in fh:
+            if line.startswith(prefix):
+                return int(line.split('\t')[1])
+    raise ValueError("No {} found in {}.".format(key, statsfile))
+
+def load_read_count(statsfile):
+    return load_stat(statsfile, "reads")
+
+def collect_stats(fasta):
+    """
+    Collect the read statistics of a fasta file in a single pass.
+
+    :param fasta: path to fasta file
+    :return: ReadStats
+    """
+    stats = ReadStats()
+    length = None
+    with open(fasta, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b'>'):
+                if length is not None:
+                    stats.add(length)
+                length = 0
+            else:
+                length += len(line.rstrip())
+    if length is not None:
+        stats.add(length)
+    return stats
+
+def main():
+    args = get_args()
+    collect_stats(args.fasta).write(args.outfile, args.fasta, args.binsize)
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,17 @@
 import argparse
 import logging
+import os
+import re
+import shutil
+import tempfile
+from contextlib import contextmanager
+from multiprocessing import Pool
+from alignment_filter import AlignmentFilter, log_filter
+from compressed_io import (BUFFER_SIZE, append_file, format_command, is_compressed, open_input,
+                           open_output, open_process)
+
+# a CIGAR string may only contain digits and the legal operations
+LEGAL_CIGAR = re.compile(rb'[0-9MIDNSHP=X]*')
 
 def get_args():
     """
@@ -7,16 +19,61 @@ def get_args():
     """
     parser = argparse.ArgumentParser(
         prog='sam-merger.py',
-        description="""Merge a series of SAM format files from a chunked alignment pipeline.""")
+        description="""Merge a series of SAM format files from a chunked alignment pipeline.
+        The SAM files are screened for illegal CIGAR strings in parallel processes, and
+        the screened files are then concatenated in the order given. SAM files ending
+        in .gz are read and written through bgzip (or gzip) processes. With --command, the
+        input files are fasta chunks that are aligned one after another, and the output
+        of the aligner is screened as it is produced, without writing chunk SAM files.
+        With --screened, SAM files written by this script for single chunks are appended
+        to the output as they are, so the chunks can be aligned and screened in separate
+        jobs and merged at the end without being read again.""")
 
     parser.add_argument("-i", "--infiles",
                         required=True,
                         nargs='+',
                         help="The SAM files to merge (include all file names "
-                             "separated by spaces).")
+                             "separated by spaces), which can be compressed (.gz).")
     parser.add_argument("-o", "--outfile",
                         required=True,
-                        help="The name of the output file (example: Merged.sam).")
+                        help="The name of the output file (example: Merged.sam), which is "
+                             "compressed if it ends in .gz.")
+    parser.add_argument("-t", "--threads",
+                        required=False,
+                        type=int,
+                        default=1,
+                        help="The number of processes screening SAM files [1].")
+    parser.add_argument("-c", "--command",
+                        required=False,
+                        default=None,
+                        help="Optional aligner command that writes SAM to stdout, run for each "
+                             "input file with {} replaced by the file name (example: "
+                             "\"diamond blastx -d db.dmnd -f 101 -q {}\").")
+    parser.add_argument("--no_headers",
+                        required=False,
+                        action='store_true',
+                        help="Optional flag to drop all header lines, for the SAM files of "
+                             "chunks other than the first, which are appended with --screened.")
+    parser.add_argument("--screened",
+                        required=False,
+                        action='store_true',
+                        help="Optional flag for SAM files already screened by this script (with "
+                             "the header lines in the first file only), which are appended to "
+                             "the output without being screened again. Compressed files are "
+                             "appended without being decompressed if the output is compressed.")
+    parser.add_argument("--top_percent",
+                        required=False,
+                        type=float,
+                        default=0,
+                        help="Optional pre-filter: remove alignments scoring more than this "
+                             "percent below the best alignment of their read, or 0 to keep "
+                             "them [0].")
+    parser.add_argument("--max_hits",
+                        required=False,
+                        type=int,
+                        default=0,
+                        help="Optional pre-filter: keep only this many of the best alignments "
+                             "of each read, or 0 to keep all [0].")
 
     parser.add_argument("-l", "--logfile",
                         required=True,
@@ -24,73 +81,133 @@ def get_args():
 
     return parser.parse_args()
 
-def good_cigar(legal, cigar):
-    status = True
-    for c in cigar:
-        if c.isdigit() or c in legal:
-            pass
-        else:
-            status = False
-    return status
+def good_cigar(cigar):
+    return LEGAL_CIGAR.fullmatch(cigar) is not None
+
+@contextmanager
+def open_sam(infile, command):
+    if command is None:
+        with open_input(infile) as fhin:
+            yield fhin
+    else:
+        with open_process(format_command(command, infile), infile) as fhin:
+            yield fhin
 
-def write_header_sam(infile, outfile, legal):
+def screen_sam(infile, outfile, headers, command=None, top_percent=0, max_hits=0):
     """
-    Writes all lines of SAM file, including headers,
-    to the output file. Filters out CIGAR strings with
-    illegal characters and omits row.
-    
-    :param infile: name of first SAM file in series
+    Writes all lines of a SAM file, or of the SAM output of the aligner
+    command for the input file, to the output file, including headers
+    only if requested. Filters out CIGAR strings with illegal characters
+    and omits row. The screened alignments pass through the pre-filter
+    if any of its thresholds is set.
+
+    :param infile: name of SAM file to screen, or of the input file of the command
     :param outfile: name of output file to write contents in
-    :param legal: list of legal characters for CIGAR strings
+    :param headers: True to keep header lines (start with @)
+    :param command: aligner command template, or None to read a SAM file
+    :param top_percent: pre-filter maximum percent below the best score of a read, or 0
+    :param max_hits: pre-filter maximum number of alignments per read, or 0
     :return goodcount: count of alignments with valid CIGAR
     :return badcount: count of excluded alignments with invalid CIGAR
+    :return filtercounts: counts of the pre-filter (alignments, removed, bytes, removed bytes)
     """
     goodcount, badcount = int(0), int(0)
-    with open(infile, 'r') as fhin, open(outfile, 'a') as fhout:
+    with open_sam(infile, command) as fhin, open_output(outfile, append=True) as fhout:
+        fhfilter = AlignmentFilter(fhout, top_percent=top_percent, max_hits=max_hits)
+        fhsam = fhfilter if fhfilter.active else fhout
         for line in fhin:
-            if line.startswith("@"):
-                fhout.write(line)
-            if not line.startswith("@") and len(line.split()) > 5:
-                if good_cigar(legal, line.split()[5]):
-                    goodcount += 1
+            if line.startswith(b"@"):
+                if headers:
                     fhout.write(line)
+                continue
+            fields = line.split(None, 6)
+            if len(fields) > 5:
+                if good_cigar(fields[5]):
+                    goodcount += 1
+                    fhsam.write(line)
                 else:
-                    badcount+=1
-    logging.info("Finished adding SAM: {}".format(infile))
-    return goodcount, badcount
-                            
-def write_remainder_sams(samlist, outfile, legal):
+                    badcount += 1
+        fhfilter.close()
+    return goodcount, badcount, fhfilter.counts()
+
+def write_sams(samlist, outfile, threads, command=None, top_percent=0, max_hits=0, headers=True):
     """
     Writes all lines of SAM files included in list to output file,
-    while excluding any lines with headers (start with @). Filters
-    out CIGAR strings with illegal characters and omits row.
-    
+    keeping the header lines of the first file only, if any. Filters out
+    CIGAR strings with illegal characters and omits row. With more
+    than one process, each SAM file is screened into a temporary file
+    next to the output file, and the temporary files are appended to
+    the output file in the order of the list. Temporary files of a
+    compressed output are compressed, and are appended without being
+    decompressed. With an aligner command, the input files are aligned
+    one after another and their output is appended directly, as the
+    aligner already uses all threads. The alignments of a read are
+    all in one file, so each file is pre-filtered on its own.
+
     :param samlist: list of SAM file names
     :param outfile: name of output file to write contents in
-    :param legal: list of legal characters for CIGAR strings
+    :param threads: number of processes
+    :param command: aligner command template run for each file, or None to read SAM files
+    :param top_percent: pre-filter maximum percent below the best score of a read, or 0
+    :param max_hits: pre-filter maximum number of alignments per read, or 0
+    :param headers: True to keep the header lines of the first file
     :return goodcount: count of alignments with valid CIGAR
     :return badcount: count of excluded alignments with invalid CIGAR
+    :return filtercounts: AlignmentFilter holding the summed pre-filter counts
     """
     goodcount, badcount = int(0), int(0)
+    filtercounts = AlignmentFilter(None, top_percent=top_percent, max_hits=max_hits)
+    if threads == 1 or len(samlist) == 1 or command is not None:
+        for i, infile in enumerate(samlist):
+            g, b, f = screen_sam(infile, outfile, headers and i == 0, command, top_percent, max_hits)
+            logging.info("Finished adding SAM: {}".format(infile))
+            goodcount, badcount = goodcount + g, badcount + b
+            filtercounts.add_counts(f)
+        return goodcount, badcount, filtercounts
+
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outfile)))
+    try:
+        suffix = os.path.splitext(outfile)[1] if is_compressed(outfile) else ""
+        jobs = [(infile, os.path.join(tmpdir, "{}.sam{}".format(i, suffix)), headers and i == 0, None,
+                 top_percent, max_hits)
+                for i, infile in enumerate(samlist)]
+        with Pool(min(threads, len(jobs))) as pool:
+            counts = pool.starmap(screen_sam, jobs)
+        with open(outfile, 'ab') as fhout:
+            for job, (g, b, f) in zip(jobs, counts):
+                infile, tmpfile = job[0], job[1]
+                with open(tmpfile, 'rb') as fhin:
+                    shutil.copyfileobj(fhin, fhout, BUFFER_SIZE)
+                os.remove(tmpfile)
+                logging.info("Finished adding SAM: {}".format(infile))
+                goodcount, badcount = goodcount + g, badcount + b
+                filtercounts.add_counts(f)
+    finally:
+        shutil.rmtree(tmpdir)
+    return goodcount, badcount, filtercounts
+
+def append_sams(samlist, outfile):
+    """
+    Appends SAM files that were already screened by this script to the
+    output file in the order of the list.
+
+    :param samlist: list of screened SAM file names
+    :param outfile: name of output file to write contents in
+    :return: number of bytes copied
+    """
+    nbytes = int(0)
     for infile in samlist:
-        with open(infile, 'r') as fhin, open(outfile, 'a') as fhout:
-            for line in fhin:
-                if not line.startswith("@") and len(line.split()) > 5:
-                    if good_cigar(legal, line.split()[5]):
-                        goodcount += 1
-                        fhout.write(line)
-                    else:
-                        badcount += 1
+        nbytes += append_file(infile, outfile)
         logging.info("Finished adding SAM: {}".format(infile))
-    return goodcount, badcount
-    
-def tally_counts(g1, g2, b1, b2):
-    total = g1+g2+b1+b2
-    pgood = round(((g1+g2) / float(total)) * 100, 5)
-    pbad = round(((b1+b2) / float(total)) * 100, 5)
+    return nbytes
+
+def tally_counts(goodcount, badcount):
+    total = goodcount + badcount
+    pgood = round((goodcount / float(total)) * 100, 5) if total else 0.0
+    pbad = round((badcount / float(total)) * 100, 5) if total else 0.0
     logging.info("Found {:,} total read alignments.".format(total))
-    logging.info("Found {:,} read alignments ({}%) contained valid CIGAR strings.".format(g1+g2, pgood))
-    logging.info("Found {:,} read alignments ({}%) contained illegal CIGAR strings.".format(b1+b2, pbad))
+    logging.info("Found {:,} read alignments ({}%) contained valid CIGAR strings.".format(goodcount, pgood))
+    logging.info("Found {:,} read alignments ({}%) contained illegal CIGAR strings.".format(badcount, pbad))
 
 def setup_logging(logfile):
     # set up logging to file
@@ -103,14 +220,15 @@ def main():
     args = get_args()
     setup_logging(args.logfile)
     logging.info("Starting SAM merge.")
-    legal = ["M", "I", "D", "N", "S", "H", "P", "=", "X"]
-    if len(args.infiles) == 1:
-        g1, b1 = write_header_sam(args.infiles[0], args.outfile, legal)
-        tally_counts(g1, 1, b1, 1)
-    else:
-        g1, b1 = write_header_sam(args.infiles[0], args.outfile, legal)
-        g2, b2 = write_remainder_sams(args.infiles[1:], args.outfile, legal)
-        tally_counts(g1, g2, b1, b2)
+    if args.screened:
+        nbytes = append_sams(args.infiles, args.outfile)
+        logging.info("Appended {:,} bytes of {:,} screened SAM files.".format(nbytes, len(args.infiles)))
+        return
+    goodcount, badcount, filtercounts = write_sams(args.infiles, args.outfile, args.threads, args.command,
+                                                   args.top_percent, args.max_hits, not args.no_headers)
+    tally_counts(goodcount, badcount)
+    if filtercounts.active:
+        log_filter(filtercounts.counts())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,99 @@
+import argparse
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+from taxonomy_snapshot import SNAPSHOT_FORMAT, build_snapshot, taxdump_checksum
+
+def get_args():
+    """
+    Get arguments from command line with argparse.
+    """
+    parser = argparse.ArgumentParser(
+        prog='taxonomy_store.py',
+        description="""Provide the taxonomy snapshot for a local NCBI taxdump from a
+        versioned taxonomy store. Snapshots are keyed by the checksum of the taxdump,
+        so a snapshot is only built the first time a new taxdump is supplied and is
+        reused by every later run.""")
+
+    parser.add_argument("-t", "--taxdump",
+                        required=True,
+                        help="A local NCBI taxdump.tar.gz file, or a directory containing the "
+                             "extracted nodes.dmp, names.dmp and merged.dmp files.")
+    parser.add_argument("-s", "--store",
+                        required=True,
+                        help="The taxonomy store directory, which can be shared between runs.")
+    parser.add_argument("-o", "--outfile",
+                        required=True,
+                        help="The name of the symbolic link to create, which points to the "
+                             "snapshot in the store (e.g., NCBI-taxonomy.snapshot).")
+
+    return parser.parse_args()
+
+@contextmanager
+def store_lock(store):
+    """
+    Hold an exclusive lock on the taxonomy store, so that jobs running
+    at the same time never build the same snapshot twice or read a
+    snapshot that is still being written.
+
+    :param store: path to taxonomy store directory
+    """
+    os.makedirs(store, exist_ok=True)
+    with open(os.path.join(store, ".lock"), 'a') as fh:
+        print("store_lock: Waiting for lock on {}...".format(store))
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+def get_snapshot(taxdump, store):
+    """
+    Return the snapshot for taxdump, building it only if the store does
+    not have one for this checksum and snapshot format yet. A version
+    file with the checksum and source of the taxdump is kept next to
+    each snapshot.
+
+    :param taxdump: path to taxdump.tar.gz or to an extracted taxdump directory
+    :param store: path to taxonomy store directory
+    :return: path to snapshot file in the store
+    """
+    print("get_snapshot: Calculating checksum of {}...".format(taxdump))
+    checksum = taxdump_checksum(taxdump)
+    entry = os.path.join(store, "v{}-{}".format(SNAPSHOT_FORMAT, checksum[:16]))
+    snapshot = os.path.join(entry, "NCBI-taxonomy.snapshot")
+    with store_lock(store):
+        if os.path.isfile(snapshot):
+            print("get_snapshot: Using stored snapshot {}.".format(snapshot))
+        else:
+            print("get_snapshot: No stored snapshot for this taxdump, building {}...".format(snapshot))
+            os.makedirs(entry, exist_ok=True)
+            build_snapshot(taxdump, snapshot, checksum)
+            with open(os.path.join(entry, "version.json"), 'w') as fh:
+                json.dump({"taxdump_sha256": checksum, "snapshot_format": SNAPSHOT_FORMAT,
+                           "taxdump": os.path.abspath(taxdump),
+                           "built": time.strftime("%Y-%m-%d %H:%M:%S")}, fh, indent=2)
+    return snapshot
+
+def link_snapshot(snapshot, outfile):
+    """
+    Point outfile at the stored snapshot, replacing any existing link.
+
+    :param snapshot: path to snapshot file in the store
+    :param outfile: name of the symbolic link to create
+    """
+    print("link_snapshot: Linking {} to {}...".format(outfile, snapshot))
+    tmplink = "{}.tmp.{}".format(outfile, os.getpid())
+    os.symlink(os.path.abspath(snapshot), tmplink)
+    os.replace(tmplink, outfile)
+
+def main():
+    args = get_args()
+    snapshot = get_snapshot(args.taxdump, args.store)
+    link_snapshot(snapshot, args.outfile)
+    print("\nDone!\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+import argparse
+import logging
+
+def get_args():
+    """
+    Get arguments from command line with argparse.
+    """
+    parser = argparse.ArgumentParser(
+        prog='Derive-Filtered-Taxonomy.py',
+        description="""Apply the MEGAN minimum support filter (--minSupportPercent) to the
+        class counts (c2c) and read classifications (r2c) exported from an unfiltered RMA
+        file, instead of running sam2rma a second time with the filter. Taxa with fewer
+        assigned reads than the minimum support pass their reads up the lineage, from the
+        deepest taxa to the root, until they reach a taxon with enough support, as MEGAN
+        does. The lineages are taken from a paths export of the same RMA file
+        (rma2info -c2c CLASSIFICATION -p). With --validate, the derived files are compared
+        to those exported from a filtered RMA file, and the differences are reported.""")
+
+    parser.add_argument("-c", "--c2c",
+                        required=True,
+                        help="The c2c file exported from the unfiltered RMA file "
+                             "(rma2info -c2c CLASSIFICATION -n, optionally with -r).")
+    parser.add_argument("-p", "--paths",
+                        required=True,
+                        help="The paths file exported from the unfiltered RMA file "
+                             "(rma2info -c2c CLASSIFICATION -p).")
+    parser.add_argument("-r", "--r2c",
+                        required=False,
+                        default=None,
+                        help="Optional r2c file exported from the unfiltered RMA file "
+                             "(rma2info -r2c CLASSIFICATION -n).")
+    parser.add_argument("-m", "--min_support_percent",
+                        required=True,
+                        type=float,
+                        help="The minimum support as percent of assigned reads, as given to "
+                             "sam2rma with --minSupportPercent.")
+    parser.add_argument("-o", "--c2c_out",
+                        required=True,
+                        help="The name of the filtered c2c file to write, or to compare with "
+                             "--validate.")
+    parser.add_argument("-R", "--r2c_out",
+                        required=False,
+                        default=None,
+                        help="The name of the filtered r2c file to write, or to compare with "
+                             "--validate (requires --r2c).")
+    parser.add_argument("--ranks",
+                        required=False,
+                        action='store_true',
+                        help="The c2c file has a rank column before the name (rma2info -r).")
+    parser.add_argument("--validate",
+                        required=False,
+                        default=None,
+                        help="Optional name of a report file. The c2c (and r2c) files given to "
+                             "-o (and -R) are then not written, but compared with the derived "
+                             "ones, which should be exported from an RMA file made with the "
+                             "same minimum support.")
+
+    return parser.parse_args()
+
+def parse_count(value):
+    count = float(value)
+    return int(count) if count.is_integer() else count
+
+def format_count(count):
+    return str(int(count)) if float(count).is_integer() else str(count)
+
+def read_c2c(c2cfile, ranks):
+    """
+    Read the class counts of a c2c file. The counts of rows with the
+    same name are summed.
+
+    :param c2cfile: name of c2c file
+    :param ranks: True if the file has a rank column before the name
+    :return counts: dict of name: count, in the order of the file
+    :return levels: dict of name: rank column
+    """
+    counts, levels = {}, {}
+    with open(c2cfile, 'r') as fh:
+        for line in fh:
+            parts = line.rstrip('\n').split('\t')
+            if ranks:
+                if len(parts) < 3:
+                    continue
+                level, name, count = parts[0], parts[1], parts[2]
+                levels.setdefault(name, level)
+            else:
+                if len(parts) < 2:
+                    continue
+                name, count = parts[0], parts[1]
+            counts[name] = counts.get(name, 0) + parse_count(count)
+    return counts, levels
+
+def read_paths(pathsfile):
+    """
+    Build the tree of the classification from a paths export, in which
+    each taxon is given by the names of its lineage separated by
+    semicolons. Names are assumed to be unique, as in the c2c files.
+
+    :param pathsfile: name of paths file
+    :return parents: dict of name: parent name, or None for a root
+    """
+    parents = {}
+    with open(pathsfile, 'r') as fh:
+        for line in fh:
+            path = line.rstrip('\n').split('\t')[0]
+            names = [name.strip() for name in path.split(';') if name.strip()]
+            for parent, name in zip([None] + names[:-1], names):
+                if name in parents and parents[name] != parent:
+                    logging.warning("read_paths: {} has more than one parent, using the first.".format(name))
+                    continue
+                parents.setdefault(name, parent)
+    return parents
+
+def get_min_support(counts, parents, percent):
+    """
+    Return the minimum support in reads: the percent of all reads that
+    are assigned to a taxon of the tree, but at least 1.
+
+    :param counts: dict of name: count
+    :param parents: dict of name: parent name
+    :param percent: minimum support as percent of assigned reads
+    :return: minimum support
+    """
+    assigned = sum(count for name, count in counts.items() if name in parents)
+    return max(1, int(percent / 100.0 * assigned))
+
+def depth(name, parents, depths):
+    path = []
+    while name is not None and name not in depths:
+        path.append(name)
+        name = parents.get(name)
+    base = depths[name] if name is not None else -1
+    for node in reversed(path):
+        base += 1
+        depths[node] = base
+    return base
+
+def filter_counts(counts, parents, min_support):
+    """
+    Move the reads of taxa with less than the minimum support to their
+    parent, from the deepest taxa up. A taxon keeps the reads moved to
+    it from below if, with its own reads, they reach the minimum
+    support, and passes them all on otherwise. Reads reaching a root
+    stay there. Names that are not in the tree (such as Not assigned
+    or No hits) keep their counts.
+
+    :param counts: dict of name: count
+    :param parents: dict of name: parent name
+    :param min_support: minimum support
+    :return filtered: dict of name: count of the taxa with reads after filtering
+    :return moved: dict of name: name of the taxon its reads were moved to
+    """
+    depths = {}
+    pending = {}
+    for name, count in counts.items():
+        if name in parents:
+            pending[name] = pending.get(name, 0) + count
+            node = parents[name]
+            while node is not None and node not in pending:
+                pending[node] = 0
+                node = parents[node]
+    filtered = {name: count for name, count in counts.items() if name not in parents}
+    unsupported = set()
+    for name in sorted(pending, key=lambda node: -depth(node, parents, depths)):
+        count = pending[name]
+        parent = parents[name]
+        if count >= min_support or parent is None:
+            if count > 0:
+                filtered[name] = filtered.get(name, 0) + count
+        else:
+            pending[parent] += count
+            unsupported.add(name)
+    moved = {}
+    for name in counts:
+        target = name
+        while target in unsupported:
+            target = parents[target]
+        if target != name:
+            moved[name] = target
+    return filtered, moved
+
+def write_c2c(outfile, filtered, counts, levels, ranks):
+    """
+    Write the filtered class counts, keeping the order of the
+    unfiltered c2c file, followed by taxa that only have reads after
+    filtering. Taxa without a rank in the unfiltered file are written
+    with the rank '-'.
+    """
+    order = [name for name in counts if name in filtered] + \
+            [name for name in filtered if name not in counts]
+    with open(outfile, 'w') as fh:
+        for name in order:
+            if ranks:
+                fh.write("{}\t{}\t{}\n".format(levels.get(name, '-'), name, format_count(filtered[name])))
+            else:
+                fh.write("{}\t{}\n".format(name, format_count(filtered[name])))
+
+def iter_r2c(r2cfile, moved):
+    with open(r2cfile, 'r') as fh:
+        for line in fh:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) > 1 and parts[1] in moved:
+                parts[1] = moved[parts[1]]
+            yield parts
+
+def write_r2c(outfile, r2cfile, moved):
+    with open(outfile, 'w') as fh:
+        for parts in iter_r2c(r2cfile, moved):
+            fh.write("\t".join(parts) + "\n")
+
+def compare_counts(derived, real, fh):
+    """
+    Write the taxa whose counts differ between the derived and the real
+    filtered class counts.
+
+    :return: number of differing taxa
+    """
+    differing = 0
+    for name in list(derived) + [name for name in real if name not in derived]:
+        a, b = derived.get(name), real.get(name)
+        if a != b:
+            differing += 1
+            fh.write("c2c\t{}\tderived={}\treal={}\n".format(
+                name, format_count(a) if a is not None else "NA", format_count(b) if b is not None else "NA"))
+    return differing
+
+def compare_reads(r2cfile, moved, realfile, fh):
+    """
+    Write the reads classified differently in the derived and the real
+    filtered read classifications.
+
+    :return: number of differing reads, number of reads compared
+    """
+    real = {}
+    with open(realfile, 'r') as fhreal:
+        for line in fhreal:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) > 1:
+                real[parts[0]] = parts[1]
+    differing, total = 0, 0
+    for parts in iter_r2c(r2cfile, moved):
+        if len(parts) < 2:
+            continue
+        total += 1
+        if real.pop(parts[0], None) != parts[1]:
+            differing += 1
+            fh.write("r2c\t{}\tderived={}\n".format(parts[0], parts[1]))
+    for read, name in real.items():
+        differing += 1
+        fh.write("r2c\t{}\tderived=NA\treal={}\n".format(read, name))
+    return differing, total
+
+def validate(args, filtered, moved):
+    """
+    Compare the derived files with those exported from a filtered RMA
+    file, and write the differences and a summary to the report file.
+
+    :return: True if the derived files match
+    """
+    real, _ = read_c2c(args.c2c_out, args.ranks)
+    with open(args.validate, 'w') as fh:
+        fh.write("# validation of the filtered classification derived from {}\n".format(args.c2c))
+        taxa = compare_counts(filtered, real, fh)
+        summary = ["taxa\t{}".format(len(set(filtered) | set(real))), "differing_taxa\t{}".format(taxa)]
+        reads = 0
+        if args.r2c is not None and args.r2c_out is not None:
+            reads, total = compare_reads(args.r2c, moved, args.r2c_out, fh)
+            summary.extend(["reads\t{}".format(total), "differing_reads\t{}".format(reads)])
+        summary.append("identical\t{}".format("yes" if taxa == 0 and reads == 0 else "no"))
+        fh.write("\n".join(summary) + "\n")
+    for line in summary:
+        logging.info("validate: {}".format(line.replace('\t', ': ')))
+    return taxa == 0 and reads == 0
+
+def setup_logging():
+    logging.basicConfig(format="%(levelname)s: %(asctime)s: %(message)s",
+                        datefmt='%d-%b-%y %H:%M:%S',
+                        level=logging.DEBUG)
+
+def main():
+    args = get_args()
+    setup_logging()
+    if args.r2c_out is not None and args.r2c is None:
+        raise ValueError("A filtered r2c file (-R) requires the unfiltered r2c file (-r).")
+    counts, levels = read_c2c(args.c2c, args.ranks)
+    parents = read_paths(args.paths)
+    missing = [name for name in counts if name not in parents]
+    if missing:
+        logging.info("main: {:,} classes are not in the paths file and are kept as they are: {}".format(
+            len(missing), ", ".join(missing[:10])))
+    if args.min_support_percent > 0:
+        min_support = get_min_support(counts, parents, args.min_support_percent)
+        filtered, moved = filter_counts(counts, parents, min_support)
+    else:
+        min_support, filtered, moved = 0, dict(counts), {}
+    logging.info("main: Minimum support is {:,} reads; moved the reads of {:,} of {:,} classes up "
+                 "their lineage.".format(min_support, len(moved), len(counts)))
+    if args.validate is not None:
+        validate(args, filtered, moved)
+        return
+    write_c2c(args.c2c_out, filtered, counts, levels, args.ranks)
+    if args.r2c_out is not None:
+        write_r2c(args.r2c_out, args.r2c, moved)
+
+if __name__ == '__main__':
+    main()
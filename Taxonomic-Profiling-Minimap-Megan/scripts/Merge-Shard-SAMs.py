@@ -0,0 +1,427 @@
+import argparse
+import heapq
+import logging
+import os
+import re
+import subprocess
+from contextlib import ExitStack
+from itertools import groupby
+from alignment_filter import AlignmentFilter, log_filter
+from compressed_io import BUFFER_SIZE, decompressor, is_compressed, open_input, open_output
+
+# SAM flags
+SECONDARY = 0x100
+SUPPLEMENTARY = 0x800
+# CIGAR operations counted in the alignment block length of minimap2
+CIGAR_OPS = re.compile(rb'(\d+)([MIDNSHP=X])')
+BLOCK_OPS = (b'M', b'I', b'D', b'=', b'X')
+
+class OrderError(ValueError):
+    pass
+
+def get_args():
+    """
+    Get arguments from command line with argparse.
+    """
+    parser = argparse.ArgumentParser(
+        prog='Merge-Shard-SAMs.py',
+        description="""Merge the SAM files of the same reads aligned against separate
+        shards of a reference database into one SAM file, as if the reads had been aligned
+        against a single index. For each read, the primary alignment is taken from the
+        shard with the best alignment score (AS), the alignments of all other shards
+        become secondary alignments, except their supplementary alignments, which belong
+        to a primary alignment that is not kept and are dropped, and the secondary
+        alignments are selected again across all shards with the secondary-to-primary
+        score ratio and the maximum number of secondary alignments of minimap2 (-p, -N).
+        The mapping quality of the primary alignment is lowered by the score difference to
+        the best alignment on another shard, which minimap2 would have seen with a single
+        index. The SAM files are read in the order of the reads fasta, or sorted by read
+        name as soon as a read is found out of that order. The merged SAM and the ordered
+        list of unique read names are written in a single pass.""")
+
+    parser.add_argument("-i", "--infiles",
+                        required=True,
+                        nargs='+',
+                        help="The SAM files of the shards (include all file names separated "
+                             "by spaces), which can be compressed (.gz).")
+    parser.add_argument("-f", "--fasta",
+                        required=True,
+                        help="The fasta file of the reads, giving the order of the SAM files.")
+    parser.add_argument("-o", "--outfile",
+                        required=True,
+                        help="The name of the output file (example: Merged.sam), which is "
+                             "compressed if it ends in .gz.")
+    parser.add_argument("-r", "--readsfile",
+                        required=True,
+                        help="The name of the output file listing the unique read names "
+                             "in the order of the merged SAM (example: reads.txt).")
+    parser.add_argument("-N", "--secondary",
+                        required=False,
+                        type=int,
+                        default=20,
+                        help="The maximum number of secondary alignments per read, as given "
+                             "to minimap2 with -N [20].")
+    parser.add_argument("-p", "--pri_ratio",
+                        required=False,
+                        type=float,
+                        default=0.8,
+                        help="The minimum secondary-to-primary score ratio, as given to "
+                             "minimap2 with -p [0.8].")
+    parser.add_argument("-A", "--match_score",
+                        required=False,
+                        type=int,
+                        default=2,
+                        help="The matching score of minimap2 (-A), used for the mapping "
+                             "quality [2].")
+    parser.add_argument("-T", "--tempdir",
+                        required=False,
+                        default=None,
+                        help="Directory location for the temporary files written while "
+                             "sorting [default is the sort default].")
+    parser.add_argument("-t", "--threads",
+                        required=False,
+                        type=int,
+                        default=1,
+                        help="The number of threads to use for sorting or compression [1].")
+    parser.add_argument("--min_query_cover",
+                        required=False,
+                        type=float,
+                        default=0,
+                        help="Optional pre-filter: remove alignments covering less than this "
+                             "percent of their read, except the best alignment of the read [0].")
+    parser.add_argument("--top_percent",
+                        required=False,
+                        type=float,
+                        default=0,
+                        help="Optional pre-filter: remove alignments scoring more than this "
+                             "percent below the best alignment of their read, or 0 to keep "
+                             "them [0].")
+    parser.add_argument("--max_hits",
+                        required=False,
+                        type=int,
+                        default=0,
+                        help="Optional pre-filter: keep only this many of the best alignments "
+                             "of each read, or 0 to keep all [0].")
+
+    parser.add_argument("-l", "--logfile",
+                        required=True,
+                        help="The name of the log file to write.")
+
+    return parser.parse_args()
+
+def setup_logging(logfile):
+    # set up logging to file
+    logging.basicConfig(filename=logfile,
+                        format="%(levelname)s: %(asctime)s: %(message)s",
+                        datefmt='%d-%b-%y %H:%M:%S',
+                        level=logging.DEBUG)
+
+def get_qname(line):
+    return line[:line.find(b'\t')]
+
+def iter_groups(fhin, headers=None):
+    """
+    Read the alignments of a SAM stream in groups of consecutive lines
+    with the same read name.
+
+    :param fhin: binary file object of SAM
+    :param headers: list to collect the header lines in, or None to skip them
+    :return: iterator of (read name, list of lines)
+    """
+    for qname, lines in groupby(fhin, key=get_qname):
+        if qname.startswith(b'@'):
+            if headers is not None:
+                headers.extend(lines)
+            continue
+        yield qname, list(lines)
+
+def iter_read_names(fasta):
+    with open_input(fasta) as fh:
+        for line in fh:
+            if line.startswith(b'>'):
+                yield line[1:].split(None, 1)[0]
+
+class Alignment:
+    """
+    The fields of a SAM line needed to merge the alignments of a read
+    across shards, with the line kept to write it back unchanged.
+    """
+
+    def __init__(self, line):
+        self.line = line
+        self.fields = line.rstrip(b'\n').split(b'\t')
+        self.flag = int(self.fields[1])
+        self.score = int(self.get_tag(b'AS:i:', 0))
+
+    def get_tag(self, prefix, default=None):
+        for field in self.fields[11:]:
+            if field.startswith(prefix):
+                return field[len(prefix):]
+        return default
+
+    def set_tag(self, prefix, value):
+        for i in range(11, len(self.fields)):
+            if self.fields[i].startswith(prefix):
+                self.fields[i] = prefix + value
+                return
+
+    @property
+    def is_primary(self):
+        return not self.flag & (SECONDARY | SUPPLEMENTARY)
+
+    def identity(self):
+        """
+        Return the identity of the alignment as minimap2 computes it for
+        the mapping quality: matching bases over the alignment block length.
+
+        :return: identity, or 0 without block
+        """
+        blen = sum(int(n) for n, op in CIGAR_OPS.findall(self.fields[5]) if op in BLOCK_OPS)
+        if blen == 0:
+            return 0.0
+        return max(0, blen - int(self.get_tag(b'NM:i:', 0))) / blen
+
+    def make_secondary(self):
+        """
+        Turn the primary alignment into a secondary alignment in the way
+        minimap2 writes them: secondary flag, mapping quality 0, no
+        sequence and quality, and the tp:A:S tag.
+        """
+        self.flag |= SECONDARY
+        self.fields[1] = str(self.flag).encode()
+        self.fields[4] = b'0'
+        self.fields[9] = b'*'
+        self.fields[10] = b'*'
+        self.set_tag(b'tp:A:', b'S')
+        self.line = None
+
+    def to_line(self):
+        if self.line is None:
+            self.line = b'\t'.join(self.fields) + b'\n'
+        return self.line
+
+def lower_mapq(primary, competitor, match_score):
+    """
+    Lower the mapping quality of the primary alignment by the score
+    difference to the best alignment on another shard, with the bound
+    minimap2 applies to the mapping quality of an aligned read.
+
+    :param primary: primary Alignment
+    :param competitor: alignment score of the best alignment on another shard
+    :param match_score: matching score of minimap2 (-A)
+    :return: None
+    """
+    mapq = int(primary.fields[4])
+    identity = primary.identity()
+    alt = int(6.02 * identity * identity * (primary.score - competitor) / match_score + .499)
+    mapq = max(0, min(mapq, alt))
+    if mapq == 0 and primary.score > competitor:
+        mapq = 1
+    if mapq != int(primary.fields[4]):
+        primary.fields[4] = str(mapq).encode()
+        primary.line = None
+
+def merge_hits(groups, secondary, pri_ratio, match_score):
+    """
+    Merge the alignments of one read from several shards. The primary
+    alignment, with its supplementary alignments, is kept from the shard
+    with the best primary alignment score. The supplementary alignments
+    of the other shards are dropped, as their primary alignment is not
+    kept, and all other alignments are candidates for the secondary
+    alignments, of which those scoring at least pri_ratio of the
+    primary are kept, best first, up to the maximum number.
+
+    :param groups: list of lists of SAM lines, one per shard with alignments of the read
+    :param secondary: maximum number of secondary alignments
+    :param pri_ratio: minimum secondary-to-primary score ratio
+    :param match_score: matching score of minimap2
+    :return lines: merged SAM lines
+    :return removed: number of alignments removed
+    """
+    if len(groups) == 1:
+        return groups[0], 0
+    shards = [[Alignment(line) for line in lines] for lines in groups]
+    best, best_score = 0, None
+    for i, alns in enumerate(shards):
+        for aln in alns:
+            if aln.is_primary and (best_score is None or aln.score > best_score):
+                best, best_score = i, aln.score
+    kept = [aln for aln in shards[best] if not aln.flag & SECONDARY]
+    candidates = [aln for aln in shards[best] if aln.flag & SECONDARY]
+    competitor = None
+    for i, alns in enumerate(shards):
+        if i != best:
+            for aln in alns:
+                if aln.flag & SUPPLEMENTARY:
+                    continue
+                candidates.append(aln)
+                competitor = aln.score if competitor is None else max(competitor, aln.score)
+    primary = [aln for aln in kept if aln.is_primary]
+    if primary and competitor is not None:
+        lower_mapq(primary[0], competitor, match_score)
+    candidates = [aln for aln in sorted(candidates, key=lambda aln: -aln.score)
+                  if best_score is None or aln.score >= pri_ratio * best_score][:secondary]
+    for aln in candidates:
+        if not aln.flag & SECONDARY:
+            aln.make_secondary()
+    removed = sum(len(lines) for lines in groups) - len(kept) - len(candidates)
+    return [aln.to_line() for aln in kept + candidates], removed
+
+def start_sort(infile, tempdir, threads):
+    """
+    Start a sort of the alignments in a SAM file by read name, in the
+    same way as sam-merger-minimap.py, keeping the order of the lines of
+    each read.
+
+    :param infile: name of SAM file to sort
+    :param tempdir: directory for temporary sort files, or None
+    :param threads: number of threads for sort
+    :return: list of processes; sorted lines are read from stdout of the last
+    """
+    procs = []
+    if is_compressed(infile):
+        procs.append(subprocess.Popen(decompressor() + [infile], stdout=subprocess.PIPE))
+        procs.append(subprocess.Popen(["grep", "-v", "^@"], stdin=procs[-1].stdout,
+                                      stdout=subprocess.PIPE))
+    else:
+        procs.append(subprocess.Popen(["grep", "-v", "^@", infile], stdout=subprocess.PIPE))
+    cmd = ["sort", "-s", "-t", "\t", "-k1,1", "--parallel={}".format(threads)]
+    if tempdir is not None:
+        cmd.extend(["-T", tempdir])
+    procs.append(subprocess.Popen(cmd, stdin=procs[-1].stdout, stdout=subprocess.PIPE,
+                                  env=dict(os.environ, LC_ALL="C"), bufsize=BUFFER_SIZE))
+    for proc in procs[:-1]:
+        proc.stdout.close()
+    logging.info("start_sort: Sorting {} with {} threads.".format(infile, threads))
+    return procs
+
+def iter_in_order(streams, names, pending):
+    """
+    Collect the alignments of each read from the shard streams, which
+    are all in the order of the read names given. Reads without
+    alignments on a shard are simply missing from its stream. Each read
+    taken from a stream must be one of the reads still to come, so a
+    read out of order stops the merge as soon as its stream reaches
+    it, instead of once all streams have been read.
+
+    :param streams: list of iterators of (read name, lines), one per shard
+    :param names: iterator of read names in order
+    :param pending: set of hashes of the read names, emptied as the names go by
+    :return: iterator of (read name, list of lists of lines)
+    """
+    def advance(i):
+        head = next(streams[i], None)
+        if head is not None and hash(head[0]) not in pending:
+            raise OrderError("Alignments of {} are not in the order of the reads fasta.".format(
+                head[0].decode()))
+        return head
+
+    heads = [advance(i) for i in range(len(streams))]
+    for name in names:
+        pending.discard(hash(name))
+        groups = []
+        for i, head in enumerate(heads):
+            if head is not None and head[0] == name:
+                groups.append(head[1])
+                heads[i] = advance(i)
+        if groups:
+            yield name, groups
+    for head in heads:
+        if head is not None:
+            raise OrderError("Alignments of {} are not in the order of the reads fasta.".format(
+                head[0].decode()))
+
+def iter_sorted(streams):
+    """
+    Collect the alignments of each read from shard streams that are
+    sorted by read name.
+
+    :param streams: list of iterators of (read name, lines), one per shard
+    :return: iterator of (read name, list of lists of lines)
+    """
+    for name, heads in groupby(heapq.merge(*streams, key=lambda head: head[0]), key=lambda head: head[0]):
+        yield name, [lines for _, lines in heads]
+
+def write_merged(reads, headers, outfile, readsfile, args):
+    """
+    Write the merged alignments of each read, and the read names in
+    the order of the merged SAM. The merged alignments pass through the
+    pre-filter if any of its thresholds is set.
+
+    :param reads: iterator of (read name, list of lists of lines)
+    :param headers: header lines of the first shard, read while merging
+    :param outfile: name of output SAM
+    :param readsfile: name of output reads file
+    :param args: parsed command line arguments
+    :return alncount: count of merged alignments
+    :return readcount: count of unique read names
+    :return removed: count of alignments removed by the merge
+    """
+    alncount, readcount, removed = int(0), int(0), int(0)
+    with open_output(outfile, args.threads) as fhout, open(readsfile, 'wb') as fhreads:
+        fhfilter = AlignmentFilter(fhout, args.min_query_cover, args.top_percent, args.max_hits)
+        fhsam = fhfilter if fhfilter.active else fhout
+        written = False
+        for name, groups in reads:
+            if not written:
+                fhout.writelines(headers)
+                written = True
+            lines, r = merge_hits(groups, args.secondary, args.pri_ratio, args.match_score)
+            for line in lines:
+                fhsam.write(line)
+            fhreads.write(name + b'\n')
+            alncount, readcount, removed = alncount + len(lines), readcount + 1, removed + r
+            if readcount % 1000000 == 0:
+                logging.info("write_merged: Merged {:,} reads.".format(readcount))
+        if not written:
+            fhout.writelines(headers)
+        if fhfilter.active:
+            fhfilter.close()
+            log_filter(fhfilter.counts())
+    return alncount, readcount, removed
+
+def merge_in_order(args):
+    with ExitStack() as stack:
+        headers = []
+        streams = [iter_groups(stack.enter_context(open_input(infile)), headers if i == 0 else None)
+                   for i, infile in enumerate(args.infiles)]
+        pending = set(hash(name) for name in iter_read_names(args.fasta))
+        # the header lines are read with the first group of the first shard
+        reads = iter_in_order(streams, iter_read_names(args.fasta), pending)
+        return write_merged(reads, headers, args.outfile, args.readsfile, args)
+
+def merge_sorted(args):
+    headers = []
+    with open_input(args.infiles[0]) as fhin:
+        for line in fhin:
+            if not line.startswith(b'@'):
+                break
+            headers.append(line)
+    pipelines = [start_sort(infile, args.tempdir, max(1, args.threads // len(args.infiles)))
+                 for infile in args.infiles]
+    streams = [iter_groups(procs[-1].stdout) for procs in pipelines]
+    counts = write_merged(iter_sorted(streams), headers, args.outfile, args.readsfile, args)
+    for infile, procs in zip(args.infiles, pipelines):
+        procs[-1].stdout.close()
+        for proc in procs:
+            # grep exits with 1 when a file holds no alignments
+            if proc.wait() > (1 if proc.args[0] == "grep" else 0):
+                logging.error("merge_sorted: Sorting {} failed.".format(infile))
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return counts
+
+def main():
+    args = get_args()
+    setup_logging(args.logfile)
+    logging.info("Merging {} shard SAM files.".format(len(args.infiles)))
+    try:
+        alncount, readcount, removed = merge_in_order(args)
+    except OrderError as error:
+        logging.warning("{} Sorting the shard SAM files by read name instead.".format(error))
+        alncount, readcount, removed = merge_sorted(args)
+    logging.info("Removed {:,} alignments beyond the secondary alignments of a single index.".format(removed))
+    logging.info("Found {:,} total read alignments.".format(alncount))
+    logging.info("Found {:,} unique read names in SAM file.".format(readcount))
+
+if __name__ == '__main__':
+    main()
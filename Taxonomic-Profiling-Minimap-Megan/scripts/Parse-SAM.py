@@ -1,7 +1,21 @@
 import argparse
+import hashlib
+import heapq
 import logging
-import re
-from Bio import SeqIO
+import os
+import shutil
+import subprocess
+import tempfile
+from array import array
+from bisect import bisect_left
+from multiprocessing import Pool
+from compressed_io import is_compressed, open_input
+
+# number of bytes read from the SAM file at a time
+BLOCK_SIZE = 16 * 1024 * 1024
+# smallest number of new read name hashes held in a set before they are merged into the
+# sorted array, which then happens whenever the set reaches a quarter of the array
+MIN_RECENT_KEYS = 1 << 18
 
 def get_args():
     """
@@ -9,7 +23,14 @@ def get_args():
     """
     parser = argparse.ArgumentParser(
         prog='Parse-SAM.py',
-        description="""Get ordered unique read names in SAM file.""")
+        description="""Get ordered unique read names in SAM file. Read names are
+        tracked as 64-bit hashes in a sorted array in a single pass. With --grouped, for
+        SAM files grouped by read name (all alignments of a read are contiguous), as is
+        the case for the merged SAM files of the workflow, the file is instead scanned in
+        byte ranges by several processes, each comparing read names only to the previous
+        one. The read names found are then checked for duplicates with an external sort,
+        and the script fails if the SAM file turns out not to be grouped. Compressed SAM
+        files (.gz) are read through bgzip (or gzip) in a single pass.""")
 
     parser.add_argument("-s", "--sam",
                         required=True,
@@ -18,7 +39,20 @@ def get_args():
     parser.add_argument("-o", "--outfile",
                         required=True,
                         help="The name of the output reads file (example: output.fasta).")
-                        
+
+    parser.add_argument("-t", "--threads",
+                        required=False,
+                        type=int,
+                        default=1,
+                        help="The number of processes scanning byte ranges of a grouped SAM file [1].")
+
+    parser.add_argument("-g", "--grouped",
+                        required=False,
+                        action='store_true',
+                        help="Optional flag for SAM files that are grouped by read name, which are "
+                             "scanned in parallel with constant memory. The script fails if a read "
+                             "name is found in two separate groups of alignments.")
+
     parser.add_argument("-l", "--logfile",
                         required=True,
                         help="The name of the log file to write.")
@@ -32,35 +66,234 @@ def setup_logging(logfile):
                         datefmt='%d-%b-%y %H:%M:%S',
                         level=logging.DEBUG)
 
+def iter_qnames(sam, start=0, end=None):
+    """
+    Yield the read name of every alignment line starting in the byte
+    range [start, end) of the SAM file, which is read in blocks. The
+    range must begin at the start of a line. Compressed SAM files can
+    only be read as a whole.
+
+    :param sam: path to SAM file
+    :param start: first byte of range
+    :param end: end of range, or None for the end of the file
+    :return: generator of read names (bytes)
+    """
+    with open_input(sam) as fh:
+        if start:
+            fh.seek(start)
+        remaining = end - start if end is not None else float('inf')
+        tail = b''
+        while remaining > 0:
+            buf = fh.read(int(min(BLOCK_SIZE, remaining)))
+            if not buf:
+                break
+            remaining -= len(buf)
+            lines = (tail + buf).split(b'\n')
+            tail = lines.pop()
+            for line in lines:
+                tab = line.find(b'\t')
+                if tab > 0 and not line.startswith(b'@'):
+                    yield line[:tab]
+        tab = tail.find(b'\t')
+        if tab > 0 and not tail.startswith(b'@'):
+            yield tail[:tab]
+
+def get_ranges(sam, n):
+    """
+    Split the SAM file into n byte ranges of similar size, which each
+    begin at the start of a line.
+
+    :param sam: path to SAM file
+    :param n: number of ranges
+    :return: list of (start, end) tuples
+    """
+    size = os.path.getsize(sam)
+    bounds = [0]
+    with open(sam, 'rb') as fh:
+        for i in range(1, n):
+            fh.seek(max(size * i // n, bounds[-1]))
+            fh.readline()
+            bounds.append(min(fh.tell(), size))
+    bounds.append(size)
+    return [(s, e) for s, e in zip(bounds[:-1], bounds[1:]) if e > s]
+
+def scan_range(sam, start, end, outfile):
+    """
+    Write the read names in a byte range of a grouped SAM file to a
+    file, writing each name only when it differs from the previous one.
+
+    :param sam: path to SAM file
+    :param start: first byte of range
+    :param end: end of range, or None for the end of the file
+    :param outfile: name of file to write read names to
+    :return: first read name, last read name, count of read names, count of alignments
+    """
+    first, previous = None, None
+    lcnt, rcnt = int(0), int(0)
+    with open(outfile, 'wb') as fh_out:
+        for qname in iter_qnames(sam, start, end):
+            lcnt += 1
+            if qname != previous:
+                fh_out.write(qname + b'\n')
+                rcnt += 1
+                if first is None:
+                    first = qname
+                previous = qname
+    return first, previous, rcnt, lcnt
+
+def find_duplicate(outfile, start, tmpdir):
+    """
+    Sort the read names written to the reads file from a byte offset on
+    with an external sort, so memory stays constant, and return the
+    first read name that is written more than once.
+
+    :param outfile: reads file
+    :param start: byte offset of the first read name to check
+    :param tmpdir: directory for temporary sort files
+    :return: duplicated read name (bytes), or None
+    """
+    proc = subprocess.Popen(["sort", "-T", tmpdir], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            env=dict(os.environ, LC_ALL="C"))
+    with open(outfile, 'rb') as fh_in:
+        fh_in.seek(start)
+        shutil.copyfileobj(fh_in, proc.stdin, BLOCK_SIZE)
+    proc.stdin.close()
+    duplicate, previous = None, None
+    for line in proc.stdout:
+        if line == previous:
+            duplicate = line.rstrip(b'\n')
+            break
+        previous = line
+    proc.stdout.close()
+    # sort stopped by SIGPIPE once a duplicate is found is not a failure
+    if proc.wait() != 0 and duplicate is None:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return duplicate
+
+def parse_grouped_sam(sam, outfile, threads):
+    """
+    Obtain all unique read names (qnames) of a SAM file grouped by read
+    name, in the order of the SAM. The file is split into byte ranges
+    that are scanned in parallel, and the read names of each range are
+    concatenated in order. A read whose alignments span two ranges is
+    written only once. This list will be used to write the reads fasta
+    in the order of the SAM, and only including reads with alignments.
+    If a read name is written twice, the alignments were not grouped,
+    so the read names are removed from the reads file again and an
+    error is raised.
+
+    :param sam: path to SAM file
+    :param outfile: output file name
+    :param threads: number of processes
+    :return: None
+    """
+    if is_compressed(sam):
+        threads = 1
+    logging.info("parse_grouped_sam: Beginning SAM parsing with {} processes.".format(threads))
+    ranges = get_ranges(sam, threads) if threads > 1 else [(0, None)]
+    start = os.path.getsize(outfile) if os.path.isfile(outfile) else 0
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outfile)))
+    try:
+        jobs = [(sam, s, e, os.path.join(tmpdir, "range{}.txt".format(i))) for i, (s, e) in enumerate(ranges)]
+        with Pool(max(1, len(jobs))) as pool:
+            results = pool.starmap(scan_range, jobs)
+        lcnt, rcnt = int(0), int(0)
+        previous = None
+        with open(outfile, 'ab') as fh_out:
+            for job, (first, last, range_rcnt, range_lcnt) in zip(jobs, results):
+                lcnt += range_lcnt
+                if first is None:
+                    continue
+                with open(job[3], 'rb') as fh_in:
+                    if first == previous:
+                        fh_in.readline()
+                        range_rcnt -= 1
+                    shutil.copyfileobj(fh_in, fh_out, BLOCK_SIZE)
+                rcnt += range_rcnt
+                previous = last
+        duplicate = find_duplicate(outfile, start, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+    if duplicate is not None:
+        os.truncate(outfile, start)
+        logging.error("parse_grouped_sam: Read name {} is found in separate groups of alignments.".format(
+            duplicate.decode(errors='replace')))
+        raise ValueError("{} is not grouped by read name (read {} is found twice), run without "
+                         "--grouped.".format(sam, duplicate.decode(errors='replace')))
+    logging.info("parse_grouped_sam: Processed {:,} alignments.".format(lcnt))
+    logging.info("parse_grouped_sam: Found {:,} unique read names in SAM file.".format(rcnt))
+
+class ReadKeys:
+    """
+    Set of 64-bit read name hashes kept in a sorted array, at 8 bytes
+    per read. Hashes added since the last merge are held in a small set,
+    which is merged into the array once it reaches a quarter of it, so
+    the merges take linear time overall.
+    """
+
+    def __init__(self):
+        self.keys = array('Q')
+        self.recent = set()
+
+    def __len__(self):
+        return len(self.keys) + len(self.recent)
+
+    def add(self, key):
+        """
+        Add a hash unless it is present.
+
+        :param key: 64-bit hash
+        :return: True if the hash was added
+        """
+        if key in self.recent:
+            return False
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return False
+        self.recent.add(key)
+        if len(self.recent) >= max(MIN_RECENT_KEYS, len(self.keys) // 4):
+            self.keys = array('Q', heapq.merge(self.keys, sorted(self.recent)))
+            self.recent = set()
+        return True
+
 def parse_sam(sam, outfile):
     """
-    Simply read the sorted SAM file line by line to obtain
-    all unique read names (qnames). This list will be used to
-    write the reads fasta in the order of the SAM, and only
-    including reads with alignments.
+    Simply read the SAM file line by line to obtain all unique read
+    names (qnames), for SAM files that are not grouped by read name.
+    Only a 64-bit hash of each read name is kept in memory, computed
+    once for each run of alignments with the same read name. Two read
+    names with the same hash are taken for one read, so the second is
+    silently left out of the reads file; with 64-bit hashes, this is
+    expected in about one of 370,000 files of ten million reads.
 
-    :param s: path to SAM file
+    :param sam: path to SAM file
     :param outfile: output file name
-    :return: list of read names
+    :return: None
     """
     logging.info("parse_sam: Beginning SAM parsing.")
     lcnt = int(0)
-    unique_reads = set()
-    with open(sam, 'r') as fh_in, open(outfile, 'a') as fh_out:
-        for line in fh_in:
-            if not line.startswith('@'):
-                lcnt += 1
-                if lcnt % 50000 == 0:
-                    logging.info("parse_sam: processed {:,} alignments...".format(lcnt))
-                if line.split('\t')[0] not in unique_reads:
-                    unique_reads.add(line.split('\t')[0])
-                    fh_out.write("{}\n".format(line.split('\t')[0]))
+    unique_reads = ReadKeys()
+    previous = None
+    with open(outfile, 'ab') as fh_out:
+        for qname in iter_qnames(sam):
+            lcnt += 1
+            if lcnt % 50000 == 0:
+                logging.info("parse_sam: processed {:,} alignments...".format(lcnt))
+            if qname == previous:
+                continue
+            previous = qname
+            key = int.from_bytes(hashlib.blake2b(qname, digest_size=8).digest(), 'little')
+            if unique_reads.add(key):
+                fh_out.write(qname + b'\n')
     logging.info("parse_sam: Found {:,} unique read names in SAM file.".format(len(unique_reads)))
 
 def main():
     args = get_args()
     setup_logging(args.logfile)
-    parse_sam(args.sam, args.outfile)
+    if args.grouped:
+        parse_grouped_sam(args.sam, args.outfile, args.threads)
+    else:
+        parse_sam(args.sam, args.outfile)
 
 if __name__ == '__main__':
     main()
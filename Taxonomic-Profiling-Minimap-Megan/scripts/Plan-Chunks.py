@@ -0,0 +1,310 @@
+import argparse
+import csv
+import math
+import os
+from read_stats import load_stat
+
+# MB per second assumed for loading the database index into memory, a sequential read
+# rate that a local disk or a network file system sustains; the load time is estimated
+# from it, as the benchmark files only give the time of a whole aligner job
+INDEX_LOAD_RATE = 500
+# largest share of the aligning time of a chunk that may be spent loading the index
+MAX_LOAD_SHARE = 0.05
+# memory of an aligner process relative to the size of the database index
+INDEX_MEMORY_FACTOR = 1.2
+# smallest chunk (in bases) when no past benchmarks are available to estimate throughput;
+# a tenth of the chunks of the fixed plan recommended for a 2.5 million read HiFi fasta
+# (2 chunks of about 12 Gb), so a first run still gives every aligner job a chunk without
+# loading the index for tiny chunks, and writes the benchmarks that later plans use
+MIN_CHUNK_BASES = 1000000000
+# chunks per concurrent aligner job (or worker): with two, chunks that take longer than
+# others are balanced by the jobs that finish first, at the cost of one more index load per
+# job, and the last jobs end within about half a chunk of each other
+CHUNKS_PER_SLOT = 2
+
+def get_args():
+    """
+    Get arguments from command line with argparse.
+    """
+    parser = argparse.ArgumentParser(
+        prog='Plan-Chunks.py',
+        description="""Choose the number of chunks to split a fasta file into before
+        alignment. Each chunk is aligned in its own job, which loads the database index.
+        Chunks must be large enough that loading the index takes a small share of the
+        aligning time, which is estimated from past benchmark files of the aligner rule
+        (less the estimated index loads), and numerous enough that all aligner jobs
+        fitting in the available cores and memory are kept busy. With persistent
+        aligner workers, which load the index once each, chunks only need to be numerous
+        enough for the workers to balance each other. The plan is written as tab-delimited
+        key and value lines.""")
+
+    parser.add_argument("-f", "--fasta",
+                        required=True,
+                        help="The fasta file to plan chunks for.")
+    parser.add_argument("-o", "--outfile",
+                        required=True,
+                        help="The name of the output plan file (example: SAMPLE.chunk-plan.txt).")
+    parser.add_argument("-n", "--chunks",
+                        required=False,
+                        default="auto",
+                        help="A fixed number of chunks, which skips planning, or auto [auto].")
+    parser.add_argument("-d", "--db",
+                        required=False,
+                        default=None,
+                        help="The database index loaded by the aligner for each chunk.")
+    parser.add_argument("-t", "--threads",
+                        required=False,
+                        type=int,
+                        default=1,
+                        help="The number of threads of each aligner process [1].")
+    parser.add_argument("-w", "--workers",
+                        required=False,
+                        type=int,
+                        default=0,
+                        help="The number of persistent aligner workers sharing the chunks of a "
+                             "sample, or 0 if the aligner is run once per chunk [0].")
+    parser.add_argument("-c", "--cores",
+                        required=False,
+                        type=int,
+                        default=1,
+                        help="The number of cores available to the workflow [1].")
+    parser.add_argument("-m", "--mem_mb",
+                        required=False,
+                        type=int,
+                        default=0,
+                        help="The memory available to the workflow in MB, or 0 if not "
+                             "limited [0].")
+    parser.add_argument("-x", "--max_chunk_bases",
+                        required=False,
+                        type=float,
+                        default=0,
+                        help="The largest number of bases in a chunk, or 0 if not limited [0].")
+    parser.add_argument("--chunks_per_slot",
+                        required=False,
+                        type=int,
+                        default=CHUNKS_PER_SLOT,
+                        help="The number of chunks per concurrent aligner job (or worker), so "
+                             "that slow chunks are balanced by the others [{}].".format(CHUNKS_PER_SLOT))
+    parser.add_argument("--min_chunk_bases",
+                        required=False,
+                        type=float,
+                        default=MIN_CHUNK_BASES,
+                        help="The smallest chunk in bases when no benchmarks of past runs are "
+                             "available to estimate the throughput [{}].".format(MIN_CHUNK_BASES))
+    parser.add_argument("--load_rate",
+                        required=False,
+                        type=float,
+                        default=INDEX_LOAD_RATE,
+                        help="The rate in MB per second at which the database index is loaded, "
+                             "which gives the index load time [{}].".format(INDEX_LOAD_RATE))
+    parser.add_argument("-b", "--benchmarks",
+                        required=False,
+                        default=None,
+                        help="The directory with benchmark files of past aligner runs.")
+    parser.add_argument("-r", "--rule",
+                        required=False,
+                        default=None,
+                        help="The name of the aligner rule, as used in benchmark file names "
+                             "(SAMPLE.CHUNK.RULE.tsv for a job per chunk, SAMPLE.RULE.tsv for "
+                             "workers).")
+    parser.add_argument("-s", "--statsdir",
+                        required=False,
+                        default=None,
+                        help="The directory with read statistics files (SAMPLE.read-stats.txt) "
+                             "and chunk plans (SAMPLE.chunk-plan.txt) of past runs, which give "
+                             "the bases and chunks aligned in each benchmark.")
+
+    return parser.parse_args()
+
+def get_sample_bases(fasta, statsdir):
+    """
+    Return the number of bases in the fasta file. The read statistics
+    of an earlier run of the same sample are used if they are newer
+    than the fasta, otherwise the file size is used, which overestimates
+    the bases only by the header and line break bytes.
+
+    :param fasta: path to fasta file
+    :param statsdir: directory with read statistics files, or None
+    :return bases: number of bases
+    :return source: description of where the number was taken from
+    """
+    if statsdir is not None:
+        sample = os.path.basename(fasta).rsplit('.', 1)[0]
+        statsfile = os.path.join(statsdir, "{}.read-stats.txt".format(sample))
+        if os.path.isfile(statsfile) and os.path.getmtime(statsfile) >= os.path.getmtime(fasta):
+            bases = load_stat(statsfile, "bases")
+            if bases:
+                return bases, "read statistics"
+    return os.path.getsize(fasta), "fasta size"
+
+def read_plan(statsdir, sample):
+    """
+    Read the chunk plan of an earlier run of a sample.
+
+    :param statsdir: directory with chunk plans
+    :param sample: sample name
+    :return: dictionary of key: value (str), empty if there is no plan
+    """
+    plan = {}
+    planfile = os.path.join(statsdir, "{}.chunk-plan.txt".format(sample))
+    if os.path.isfile(planfile):
+        with open(planfile, 'r') as fh:
+            for line in fh:
+                if not line.startswith('#') and '\t' in line:
+                    key, value = line.rstrip('\n').split('\t', 1)
+                    plan[key] = value
+    return plan
+
+def mean_seconds(benchfile):
+    with open(benchfile, 'r') as fh:
+        seconds = [float(row['s']) for row in csv.DictReader(fh, delimiter='\t') if row.get('s')]
+    return sum(seconds) / len(seconds) if seconds else None
+
+def get_throughput(benchdir, rule, statsdir, load_seconds):
+    """
+    Estimate the aligner throughput in bases per second, without the
+    index loads, from the benchmark files of past runs (written by
+    snakemake) that have read statistics for the same sample. A sample
+    aligned in a job per chunk has a benchmark file per chunk
+    (SAMPLE.CHUNK.RULE.tsv), and the times of the chunks of its last
+    plan are summed, less one index load per chunk. A sample aligned
+    by persistent workers has one benchmark file (SAMPLE.RULE.tsv),
+    less one index load, as the workers load it at the same time.
+    Subtracting the loads keeps the estimate independent of the number
+    of chunks it was measured with.
+
+    :param benchdir: directory with benchmark files, or None
+    :param rule: name of the aligner rule
+    :param statsdir: directory with read statistics files and chunk plans, or None
+    :param load_seconds: estimated seconds to load the index
+    :return: bases per second, or None without usable benchmarks
+    """
+    if benchdir is None or rule is None or statsdir is None or not os.path.isdir(benchdir):
+        return None
+    suffix = ".{}.tsv".format(rule)
+    chunk_seconds, job_seconds = {}, {}
+    for name in sorted(os.listdir(benchdir)):
+        if not name.endswith(suffix):
+            continue
+        seconds = mean_seconds(os.path.join(benchdir, name))
+        if seconds is None:
+            continue
+        stem = name[:-len(suffix)]
+        sample, _, piece = stem.rpartition('.')
+        if sample and piece.isdigit():
+            chunk_seconds.setdefault(sample, {})[int(piece)] = seconds
+        else:
+            job_seconds[stem] = seconds
+    total_bases, total_seconds = 0, 0.0
+    for sample in sorted(set(chunk_seconds) | set(job_seconds)):
+        statsfile = os.path.join(statsdir, "{}.read-stats.txt".format(sample))
+        if not os.path.isfile(statsfile):
+            continue
+        plan = read_plan(statsdir, sample)
+        if int(plan.get("workers", 0)) > 0 and sample in job_seconds:
+            seconds, loads = job_seconds[sample], 1
+        elif sample in chunk_seconds and plan.get("chunks", "").isdigit():
+            chunks = int(plan["chunks"])
+            pieces = [chunk_seconds[sample].get(piece) for piece in range(chunks)]
+            if None in pieces:
+                continue
+            seconds, loads = sum(pieces), chunks
+        else:
+            continue
+        bases = load_stat(statsfile, "bases")
+        aligning = seconds - loads * load_seconds
+        if bases and aligning > 0:
+            total_bases += bases
+            total_seconds += aligning
+    if total_seconds <= 0:
+        return None
+    return total_bases / total_seconds
+
+def get_slots(cores, threads, mem_mb, index_bytes):
+    """
+    Return the number of aligner processes that fit in the available
+    cores, and in the available memory if it is given, with each
+    process holding the database index in memory.
+
+    :param cores: number of cores available
+    :param threads: number of threads of each aligner process
+    :param mem_mb: memory available in MB, or 0 if not limited
+    :param index_bytes: size of the database index in bytes
+    :return: number of aligner processes
+    """
+    slots = max(1, cores // max(1, threads))
+    if mem_mb > 0 and index_bytes > 0:
+        slots = min(slots, max(1, int(mem_mb * 1024 * 1024 // (index_bytes * INDEX_MEMORY_FACTOR))))
+    return slots
+
+def plan_chunks(bases, slots, load_seconds, throughput, max_chunk_bases, workers=0,
+                chunks_per_slot=CHUNKS_PER_SLOT, min_chunk_bases=MIN_CHUNK_BASES):
+    """
+    Choose the number of chunks. Each chunk is aligned in its own job,
+    so chunks are large enough that loading the index takes at most
+    MAX_LOAD_SHARE of the time to align them (or hold min_chunk_bases
+    without a throughput estimate). Within that limit, there are
+    chunks_per_slot chunks per concurrent aligner job. Persistent
+    workers load the index once, whatever the number of chunks, so
+    there are chunks_per_slot chunks per worker. Chunks are never
+    larger than max_chunk_bases if given.
+
+    :param bases: number of bases to align
+    :param slots: number of concurrent aligner jobs, or workers
+    :param load_seconds: estimated seconds to load the index
+    :param throughput: aligned bases per second, or None
+    :param max_chunk_bases: largest chunk in bases, or 0
+    :param workers: number of persistent aligner workers, or 0
+    :param chunks_per_slot: chunks per concurrent aligner job or worker
+    :param min_chunk_bases: smallest chunk in bases without a throughput estimate
+    :return chunks: number of chunks
+    :return min_chunk_bases: smallest efficient chunk in bases
+    """
+    if workers > 0:
+        min_chunk_bases = 1
+    elif throughput is not None:
+        min_chunk_bases = max(1, int(load_seconds * throughput / MAX_LOAD_SHARE))
+    else:
+        min_chunk_bases = max(1, int(min_chunk_bases))
+    useful = max(1, bases // min_chunk_bases)
+    wanted = slots * chunks_per_slot if slots > 1 else 1
+    chunks = min(wanted, useful)
+    if max_chunk_bases > 0:
+        chunks = max(chunks, math.ceil(bases / max_chunk_bases))
+    return max(1, chunks), min_chunk_bases
+
+def write_plan(outfile, fasta, plan):
+    with open(outfile, 'w') as fh:
+        fh.write("# chunk plan of {}\n".format(os.path.basename(fasta)))
+        for key, value in plan:
+            fh.write("{}\t{}\n".format(key, value))
+
+def main():
+    args = get_args()
+    bases, source = get_sample_bases(args.fasta, args.statsdir)
+    if args.chunks != "auto":
+        write_plan(args.outfile, args.fasta, [("chunks", int(args.chunks)), ("bases", bases),
+                                              ("bases_source", source), ("planned", "no, fixed in config")])
+        return
+    index_bytes = os.path.getsize(args.db) if args.db is not None and os.path.isfile(args.db) else 0
+    if args.workers > 0:
+        slots = args.workers
+    else:
+        slots = get_slots(args.cores, args.threads, args.mem_mb, index_bytes)
+    load_seconds = index_bytes / (args.load_rate * 1024 * 1024)
+    throughput = get_throughput(args.benchmarks, args.rule, args.statsdir, load_seconds)
+    chunks, min_chunk_bases = plan_chunks(bases, slots, load_seconds, throughput, args.max_chunk_bases,
+                                          args.workers, args.chunks_per_slot, args.min_chunk_bases)
+    loads = 1 if args.workers > 0 else chunks
+    plan = [("chunks", chunks), ("bases", bases), ("bases_source", source),
+            ("chunk_bases", bases // chunks), ("min_chunk_bases", min_chunk_bases),
+            ("slots", slots), ("chunks_per_slot", args.chunks_per_slot), ("workers", args.workers),
+            ("index_bytes", index_bytes), ("load_seconds", round(load_seconds)),
+            ("throughput", round(throughput) if throughput is not None else "NA"),
+            ("planned", "yes")]
+    if throughput is not None:
+        plan.append(("estimated_seconds", round(bases / throughput + loads * load_seconds)))
+    write_plan(args.outfile, args.fasta, plan)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,11 @@
 import argparse
 import logging
-from Bio import SeqIO
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# size of the blocks of records read from the fasta and written to the output
+BLOCK_SIZE = 64 * 1024 * 1024
 
 def get_args():
     """
@@ -8,7 +13,13 @@ def get_args():
     """
     parser = argparse.ArgumentParser(
         prog='Sort-Fasta-Records-by-SAM-BioPython.py',
-        description="""Sort all entries in a fasta file by order of a read names text file.""")
+        description="""Sort all entries in a fasta file by order of a read names text file.
+        If the read names are in the same order as the fasta file, the fasta is filtered
+        in a single streaming pass. Otherwise the byte offsets of the fasta records are
+        indexed and the records are copied in the order of the read names. Records are
+        copied unchanged, with the line breaks of the input fasta, unless --wrap is given,
+        in which case they are written as by Biopython (SeqRecord.format("fasta") wraps
+        the sequence at 60 bases per line).""")
 
     parser.add_argument("-f", "--fasta",
                         required=True,
@@ -21,7 +32,27 @@ def get_args():
     parser.add_argument("-o", "--outfile",
                         required=True,
                         help="The name of the output FASTA file (example: output.fasta).")
-                        
+
+    parser.add_argument("-x", "--index",
+                        required=False,
+                        default=None,
+                        help="The offset index of the FASTA file, which is created if it does "
+                             "not exist or is out of date, and reused otherwise [FASTA.offsets].")
+
+    parser.add_argument("-t", "--threads",
+                        required=False,
+                        type=int,
+                        default=1,
+                        help="The number of threads used to read blocks of records [1].")
+
+    parser.add_argument("-w", "--wrap",
+                        required=False,
+                        type=int,
+                        default=0,
+                        help="Write the sequence of each record in lines of this many bases, "
+                             "with the header line stripped of trailing whitespace, as written "
+                             "by Biopython with 60; 0 copies the records unchanged [0].")
+
     parser.add_argument("-l", "--logfile",
                         required=True,
                         help="The name of the log file to write.")
@@ -35,49 +66,216 @@ def setup_logging(logfile):
                         datefmt='%d-%b-%y %H:%M:%S',
                         level=logging.DEBUG)
 
-def index_fasta(f):
+def wrap_record(record, wrap):
     """
-    Use SeqIO to index the fasta file (f). Returns a
-    dictionary-like structure, with seq names as keys and
-    seqs as values.
+    Rewrite a fasta record with its sequence in lines of a fixed width,
+    as SeqRecord.format("fasta") does: the header line is stripped of
+    trailing whitespace, and whitespace is removed from the sequence.
 
-    :param f: path to fasta file
-    :return records: dictionary-like structure of fasta records
+    :param record: fasta record (bytes), from its header line to its last sequence line
+    :param wrap: number of bases per sequence line
+    :return: rewritten record (bytes)
     """
-    logging.info("index_fasta: Beginning to index fasta file.")
-    records = SeqIO.index(f, "fasta")
-    logging.info("index_fasta: Found {:,} records.".format(len(records)))
-    logging.info("index_fasta: Completed indexing.\n")
+    lines = record.split(b'\n')
+    seq = b''.join(line.strip() for line in lines[1:]).replace(b' ', b'')
+    wrapped = [lines[0].rstrip()]
+    wrapped.extend(seq[i:i + wrap] for i in range(0, len(seq), wrap))
+    return b'\n'.join(wrapped) + b'\n'
 
-    return records
+def wrap_records(data, wrap):
+    # the records of a block are split at their header lines, which removes the line break before each
+    if not data:
+        return data
+    return b''.join(wrap_record(record if i == 0 else b'>' + record, wrap)
+                    for i, record in enumerate(data.split(b'\n>')))
 
-def write_records(records, infile, outfile):
+def stream_records(f, infile, outfile, wrap=0):
     """
-    Write output fasta.
-    :param records: dictionary-like structure from index_fasta
+    Write the fasta records named in the read names file by streaming
+    through the fasta file once. Records are copied as they appear in
+    the fasta, so this only works if the read names are in fasta order,
+    as is the case for a SAM merged from minimap2 outputs of consecutive
+    fasta chunks.
+
+    :param f: path to fasta file
     :param infile: read names text file
     :param outfile: name of output file to write
-    :return: None
+    :param wrap: number of bases per sequence line, or 0 to copy records unchanged
+    :return: True if all read names were written, False if they are not in fasta order
     """
-    logging.info("write_records: Writing new sorted fasta file.")
+    logging.info("stream_records: Filtering fasta file by read names.")
     rec_count = int(0)
-    with open(infile, 'r') as fh_in, open(outfile, 'a') as fh_out:
+    writing = False
+    record = []
+    with open(infile, 'rb') as fh_names, open(f, 'rb') as fh_in, \
+            open(outfile, 'wb', buffering=BLOCK_SIZE) as fh_out:
+        names = (line.strip() for line in fh_names)
+        nextname = next(names, None)
         for line in fh_in:
-            rec_count += 1
-            if line.strip() in records:
-                fh_out.write(records[line.strip()].format("fasta"))
+            if line.startswith(b'>'):
+                if record:
+                    fh_out.write(wrap_record(b''.join(record), wrap))
+                    record = []
+                if nextname is None:
+                    break
+                writing = line[1:].split(None, 1)[0] == nextname
+                if writing:
+                    nextname = next(names, None)
+                    rec_count += 1
+                    if rec_count % 10000 == 0:
+                        logging.info("stream_records: Wrote {:,} records.".format(rec_count))
+            if writing and wrap:
+                record.append(line)
+            elif writing:
+                fh_out.write(line)
+        if record:
+            fh_out.write(wrap_record(b''.join(record), wrap))
+    if nextname is not None:
+        logging.warning("stream_records: Read name {} not found in fasta order, after writing "
+                        "{:,} records.".format(nextname.decode(), rec_count))
+        return False
+    logging.info("stream_records: Completed writing {:,} records.".format(rec_count))
+    return True
+
+def fasta_stamp(f):
+    """
+    Return the size and modification time of the fasta file, which are
+    stored in the offset index to recognize an out of date index.
+
+    :param f: path to fasta file
+    :return: stamp string
+    """
+    stat = os.stat(f)
+    return "#{}\t{}\n".format(stat.st_size, stat.st_mtime_ns)
+
+def build_index(f, index):
+    """
+    Record the name, byte offset and byte length of every record in the
+    fasta file. The index is a tab-delimited text file in the style of
+    a samtools faidx index, preceded by the size and modification time
+    of the fasta. If it cannot be written, it is only kept in memory.
+
+    :param f: path to fasta file
+    :param index: path to offset index file
+    :return offsets: dictionary of record name: (offset, length)
+    """
+    logging.info("build_index: Beginning to index fasta file.")
+    offsets = {}
+    name, start, pos = None, 0, 0
+    with open(f, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b'>'):
+                if name is not None:
+                    offsets[name] = (start, pos - start)
+                name, start = line[1:].split(None, 1)[0].decode(), pos
+            pos += len(line)
+    if name is not None:
+        offsets[name] = (start, pos - start)
+    try:
+        with open(index, 'w') as fh:
+            fh.write(fasta_stamp(f))
+            for name, (offset, length) in offsets.items():
+                fh.write("{}\t{}\t{}\n".format(name, offset, length))
+        logging.info("build_index: Wrote offset index {}.".format(index))
+    except OSError as e:
+        logging.warning("build_index: Could not write offset index {}: {}".format(index, e))
+    logging.info("build_index: Found {:,} records.".format(len(offsets)))
+    return offsets
+
+def load_index(f, index):
+    """
+    Load the offset index of the fasta file, building it first if it
+    does not exist or does not match the current fasta file.
+
+    :param f: path to fasta file
+    :param index: path to offset index file
+    :return offsets: dictionary of record name: (offset, length)
+    """
+    if os.path.isfile(index):
+        with open(index, 'r') as fh:
+            if fh.readline() == fasta_stamp(f):
+                logging.info("load_index: Loading offset index {}.".format(index))
+                offsets = {}
+                for line in fh:
+                    name, offset, length = line.rstrip('\n').split('\t')
+                    offsets[name] = (int(offset), int(length))
+                logging.info("load_index: Found {:,} records.".format(len(offsets)))
+                return offsets
+        logging.info("load_index: Offset index {} is out of date.".format(index))
+    return build_index(f, index)
+
+def get_blocks(offsets, infile):
+    """
+    Translate the read names into byte ranges of the fasta file, and
+    group them into blocks of about BLOCK_SIZE bytes. Records that are
+    adjacent in the fasta are merged into a single range.
+
+    :param offsets: dictionary of record name: (offset, length)
+    :param infile: read names text file
+    :return: generator of lists of (offset, length) ranges
+    """
+    block, block_size = [], 0
+    with open(infile, 'r') as fh_in:
+        for line in fh_in:
+            name = line.strip()
+            if name not in offsets:
+                logging.warning("get_blocks: Read name from SAM not found in fasta: {}.".format(name))
+                continue
+            offset, length = offsets[name]
+            if block and block[-1][0] + block[-1][1] == offset:
+                block[-1] = (block[-1][0], block[-1][1] + length)
             else:
-                logging.warning("write_records: Read name from SAM not found in fasta: {}.".format(line.strip()))
-            if rec_count % 10000 == 0:
-                logging.info("write_records: Wrote {:,} records.".format(rec_count))
-            
-    logging.info("write_records: Completed writing.")
+                block.append((offset, length))
+            block_size += length
+            if block_size >= BLOCK_SIZE:
+                yield block
+                block, block_size = [], 0
+    if block:
+        yield block
+
+def read_block(fd, block, wrap=0):
+    data = b''.join(os.pread(fd, length, offset) for offset, length in block)
+    return wrap_records(data, wrap) if wrap else data
+
+def write_records(f, offsets, infile, outfile, threads, wrap=0):
+    """
+    Write output fasta by copying the byte ranges of the records in the
+    order of the read names. Blocks of records are read (and rewrapped)
+    by a pool of threads and written in order, with at most two blocks
+    per thread held in memory.
+
+    :param f: path to fasta file
+    :param offsets: dictionary of record name: (offset, length)
+    :param infile: read names text file
+    :param outfile: name of output file to write
+    :param threads: number of threads reading blocks
+    :param wrap: number of bases per sequence line, or 0 to copy records unchanged
+    :return: None
+    """
+    logging.info("write_records: Writing new sorted fasta file.")
+    fd = os.open(f, os.O_RDONLY)
+    byte_count = int(0)
+    try:
+        with open(outfile, 'wb') as fh_out, ThreadPoolExecutor(max_workers=threads) as pool:
+            pending = deque()
+            for block in get_blocks(offsets, infile):
+                pending.append(pool.submit(read_block, fd, block, wrap))
+                if len(pending) >= 2 * threads:
+                    byte_count += fh_out.write(pending.popleft().result())
+            while pending:
+                byte_count += fh_out.write(pending.popleft().result())
+    finally:
+        os.close(fd)
+    logging.info("write_records: Completed writing {:,} bytes.".format(byte_count))
 
 def main():
     args = get_args()
     setup_logging(args.logfile)
-    records = index_fasta(args.fasta)
-    write_records(records, args.reads, args.outfile)
+    if not stream_records(args.fasta, args.reads, args.outfile, args.wrap):
+        logging.info("Read names are not in fasta order, sorting by index instead.")
+        index = args.index if args.index is not None else "{}.offsets".format(args.fasta)
+        offsets = load_index(args.fasta, index)
+        write_records(args.fasta, offsets, args.reads, args.outfile, args.threads, args.wrap)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,164 @@
+import logging
+import os
+import queue
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from compressed_io import BUFFER_SIZE, check_process, format_command, open_output
+
+# the input file argument of the aligner command in worker mode, so chunks are read from stdin
+STDIN = "-"
+
+def chunk_read_names(chunk):
+    """
+    Return the hashes of the read names in a fasta chunk. The read
+    name is the first word of the header line, as used by the aligner.
+
+    :param chunk: path to fasta chunk
+    :return: set of read name hashes
+    """
+    names = set()
+    with open(chunk, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b'>'):
+                names.add(hash(line[1:].split(None, 1)[0]))
+    return names
+
+def spool_name(spooldir, index, suffix):
+    return os.path.join(spooldir, "chunk_{:07d}.sam{}".format(index, suffix))
+
+def feed_chunks(worker, chunks, proc, inflight):
+    """
+    Write fasta chunks to the standard input of an aligner process.
+    The next chunk is taken from the shared queue only once the aligner
+    has read all but the pipe buffer of the previous one, so chunks go
+    to whichever worker is free first instead of a fixed assignment.
+    The read names of each chunk are passed to the output reader before
+    the chunk is written, and None is passed when no chunks are left.
+
+    :param worker: number of the worker, for logging
+    :param chunks: queue of (index, path) of the chunks to align
+    :param proc: aligner process reading from stdin
+    :param inflight: queue of (index, read name hashes) read by spool_output
+    :return: number of chunks written
+    """
+    taken = int(0)
+    try:
+        while True:
+            try:
+                index, chunk = chunks.get_nowait()
+            except queue.Empty:
+                break
+            inflight.put((index, chunk_read_names(chunk)))
+            taken += 1
+            logging.info("feed_chunks: Worker {} is aligning chunk {}.".format(worker, chunk))
+            with open(chunk, 'rb') as fhin:
+                shutil.copyfileobj(fhin, proc.stdin, BUFFER_SIZE)
+    except BrokenPipeError:
+        logging.error("feed_chunks: Worker {} stopped reading chunks.".format(worker))
+    finally:
+        inflight.put(None)
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    return taken
+
+def spool_output(worker, proc, inflight, spooldir, suffix):
+    """
+    Split the SAM output of an aligner process into one spool file per
+    chunk. The aligner writes its output in the order of its input, so
+    the alignments of a chunk end where a read of the next chunk fed to
+    this worker appears. Only the first line of each read is checked,
+    as in concat_grouped_sams. Header lines are dropped, and a spool
+    file is written for every chunk, even without alignments.
+
+    :param worker: number of the worker, for logging
+    :param proc: aligner process writing SAM to stdout
+    :param inflight: queue of (index, read name hashes) from feed_chunks
+    :param spooldir: directory for the spool files
+    :param suffix: extension of the spool files (.gz to compress them)
+    :return: list of (index, spool file name)
+    """
+    spools = []
+    names, prefix, plen = None, None, 0
+    with ExitStack() as stack:
+        for line in proc.stdout:
+            if line.startswith(b'@'):
+                continue
+            if prefix is None or line[:plen] != prefix:
+                qname = line[:line.find(b'\t')]
+                while names is None or hash(qname) not in names:
+                    stack.close()
+                    current = inflight.get()
+                    if current is None:
+                        raise ValueError("Worker {} wrote alignments of {}, which is in none of "
+                                         "its chunks.".format(worker, qname.decode()))
+                    index, names = current
+                    spools.append((index, spool_name(spooldir, index, suffix)))
+                    fhout = stack.enter_context(open_output(spools[-1][1]))
+                prefix = qname + b'\t'
+                plen = len(prefix)
+            fhout.write(line)
+    for index, names in iter(inflight.get, None):
+        spools.append((index, spool_name(spooldir, index, suffix)))
+        with open_output(spools[-1][1]):
+            pass
+    return spools
+
+def align_chunks(chunklist, command, workers, spooldir, suffix=""):
+    """
+    Align fasta chunks with persistent aligner workers. Each worker is
+    a single aligner process that loads the database index once and
+    reads the chunks it is given from stdin, instead of a process (and
+    an index load) per chunk. The chunks are taken from a shared queue
+    in order, so a worker slowed by a difficult chunk simply takes
+    fewer of them. The output of each worker is split back into one
+    SAM spool file per chunk, so the spools can be merged in chunk
+    order as if each chunk had been aligned separately. The index must
+    have a single part: minimap2 reads the query again for each part,
+    which stdin does not allow, so the alignments to the other parts
+    would be lost.
+
+    :param chunklist: list of fasta chunk names, in order
+    :param command: aligner command template, with {} for the input file
+    :param workers: number of aligner processes
+    :param spooldir: directory for the spool files
+    :param suffix: extension of the spool files (.gz to compress them)
+    :return: list of spool file names, in the order of chunklist
+    """
+    chunks = queue.Queue()
+    for index, chunk in enumerate(chunklist):
+        chunks.put((index, chunk))
+    workers = max(1, min(workers, len(chunklist)))
+    cmd = format_command(command, STDIN)
+    logging.info("align_chunks: Aligning {} chunks with {} workers running {}".format(
+        len(chunklist), workers, " ".join(cmd)))
+    procs = [subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=BUFFER_SIZE)
+             for _ in range(workers)]
+    spools = []
+    inflights = [queue.Queue() for _ in procs]
+    pool = ThreadPoolExecutor(2 * workers)
+    try:
+        feeders = [pool.submit(feed_chunks, w, chunks, proc, inflight)
+                   for w, (proc, inflight) in enumerate(zip(procs, inflights))]
+        readers = [pool.submit(spool_output, w, proc, inflight, spooldir, suffix)
+                   for w, (proc, inflight) in enumerate(zip(procs, inflights))]
+        for w, (feeder, reader) in enumerate(zip(feeders, readers)):
+            spools.extend(reader.result())
+            logging.info("align_chunks: Worker {} aligned {} chunks.".format(w, feeder.result()))
+    except BaseException:
+        # unblock the feeders and readers of the other workers
+        for proc in procs:
+            proc.kill()
+        raise
+    finally:
+        pool.shutdown()
+        for proc in procs:
+            proc.stdout.close()
+    for proc in procs:
+        check_process(proc, spooldir)
+    if len(spools) != len(chunklist):
+        raise ValueError("Aligned {} of {} chunks.".format(len(spools), len(chunklist)))
+    return [name for index, name in sorted(spools)]
@@ -0,0 +1,146 @@
+import logging
+import shlex
+import shutil
+import signal
+import subprocess
+from contextlib import contextmanager
+
+# files with these extensions are treated as gzip/BGZF compressed
+COMPRESSED_SUFFIXES = ('.gz', '.bgz')
+# number of bytes buffered when reading from or writing to a compressor
+BUFFER_SIZE = 16 * 1024 * 1024
+
+def is_compressed(path):
+    return path.endswith(COMPRESSED_SUFFIXES)
+
+def compressor(threads=1):
+    """
+    Return the command used to write compressed intermediate files.
+    Block-compressed BGZF files are written with bgzip from htslib if
+    it is installed, otherwise plain gzip is used. Both can be read
+    by any gzip reader.
+
+    :param threads: number of compression threads (bgzip only)
+    :return: command as list
+    """
+    if shutil.which("bgzip") is not None:
+        return ["bgzip", "-c", "-@", str(threads)]
+    return ["gzip", "-c", "-1"]
+
+def decompressor(threads=1):
+    """
+    Return the command used to read compressed intermediate files.
+
+    :param threads: number of decompression threads (bgzip only)
+    :return: command as list
+    """
+    if shutil.which("bgzip") is not None:
+        return ["bgzip", "-d", "-c", "-@", str(threads)]
+    return ["gzip", "-d", "-c"]
+
+def check_process(proc, path):
+    if proc.wait() != 0:
+        logging.error("check_process: {} failed for {}.".format(" ".join(proc.args), path))
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+@contextmanager
+def open_input(path, threads=1):
+    """
+    Open a file for reading in binary mode. Compressed files are read
+    through a decompression process, so decompression runs in parallel
+    with the reading script.
+
+    :param path: path to plain or compressed file
+    :param threads: number of decompression threads
+    :return: binary file object
+    """
+    if not is_compressed(path):
+        with open(path, 'rb') as fh:
+            yield fh
+        return
+    proc = subprocess.Popen(decompressor(threads) + [path], stdout=subprocess.PIPE,
+                            bufsize=BUFFER_SIZE)
+    try:
+        yield proc.stdout
+    finally:
+        proc.stdout.close()
+        # a decompressor stopped by SIGPIPE was only read partially, which is not a failure
+        if proc.wait() != -signal.SIGPIPE:
+            check_process(proc, path)
+
+@contextmanager
+def open_output(path, threads=1, append=False):
+    """
+    Open a file for writing in binary mode. Compressed files are written
+    through a compression process. Appending to a compressed file adds
+    a new gzip member, which gzip readers read as one stream.
+
+    :param path: path to plain or compressed file
+    :param threads: number of compression threads
+    :param append: True to append to an existing file instead of replacing it
+    :return: binary file object
+    """
+    mode = 'ab' if append else 'wb'
+    if not is_compressed(path):
+        with open(path, mode, buffering=BUFFER_SIZE) as fh:
+            yield fh
+        return
+    with open(path, mode) as fhout:
+        proc = subprocess.Popen(compressor(threads), stdin=subprocess.PIPE, stdout=fhout,
+                                bufsize=BUFFER_SIZE)
+        try:
+            yield proc.stdin
+        finally:
+            proc.stdin.close()
+            check_process(proc, path)
+
+def append_file(path, outfile):
+    """
+    Append a file to the output file. A file compressed like the output
+    is copied as it is, without being decompressed, since a compressed
+    file appended to another is read as a new gzip member. Otherwise
+    the file is passed through decompression or compression.
+
+    :param path: path to plain or compressed file to append
+    :param outfile: path to plain or compressed output file
+    :return: number of bytes copied
+    """
+    if is_compressed(path) == is_compressed(outfile):
+        with open(path, 'rb') as fhin, open(outfile, 'ab') as fhout:
+            shutil.copyfileobj(fhin, fhout, BUFFER_SIZE)
+            return fhin.tell()
+    nbytes = 0
+    with open_input(path) as fhin, open_output(outfile, append=True) as fhout:
+        for block in iter(lambda: fhin.read(BUFFER_SIZE), b''):
+            nbytes += fhout.write(block)
+    return nbytes
+
+def format_command(template, path):
+    """
+    Split a command template into arguments and replace the argument
+    {} with the path of the file to process.
+
+    :param template: command string, for example "minimap2 -a db.mmi {}"
+    :param path: path of input file
+    :return: command as list
+    """
+    return [path if arg == "{}" else arg for arg in shlex.split(template)]
+
+@contextmanager
+def open_process(command, path):
+    """
+    Start a command and read its standard output in binary mode, so
+    the output is consumed as it is produced instead of being written
+    to a file and read back.
+
+    :param command: command as list
+    :param path: path of the file the command processes, for logging
+    :return: binary file object
+    """
+    logging.info("open_process: Running {}".format(" ".join(command)))
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=BUFFER_SIZE)
+    try:
+        yield proc.stdout
+    finally:
+        proc.stdout.close()
+        check_process(proc, path)
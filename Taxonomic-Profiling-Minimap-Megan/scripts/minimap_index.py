@@ -0,0 +1,53 @@
+import logging
+import mmap
+import os
+import struct
+
+# the magic number at the start of each part of a minimap2 index (.mmi)
+MMI_MAGIC = b"MMI\x02"
+# index flag of minimap2 (MM_I_NO_SEQ) set when the reference sequences are not stored
+NO_SEQ = 0x2
+
+def index_parts(path):
+    """
+    Count the parts of a minimap2 index. An index built with -I smaller
+    than the reference holds several parts one after another, each
+    written as by mm_idx_dump: the magic number, the header (w, k, b,
+    number of sequences, flags), the sequence names and lengths, the
+    2^b buckets of minimizers, and the packed sequences. minimap2 reads
+    the query again for every part, so its output is only grouped by
+    read name for a single-part index. Only the sizes of the parts are
+    read, so counting is quick even for a large index.
+
+    :param path: path to the index, or to a fasta reference
+    :return: number of parts, or None if the file is not a minimap2 index
+    """
+    size = os.path.getsize(path)
+    if size < len(MMI_MAGIC):
+        return None
+    with open(path, 'rb') as fh:
+        if fh.read(len(MMI_MAGIC)) != MMI_MAGIC:
+            return None
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            parts, pos = 0, 0
+            while pos < size:
+                if mm[pos:pos + 4] != MMI_MAGIC:
+                    raise ValueError("Part {} of minimap2 index {} does not start with the magic "
+                                     "number.".format(parts + 1, path))
+                _, _, b, nseq, flag = struct.unpack_from("<5I", mm, pos + 4)
+                pos += 24
+                total = 0
+                for _ in range(nseq):
+                    pos += 1 + mm[pos]
+                    total += struct.unpack_from("<I", mm, pos)[0]
+                    pos += 4
+                for _ in range(1 << b):
+                    pos += 4 + 8 * struct.unpack_from("<I", mm, pos)[0]
+                    pos += 4 + 16 * struct.unpack_from("<I", mm, pos)[0]
+                if not flag & NO_SEQ:
+                    pos += 4 * ((total + 7) // 8)
+                parts += 1
+    if pos != size:
+        raise ValueError("Minimap2 index {} is truncated.".format(path))
+    logging.info("index_parts: {} has {} part(s).".format(path, parts))
+    return parts
@@ -1,5 +1,22 @@
 import argparse
+import heapq
 import logging
+import mmap
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from aligner_workers import align_chunks
+from alignment_filter import AlignmentFilter, log_filter
+from compressed_io import (BUFFER_SIZE, append_file, compressor, decompressor, format_command,
+                           is_compressed, open_input, open_output, open_process)
+from minimap_index import index_parts
+
+# number of illegal lines written to the log, later ones are only counted
+MAX_LOGGED = 10
+ILLEGAL = b'de:f:-inf'
 
 def get_args():
     """
@@ -7,16 +24,121 @@ def get_args():
     """
     parser = argparse.ArgumentParser(
         prog='sam-merger.py',
-        description="""Merge a series of SAM format files from a chunked alignment pipeline.""")
+        description="""Merge a series of SAM format files from a chunked alignment pipeline.
+        Each SAM file is sorted by read name in a separate sort process, and the sorted
+        streams are merged as they are read, so that the merged SAM and the ordered list
+        of unique read names are written in a single pass with constant memory. With
+        --grouped, the SAM files are instead concatenated in the order given, which is
+        only valid if the alignments of each read are contiguous and the reads follow
+        the order of the fasta files. This is checked while streaming, and the files are
+        sorted if it is not the case, or straight away if the minimap2 index given with
+        --index has several parts, for which minimap2 writes each read once per part.
+        SAM files ending in
+        .gz are read and written through bgzip (or gzip) processes. With --command, the
+        input files are fasta chunks that are aligned one after another, and the output
+        of the aligner is merged as it is produced, without writing chunk SAM files. With
+        --workers as well, the chunks are aligned by persistent aligner processes. With
+        --append, SAM files written by this script for consecutive fasta chunks are
+        appended to the output as they are, along with their reads files, so the chunks
+        can be aligned in separate jobs and merged at the end without being read again.""")
 
     parser.add_argument("-i", "--infiles",
                         required=True,
                         nargs='+',
                         help="The SAM files to merge (include all file names "
-                             "separated by spaces).")
+                             "separated by spaces), which can be compressed (.gz).")
     parser.add_argument("-o", "--outfile",
                         required=True,
-                        help="The name of the output file (example: Merged.sam).")
+                        help="The name of the output file (example: Merged.sam), which is "
+                             "compressed if it ends in .gz.")
+    parser.add_argument("-r", "--readsfile",
+                        required=True,
+                        help="The name of the output file listing the unique read names "
+                             "in the order of the merged SAM (example: reads.txt).")
+    parser.add_argument("-T", "--tempdir",
+                        required=False,
+                        default=None,
+                        help="Directory location for the temporary files written while "
+                             "sorting [default is the sort default].")
+    parser.add_argument("-t", "--threads",
+                        required=False,
+                        type=int,
+                        default=1,
+                        help="The total number of threads to use for sorting, which are "
+                             "divided between the SAM files, or for compression [1].")
+    parser.add_argument("-g", "--grouped",
+                        required=False,
+                        action='store_true',
+                        help="Optional flag to concatenate SAM files that are already grouped "
+                             "by read name (e.g., minimap2 outputs of consecutive fasta chunks, "
+                             "given in chunk order) instead of sorting them. Requires --fasta.")
+    parser.add_argument("-f", "--fasta",
+                        required=False,
+                        nargs='+',
+                        default=None,
+                        help="The fasta files of the reads, in the order of the SAM files, which "
+                             "gives the order of the reads that --grouped SAM files are checked "
+                             "against. With --command, the input files are used.")
+    parser.add_argument("-x", "--index",
+                        required=False,
+                        default=None,
+                        help="Optional minimap2 index the alignments were made with. If it has "
+                             "more than one part (or is not a .mmi file), the alignments are "
+                             "sorted without trying to concatenate them.")
+    parser.add_argument("-c", "--command",
+                        required=False,
+                        default=None,
+                        help="Optional aligner command that writes SAM to stdout, run for each "
+                             "input file with {} replaced by the file name (example: "
+                             "\"minimap2 -a db.mmi {}\"). Implies --grouped; if the alignments "
+                             "are not grouped, the merged SAM is sorted afterwards.")
+    parser.add_argument("-w", "--workers",
+                        required=False,
+                        type=int,
+                        default=0,
+                        help="Optional number of persistent aligner processes for --command, "
+                             "which each load the index once and read chunks from stdin ({} is "
+                             "replaced by -), taking the next chunk whenever they are free. The "
+                             "output is split into chunk SAM files in a temporary directory next "
+                             "to the output, which are then merged in chunk order. Requires a "
+                             "single-part minimap2 index (--index). If 0, the command is run once "
+                             "per chunk [0].")
+    parser.add_argument("-a", "--append",
+                        required=False,
+                        nargs='+',
+                        default=None,
+                        metavar='READSFILE',
+                        help="Optional reads files of the input SAM files, which were written by "
+                             "this script for consecutive fasta chunks (with --no_header for all "
+                             "but the first). The SAM files are appended to the output as they "
+                             "are, and the reads files to the reads file, as the alignments of "
+                             "each read are all in the SAM file of its chunk. Compressed SAM "
+                             "files are appended without being decompressed if the output is "
+                             "compressed.")
+    parser.add_argument("--no_header",
+                        required=False,
+                        action='store_true',
+                        help="Optional flag to write no header, for the SAM files of chunks other "
+                             "than the first, which are appended with --append.")
+    parser.add_argument("--min_query_cover",
+                        required=False,
+                        type=float,
+                        default=0,
+                        help="Optional pre-filter: remove alignments covering less than this "
+                             "percent of their read, except the best alignment of the read [0].")
+    parser.add_argument("--top_percent",
+                        required=False,
+                        type=float,
+                        default=0,
+                        help="Optional pre-filter: remove alignments scoring more than this "
+                             "percent below the best alignment of their read, or 0 to keep "
+                             "them [0].")
+    parser.add_argument("--max_hits",
+                        required=False,
+                        type=int,
+                        default=0,
+                        help="Optional pre-filter: keep only this many of the best alignments "
+                             "of each read, or 0 to keep all [0].")
 
     parser.add_argument("-l", "--logfile",
                         required=True,
@@ -24,42 +146,285 @@ def get_args():
 
     return parser.parse_args()
 
-def add_skeleton_header(outfile):
+def add_skeleton_header(fhout):
     """
     Writes a false @PG header to SAM to allow compatibility
     with sam2rma converter for MEGAN. Uses minimap2 header from
     the workflow.
 
-    :param outfile: name of output SAM file to write to
+    :param fhout: binary file object of output SAM
     """
-    with open(outfile, 'a') as fhout:
-        fhout.write("@PG\tID:minimap2\tPN:minimap2\tVN:2.17-r941\t"
-                    "CL:minimap2 -a -k 19 -w 10 -I 10G -g 5000 -r 2000 -N 20 --lj-min-ratio 0.5 "
-                    "A 2 -B 5 -O 5,56 -E 4,1 -z 400,50 --sam-hit-only -t 24 DATABASE FASTA\n")
+    fhout.write(b"@PG\tID:minimap2\tPN:minimap2\tVN:2.17-r941\t"
+                b"CL:minimap2 -a -k 19 -w 10 -I 10G -g 5000 -r 2000 -N 20 --lj-min-ratio 0.5 "
+                b"A 2 -B 5 -O 5,56 -E 4,1 -z 400,50 --sam-hit-only -t 24 DATABASE FASTA\n")
     logging.info("add_skeleton_header: Added sham @PG header to output SAM.")
 
-def write_all_sams(samlist, outfile):
+def start_sort(infile, tempdir, threads):
     """
-    Writes all lines of SAM files included in list to output file,
-    while excluding any lines with headers (start with @). Filters
-    out alignments with 'illegal' tags (de:f:-inf).
-    
-    :param samlist: list of SAM file names
-    :param outfile: name of output SAM file to write to
+    Start a sort of the alignments in a SAM file by read name. Header
+    lines are removed before sorting. The sort is stable and uses byte
+    order, so the alignments of each read stay in the order written
+    by minimap2 and the read names can be compared directly in python.
+    Compressed SAM files are decompressed into the pipeline, and the
+    temporary files of their sort are compressed as well.
+
+    :param infile: name of SAM file to sort
+    :param tempdir: directory for temporary sort files, or None
+    :param threads: number of threads for sort
+    :return: list of processes; sorted lines are read from stdout of the last
+    """
+    procs = []
+    if is_compressed(infile):
+        procs.append(subprocess.Popen(decompressor() + [infile], stdout=subprocess.PIPE))
+        procs.append(subprocess.Popen(["grep", "-v", "^@"], stdin=procs[-1].stdout,
+                                      stdout=subprocess.PIPE))
+    else:
+        procs.append(subprocess.Popen(["grep", "-v", "^@", infile], stdout=subprocess.PIPE))
+    cmd = ["sort", "-s", "-t", "\t", "-k1,1", "--parallel={}".format(threads)]
+    if tempdir is not None:
+        cmd.extend(["-T", tempdir])
+    if is_compressed(infile):
+        cmd.append("--compress-program={}".format(compressor()[0]))
+    procs.append(subprocess.Popen(cmd, stdin=procs[-1].stdout, stdout=subprocess.PIPE,
+                                  env=dict(os.environ, LC_ALL="C"), bufsize=BUFFER_SIZE))
+    # allow earlier processes to receive SIGPIPE if a later one exits early
+    for proc in procs[:-1]:
+        proc.stdout.close()
+    logging.info("start_sort: Sorting {} with {} threads.".format(infile, threads))
+    return procs
+
+def get_qname(line):
+    return line[:line.find(b'\t')]
+
+def log_illegal(func, line, illegal):
+    if illegal <= MAX_LOGGED:
+        logging.info("{}: found illegal line - {}".format(func, line.decode(errors='replace')))
+    if illegal == MAX_LOGGED:
+        logging.info("{}: further illegal lines are only counted.".format(func))
+
+def log_throughput(func, alncount, nbytes, start):
+    elapsed = max(time.time() - start, 1e-6)
+    logging.info("{}: {:,} alignments, {:,} bytes in {:.1f} s ({:,.0f} alignments/s, "
+                 "{:.1f} MB/s).".format(func, alncount, nbytes, elapsed, alncount / elapsed,
+                                        nbytes / elapsed / 1e6))
+
+def merge_sorted_sams(streams, fhout, fhreads):
+    """
+    Merge SAM lines from several streams that are each sorted by read
+    name, and write them to the output file while excluding any lines
+    with headers (start with @). Filters out alignments with 'illegal'
+    tags (de:f:-inf). Each read name is written to the reads file the
+    first time it is seen, which gives the unique read names in the
+    order of the merged SAM. Only one line per stream is held in memory,
+    and only the first line of each read is split into fields.
+
+    :param streams: list of binary file objects with sorted SAM lines
+    :param fhout: binary file object of output SAM
+    :param fhreads: binary file object of output reads file
     :return alncount: count of all legal alignments in SAM
+    :return readcount: count of unique read names in SAM
+    """
+    alncount, readcount, illegal, nbytes = int(0), int(0), int(0), int(0)
+    previous = None
+    start = time.time()
+    for line in heapq.merge(*streams, key=get_qname):
+        nbytes += len(line)
+        if ILLEGAL in line:
+            illegal += 1
+            log_illegal("merge_sorted_sams", line, illegal)
+            continue
+        qname = get_qname(line)
+        if qname != previous:
+            if line.startswith(b'@') or len(line.split(None, 5)) <= 5:
+                continue
+            fhreads.write(qname + b'\n')
+            readcount += 1
+            previous = qname
+        fhout.write(line)
+        alncount += 1
+        if alncount % 1000000 == 0:
+            log_throughput("merge_sorted_sams", alncount, nbytes, start)
+    logging.info("merge_sorted_sams: Finished merging {:,} SAM files, removed {:,} illegal "
+                 "lines.".format(len(streams), illegal))
+    log_throughput("merge_sorted_sams", alncount, nbytes, start)
+    return alncount, readcount
+
+def read_blocks(fhin):
+    while True:
+        block = fhin.read(BUFFER_SIZE)
+        if not block:
+            break
+        if not block.endswith(b'\n'):
+            block += fhin.readline()
+        yield block
+
+@contextmanager
+def iter_buffers(infile, threads, command=None):
+    """
+    Provide the contents of a SAM file as buffers of complete lines.
+    Plain files are memory-mapped as a single buffer. Compressed files
+    are read from a decompression process, and aligner output from the
+    aligner process, in blocks of BUFFER_SIZE bytes, each extended to
+    the end of its last line.
+
+    :param infile: name of SAM file, or of the input file of the command
+    :param threads: number of decompression threads
+    :param command: aligner command template, or None to read a SAM file
+    :return: iterator of buffers (mmap or bytes)
+    """
+    if command is not None:
+        with open_process(format_command(command, infile), infile) as fhin:
+            yield read_blocks(fhin)
+        return
+    if not is_compressed(infile):
+        if os.path.getsize(infile) == 0:
+            yield iter(())
+            return
+        with open(infile, 'rb') as fhin, mmap.mmap(fhin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield iter((mm,))
+        return
+    with open_input(infile, threads) as fhin:
+        yield read_blocks(fhin)
+
+def iter_read_names(fastalist):
+    """
+    Yield the read names of fasta files in order. The read name is the
+    first word of the header line, as used by the aligner. The files
+    are read in large blocks that are searched for header lines, so
+    sequence lines are not split.
+
+    :param fastalist: list of fasta file names, which can be compressed
+    :return: iterator of read names (bytes)
+    """
+    for fasta in fastalist:
+        with open_input(fasta) as fhin:
+            for block in read_blocks(fhin):
+                pos = 0
+                while True:
+                    if not block.startswith(b'>', pos):
+                        pos = block.find(b'\n>', pos)
+                        if pos < 0:
+                            break
+                        pos += 1
+                    nl = block.find(b'\n', pos)
+                    header = block[pos + 1:nl].split(None, 1)
+                    yield header[0] if header else b''
+                    pos = nl + 1
+
+def concat_grouped_sams(samlist, fhout, fhreads, threads, command=None, order=None):
     """
-    alncount = int(0)
+    Write all lines of SAM files included in list to output file in
+    the order given, while excluding any lines with headers (start
+    with @). Filters out alignments with 'illegal' tags (de:f:-inf).
+    The read names are written to the reads file as they change. The
+    alignments of each read must be contiguous and in the order of the
+    reads, so each new read name is looked up ahead in the read order,
+    which only holds the position of the last read, and the merge stops
+    as soon as a read name is not found ahead (because it was seen
+    before, or is out of order). Aligner output cannot be read twice,
+    so with a command the merge instead continues to the end without
+    checking, and the output must then be sorted. Without a read order,
+    the files are concatenated without checking.
+
+    Each SAM file is memory-mapped (or read in large blocks if it is
+    compressed) and scanned for line breaks. Lines of the same read as
+    the previous line are recognized by their prefix, so only the first
+    line of each read is split into fields (which also catches headers
+    and blank lines). Illegal tags are searched for ahead of the current
+    line, and the kept lines are written as slices of the buffer.
+
+    :param samlist: list of SAM file names
+    :param fhout: binary file object of output SAM
+    :param fhreads: binary file object of output reads file
+    :param threads: number of decompression threads
+    :param command: aligner command template run for each file, or None to read SAM files
+    :param order: iterator of read names in the order of the reads, or None to not check
+    :return alncount: count of all legal alignments in SAM, or None if not grouped
+    :return readcount: count of unique read names in SAM, or None if not grouped
+    """
+    alncount, readcount, illegal, nbytes = int(0), int(0), int(0), int(0)
+    grouped = order is not None
+    start = time.time()
     for infile in samlist:
-        with open(infile, 'r') as fhin, open(outfile, 'a') as fhout:
-            for line in fhin:
-                if not line.startswith("@") and len(line.split()) > 5:
-                    if 'de:f:-inf' in line:
-                        logging.info("write_all_sams: found illegal line - {}".format(line))
-                    else:
-                        fhout.write(line)
-                        alncount += 1
-        logging.info("write_all_sams: Finished adding SAM: {}".format(infile))
-    return alncount
+        prefix, plen = None, 0
+        with iter_buffers(infile, threads, command) as buffers:
+            for buf in buffers:
+                view = memoryview(buf)
+                pos, kept, end = 0, 0, len(buf)
+                nextbad = buf.find(ILLEGAL)
+                if nextbad < 0:
+                    nextbad = end
+                while pos < end:
+                    nl = buf.find(b'\n', pos)
+                    if nl < 0:
+                        nl = end
+                    if nextbad < nl:
+                        illegal += 1
+                        log_illegal("concat_grouped_sams", buf[pos:nl], illegal)
+                        fhout.write(view[kept:pos])
+                        kept = pos = nl + 1
+                        nextbad = buf.find(ILLEGAL, pos)
+                        if nextbad < 0:
+                            nextbad = end
+                        continue
+                    if prefix is None or buf[pos:pos + plen] != prefix:
+                        line = buf[pos:nl]
+                        if line.startswith(b'@') or len(line.split(None, 5)) <= 5:
+                            fhout.write(view[kept:pos])
+                            kept = pos = nl + 1
+                            continue
+                        qname = get_qname(line)
+                        if grouped and not any(name == qname for name in order):
+                            logging.warning("concat_grouped_sams: Alignments of {} are not contiguous "
+                                            "or not in read order in {}.".format(qname.decode(), infile))
+                            if command is None:
+                                view.release()
+                                return None, None
+                            grouped = False
+                        fhreads.write(qname + b'\n')
+                        readcount += 1
+                        if readcount % 1000000 == 0:
+                            log_throughput("concat_grouped_sams", alncount, nbytes + pos, start)
+                        prefix = qname + b'\t'
+                        plen = len(prefix)
+                    alncount += 1
+                    pos = nl + 1
+                if kept < end:
+                    fhout.write(view[kept:end])
+                    if buf[end - 1:end] != b'\n':
+                        fhout.write(b'\n')
+                view.release()
+                nbytes += end
+        logging.info("concat_grouped_sams: Finished adding SAM: {}".format(infile))
+    logging.info("concat_grouped_sams: Removed {:,} illegal lines.".format(illegal))
+    log_throughput("concat_grouped_sams", alncount, nbytes, start)
+    if not grouped:
+        return None, None
+    return alncount, readcount
+
+def merge_sams(samlist, fhout, fhreads, tempdir, threads):
+    """
+    Sort each SAM file by read name and merge the sorted outputs into
+    the output SAM and reads files as they are produced.
+
+    :param samlist: list of SAM file names
+    :param fhout: binary file object of output SAM
+    :param fhreads: binary file object of output reads file
+    :param tempdir: directory for temporary sort files, or None
+    :param threads: total number of threads for sorting
+    :return alncount: count of all legal alignments in SAM
+    :return readcount: count of unique read names in SAM
+    """
+    pipelines = [start_sort(infile, tempdir, max(1, threads // len(samlist))) for infile in samlist]
+    alncount, readcount = merge_sorted_sams([procs[-1].stdout for procs in pipelines], fhout, fhreads)
+    for infile, procs in zip(samlist, pipelines):
+        procs[-1].stdout.close()
+        for proc in procs:
+            # grep exits with 1 when a file holds no alignments
+            if proc.wait() > (1 if proc.args[0] == "grep" else 0):
+                logging.error("merge_sams: Sorting {} failed.".format(infile))
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return alncount, readcount
 
 def setup_logging(logfile):
     # set up logging to file
@@ -68,13 +433,148 @@ def setup_logging(logfile):
                         datefmt='%d-%b-%y %H:%M:%S',
                         level=logging.DEBUG)
 
+def unsorted_name(outfile):
+    root, ext = os.path.splitext(outfile)
+    return "{}.unsorted{}".format(root, ext) if is_compressed(outfile) else "{}.unsorted".format(outfile)
+
+def get_read_order(samlist, args, command):
+    """
+    Return the order of the reads that grouped alignments are checked
+    against, or None if the alignments cannot be grouped because the
+    minimap2 index has several parts (or an unknown number of them).
+
+    :param samlist: list of SAM file names, or of fasta chunks with a command
+    :param args: parsed command line arguments
+    :param command: aligner command template run for each file, or None
+    :return: iterator of read names, or None
+    """
+    if args.index is not None:
+        parts = index_parts(args.index)
+        if parts != 1:
+            logging.warning("get_read_order: The index {} has {} parts, so the alignments are not "
+                            "grouped by read name and are sorted.".format(
+                                args.index, parts if parts is not None else "an unknown number of"))
+            return None
+    return iter_read_names(samlist if command is not None else args.fasta)
+
+def merge(samlist, args, command=None):
+    """
+    Merge the SAM files (or the aligner output of the fasta chunks) into
+    the output SAM and reads files. Grouped files are concatenated if
+    their alignments are contiguous and in read order, and sorted
+    otherwise. Aligner output that cannot be grouped is written to an
+    unsorted file without checking, which is then sorted. The merged
+    alignments pass through the pre-filter if any of its thresholds
+    is set.
+
+    :param samlist: list of SAM file names, or of fasta chunks with a command
+    :param args: parsed command line arguments
+    :param command: aligner command template run for each file, or None
+    :return alncount: count of all legal alignments in SAM
+    :return readcount: count of unique read names in SAM
+    """
+    alncount = None
+    sortlist = samlist
+    order = get_read_order(samlist, args, command) if args.grouped or command is not None else None
+    if order is not None:
+        with open_output(args.outfile, args.threads) as fhout, open(args.readsfile, 'wb') as fhreads:
+            if not args.no_header:
+                add_skeleton_header(fhout)
+            fhfilter = AlignmentFilter(fhout, args.min_query_cover, args.top_percent, args.max_hits)
+            alncount, readcount = concat_grouped_sams(samlist, fhfilter if fhfilter.active else fhout,
+                                                      fhreads, args.threads, command, order)
+            if fhfilter.active:
+                fhfilter.close()
+                if alncount is not None:
+                    log_filter(fhfilter.counts())
+        if alncount is None and command is not None:
+            logging.warning("Aligner output is not grouped by read name, sorting the merged SAM.")
+            sortlist = [unsorted_name(args.outfile)]
+            shutil.move(args.outfile, sortlist[0])
+        elif alncount is None:
+            logging.warning("SAM files are not grouped by read name, sorting them instead.")
+    elif command is not None:
+        sortlist = [unsorted_name(args.outfile)]
+        with open_output(sortlist[0], args.threads) as fhout, open(os.devnull, 'wb') as fhreads:
+            concat_grouped_sams(samlist, fhout, fhreads, args.threads, command)
+    if alncount is None:
+        with open_output(args.outfile, args.threads) as fhout, open(args.readsfile, 'wb') as fhreads:
+            if not args.no_header:
+                add_skeleton_header(fhout)
+            fhfilter = AlignmentFilter(fhout, args.min_query_cover, args.top_percent, args.max_hits)
+            alncount, readcount = merge_sams(sortlist, fhfilter if fhfilter.active else fhout,
+                                             fhreads, args.tempdir, args.threads)
+            if fhfilter.active:
+                fhfilter.close()
+                log_filter(fhfilter.counts())
+        if sortlist != samlist:
+            os.remove(sortlist[0])
+    return alncount, readcount
+
+def append_chunks(samlist, readslist, outfile, readsfile):
+    """
+    Append the SAM files and reads files written by this script for
+    consecutive fasta chunks, in the order given. The alignments of each
+    read are all in the SAM file of its chunk, whether they were grouped
+    in read order or sorted, so the appended SAM is grouped by read name
+    and the appended reads files list its reads in order.
+
+    :param samlist: list of chunk SAM file names
+    :param readslist: list of the reads files of the chunk SAM files
+    :param outfile: name of output SAM file
+    :param readsfile: name of output reads file
+    :return: count of unique read names in SAM
+    """
+    if len(readslist) != len(samlist):
+        raise ValueError("Found {} reads files for {} SAM files.".format(len(readslist), len(samlist)))
+    readcount = int(0)
+    open(outfile, 'wb').close()
+    with open(readsfile, 'wb') as fhreads:
+        for infile, reads in zip(samlist, readslist):
+            nbytes = append_file(infile, outfile)
+            with open(reads, 'rb') as fhin:
+                for block in iter(lambda: fhin.read(BUFFER_SIZE), b''):
+                    readcount += block.count(b'\n')
+                    fhreads.write(block)
+            logging.info("append_chunks: Added SAM {} ({:,} bytes).".format(infile, nbytes))
+    return readcount
+
 def main():
     args = get_args()
     setup_logging(args.logfile)
     logging.info("Starting SAM merge.")
-    add_skeleton_header(args.outfile)
-    alncount = write_all_sams(args.infiles, args.outfile)
+    if args.append is not None:
+        readcount = append_chunks(args.infiles, args.append, args.outfile, args.readsfile)
+        logging.info("Found {:,} unique read names in SAM file.".format(readcount))
+        return
+    if args.grouped and args.command is None and args.fasta is None:
+        raise ValueError("--grouped requires the fasta files of the reads (--fasta) to check the "
+                         "order of the alignments.")
+    if args.command is not None and args.workers > 0:
+        if args.index is None:
+            raise ValueError("--workers requires the minimap2 index (--index), to check that it has "
+                             "a single part.")
+        parts = index_parts(args.index)
+        if parts != 1:
+            raise ValueError("--workers requires a minimap2 index with a single part, as "
+                             "minimap2 reads the query once per index part and the chunks on stdin "
+                             "can only be read once; {} has {} parts. Use 0 workers, or build the "
+                             "index with a larger -I.".format(
+                                 args.index, parts if parts is not None else "an unknown number of"))
+        spooldir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(args.outfile)))
+        try:
+            suffix = os.path.splitext(args.outfile)[1] if is_compressed(args.outfile) else ""
+            spools = align_chunks(args.infiles, args.command, args.workers, spooldir, suffix)
+            # the spools follow the order of the chunks
+            args.grouped = True
+            args.fasta = args.infiles
+            alncount, readcount = merge(spools, args)
+        finally:
+            shutil.rmtree(spooldir)
+    else:
+        alncount, readcount = merge(args.infiles, args, args.command)
     logging.info("Found {:,} total read alignments.".format(alncount))
+    logging.info("Found {:,} unique read names in SAM file.".format(readcount))
 
 if __name__ == '__main__':
     main()
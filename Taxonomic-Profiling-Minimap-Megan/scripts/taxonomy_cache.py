@@ -0,0 +1,196 @@
+import json
+import os
+import sqlite3
+import time
+
+DEFAULT_CACHE_SIZE = 200000
+# new entries written to the cache file in one transaction, or after this many seconds
+FLUSH_SIZE = 1000
+FLUSH_SECONDS = 5
+# names looked up in the cache file with one query
+QUERY_SIZE = 500
+
+def taxonomy_version(ncbi):
+    """
+    Return a string identifying the taxonomy behind ncbi. Snapshots carry
+    the checksum of their taxdump, for the ete3 database the location,
+    size and modification time of the SQLite file are used instead.
+
+    :param ncbi: TaxonomySnapshot or ete3 NCBITaxa object
+    :return: version string
+    """
+    version = getattr(ncbi, 'version', None)
+    if version is not None:
+        return version
+    dbfile = getattr(ncbi, 'dbfile', None)
+    if dbfile is not None and os.path.isfile(dbfile):
+        stat = os.stat(dbfile)
+        return "ete3:{}:{}:{}".format(os.path.abspath(dbfile), stat.st_size, int(stat.st_mtime))
+    return "unknown"
+
+class CachedTaxonomy:
+    """
+    Wraps a TaxonomySnapshot or NCBITaxa object with an on-disk cache of
+    name -> taxid and taxid -> lineage results. The cache is a SQLite
+    file in which entries are keyed by taxonomy version, so results from
+    an older taxonomy are never returned. Only the methods used by the
+    converters are provided, and anything not found in the cache is
+    looked up in the wrapped taxonomy. When the cache is closed, the
+    least recently used entries beyond max_entries are evicted.
+    Entries read or written are also kept in memory, so each is read
+    from the file at most once. To keep other converters sharing the
+    cache file from waiting on its lock, new entries are written in
+    short transactions as they are found, and the last use of cache
+    hits is only written once, when the cache is closed.
+    """
+
+    def __init__(self, ncbi, cachefile, max_entries=DEFAULT_CACHE_SIZE):
+        self.ncbi = ncbi
+        self.version = getattr(ncbi, 'version', None)
+        self.max_entries = max_entries
+        self._key = taxonomy_version(ncbi)
+        self._db = sqlite3.connect(cachefile, timeout=600)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS entries (version TEXT, kind TEXT, key TEXT, "
+                             "value TEXT, last_used REAL, PRIMARY KEY (version, kind, key))")
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        # values of entries read or written, last use of cache hits, and entries not yet written
+        self._memo = {'names': {}, 'lineages': {}}
+        self._used = {}
+        self._pending = []
+        self._flushed = time.time()
+        # ranks and names of every taxid in a lineage returned by get_lineage
+        self._ranks, self._names = {}, {}
+        self.hits = {'names': 0, 'lineages': 0}
+        self.misses = {'names': 0, 'lineages': 0}
+
+    def _load(self, kind, keys):
+        """
+        Read the entries of keys that are not in memory yet from the cache
+        file, in batches of QUERY_SIZE keys.
+        """
+        memo = self._memo[kind]
+        keys = [key for key in dict.fromkeys(keys) if key not in memo]
+        for i in range(0, len(keys), QUERY_SIZE):
+            batch = keys[i:i + QUERY_SIZE]
+            rows = self._db.execute("SELECT key, value FROM entries WHERE version = ? AND kind = ? AND "
+                                    "key IN ({})".format(", ".join("?" * len(batch))),
+                                    [self._key, kind] + batch).fetchall()
+            for key, value in rows:
+                memo[key] = json.loads(value)
+                self._used[(kind, key)] = time.time()
+
+    def _get(self, kind, key):
+        self._load(kind, [key])
+        value = self._memo[kind].get(key)
+        if value is None:
+            self.misses[kind] += 1
+            return None
+        self.hits[kind] += 1
+        if (kind, key) in self._used:
+            self._used[(kind, key)] = time.time()
+        return value
+
+    def _put(self, kind, key, value):
+        self._memo[kind][key] = value
+        self._pending.append((self._key, kind, key, json.dumps(value), time.time()))
+        if len(self._pending) >= FLUSH_SIZE or time.time() - self._flushed > FLUSH_SECONDS:
+            self._flush()
+
+    def _flush(self):
+        """
+        Write new entries to the cache file in one short transaction.
+        """
+        if self._pending:
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", self._pending)
+            self._pending = []
+        self._flushed = time.time()
+
+    def get_name_translator(self, names):
+        """
+        Return a dict of name: list of taxids for all names found. Names
+        that were not found are cached too, so they are not looked up again.
+        """
+        name2taxid, missing = {}, []
+        names = list(names)
+        self._load('names', names)
+        for name in names:
+            taxids = self._get('names', name)
+            if taxids is None:
+                missing.append(name)
+            elif taxids:
+                name2taxid[name] = taxids
+        if missing:
+            found = self.ncbi.get_name_translator(missing)
+            for name in missing:
+                taxids = [int(t) for t in found.get(name, [])]
+                self._put('names', name, taxids)
+                if taxids:
+                    name2taxid[name] = taxids
+            self._flush()
+        return name2taxid
+
+    def get_lineage(self, taxid):
+        """
+        Return the lineage of taxid. The ranks and names of all taxids in
+        the lineage are cached with it, and are used by get_rank and
+        get_taxid_translator.
+        """
+        cached = self._get('lineages', str(taxid))
+        if cached is None:
+            lineage = self.ncbi.get_lineage(taxid)
+            ranks = self.ncbi.get_rank(lineage)
+            names = self.ncbi.get_taxid_translator(lineage)
+            cached = {'lineage': [int(t) for t in lineage],
+                      'ranks': [ranks.get(t) for t in lineage],
+                      'names': [names.get(t) for t in lineage]}
+            self._put('lineages', str(taxid), cached)
+        for t, rank, name in zip(cached['lineage'], cached['ranks'], cached['names']):
+            if rank is not None:
+                self._ranks[t] = rank
+            if name is not None:
+                self._names[t] = name
+        return cached['lineage']
+
+    def get_rank(self, taxids):
+        """
+        Return a dict of taxid: rank name for all known taxids.
+        """
+        missing = [t for t in taxids if t not in self._ranks]
+        if missing:
+            self._ranks.update(self.ncbi.get_rank(missing))
+        return {t: self._ranks[t] for t in taxids if t in self._ranks}
+
+    def get_taxid_translator(self, taxids):
+        """
+        Return a dict of taxid: scientific name for all known taxids.
+        """
+        missing = [t for t in taxids if t not in self._names]
+        if missing:
+            self._names.update(self.ncbi.get_taxid_translator(missing))
+        return {t: self._names[t] for t in taxids if t in self._names}
+
+    def close(self):
+        """
+        Report cache hits and misses, and write the new entries and the
+        last use of cache hits to the cache file in one transaction, in
+        which the least recently used entries beyond max_entries are
+        evicted.
+        """
+        for kind in ['names', 'lineages']:
+            total = self.hits[kind] + self.misses[kind]
+            print("taxonomy_cache: {} lookups: {:,} hits, {:,} misses ({:.1f}% hit rate).".format(
+                kind, self.hits[kind], self.misses[kind], 100.0 * self.hits[kind] / total if total else 0.0))
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", self._pending)
+            self._pending = []
+            self._db.executemany("UPDATE entries SET last_used = ? WHERE version = ? AND kind = ? AND key = ?",
+                                 [(used, self._key, kind, key) for (kind, key), used in self._used.items()])
+            size = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            if size > self.max_entries:
+                self._db.execute("DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries "
+                                 "ORDER BY last_used LIMIT ?)", (size - self.max_entries,))
+                print("taxonomy_cache: Evicted {:,} least recently used entries.".format(size - self.max_entries))
+        print("taxonomy_cache: {:,} entries in cache.".format(min(size, self.max_entries)))
+        self._db.close()
@@ -0,0 +1,326 @@
+import argparse
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import sys
+import tarfile
+from array import array
+
+MAGIC = b"PBTAXSNP"
+SNAPSHOT_FORMAT = 1
+
+def get_args():
+    """
+    Get arguments from command line with argparse.
+    """
+    parser = argparse.ArgumentParser(
+        prog='taxonomy_snapshot.py',
+        description="""Compile an NCBI taxonomy dump (taxdump.tar.gz) into a compact,
+        memory-mapped snapshot file that the kreport/mpa converters can use in place
+        of the ete3 NCBITaxa SQLite database.""")
+
+    parser.add_argument("-t", "--taxdump",
+                        required=True,
+                        help="An NCBI taxdump.tar.gz file, or a directory containing the "
+                             "extracted nodes.dmp, names.dmp and merged.dmp files.")
+    parser.add_argument("-o", "--outfile",
+                        required=True,
+                        help="The name of the snapshot file to write (e.g., ncbi-taxonomy.snapshot).")
+
+    return parser.parse_args()
+
+def read_dump_lines(taxdump, filename):
+    """
+    Generator that yields the split fields of each row of a .dmp file
+    contained in a taxdump archive or directory.
+
+    :param taxdump: path to taxdump.tar.gz or to an extracted taxdump directory
+    :param filename: name of the .dmp file (e.g., nodes.dmp)
+    :return: list of field strings for each row
+    """
+    if os.path.isdir(taxdump):
+        with open(os.path.join(taxdump, filename), 'r', encoding='utf-8') as fh:
+            for line in fh:
+                yield line.rstrip('\t|\n').split('\t|\t')
+    else:
+        with tarfile.open(taxdump, 'r') as tar:
+            fh = tar.extractfile(filename)
+            for line in fh:
+                yield line.decode('utf-8').rstrip('\t|\n').split('\t|\t')
+
+def taxdump_checksum(taxdump):
+    """
+    Calculate the sha256 checksum of a taxdump. For an extracted taxdump
+    directory the nodes, names and merged tables are hashed in order.
+
+    :param taxdump: path to taxdump.tar.gz or to an extracted taxdump directory
+    :return: hex digest string
+    """
+    if os.path.isdir(taxdump):
+        files = [os.path.join(taxdump, f) for f in ['nodes.dmp', 'names.dmp', 'merged.dmp']
+                 if os.path.isfile(os.path.join(taxdump, f))]
+    else:
+        files = [taxdump]
+    digest = hashlib.sha256()
+    for f in files:
+        with open(f, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+def parse_taxdump(taxdump):
+    """
+    Read the nodes, names and merged tables from an NCBI taxdump.
+
+    The synonym name classes mirror those ete3 loads into its synonym
+    table, so name lookups resolve the same set of names.
+
+    :param taxdump: path to taxdump.tar.gz or to an extracted taxdump directory
+    :return nodes: dict of taxid: (parent taxid, rank)
+    :return sci_names: dict of taxid: scientific name
+    :return synonyms: list of (name, taxid) tuples for non-scientific names
+    :return merged: dict of old taxid: new taxid
+    """
+    print("parse_taxdump: Reading nodes.dmp...")
+    nodes = {}
+    for parts in read_dump_lines(taxdump, 'nodes.dmp'):
+        nodes[int(parts[0])] = (int(parts[1]), parts[2])
+    print("parse_taxdump: Found {:,} nodes.".format(len(nodes)))
+
+    print("parse_taxdump: Reading names.dmp...")
+    synonym_classes = {"synonym", "equivalent name", "genbank equivalent name",
+                       "anamorph", "genbank synonym", "genbank anamorph", "teleomorph"}
+    sci_names, synonyms = {}, []
+    for parts in read_dump_lines(taxdump, 'names.dmp'):
+        if parts[3] == "scientific name":
+            sci_names[int(parts[0])] = parts[1]
+        elif parts[3] in synonym_classes:
+            synonyms.append((parts[1], int(parts[0])))
+
+    merged = {}
+    try:
+        for parts in read_dump_lines(taxdump, 'merged.dmp'):
+            merged[int(parts[0])] = int(parts[1])
+    except (KeyError, FileNotFoundError):
+        print("parse_taxdump: No merged.dmp found, skipping merged taxids.")
+    return nodes, sci_names, synonyms, merged
+
+def build_snapshot(taxdump, outfile, checksum=None):
+    """
+    Compile a taxdump into the snapshot format. All tables are flat
+    arrays indexed by taxid (parent, rank code, name offset), plus a
+    sorted lowercase name index for name -> taxid lookups and a sorted
+    merged-taxid table. The file is written to a temporary name and
+    moved into place, so concurrent readers never see a partial file.
+    The checksum of the taxdump is stored in the header and identifies
+    the taxonomy version of the snapshot.
+
+    :param taxdump: path to taxdump.tar.gz or to an extracted taxdump directory
+    :param outfile: name of snapshot file to write
+    :param checksum: sha256 of the taxdump, calculated if not given
+    """
+    if checksum is None:
+        checksum = taxdump_checksum(taxdump)
+    nodes, sci_names, synonyms, merged = parse_taxdump(taxdump)
+    size = max(nodes) + 1
+
+    print("build_snapshot: Building taxid-indexed tables...")
+    ranks = [""] + sorted({rank for _, rank in nodes.values()})
+    rank_codes = {r: i for i, r in enumerate(ranks)}
+    parent = array('I', bytes(4 * size))
+    rank = array('B', bytes(size))
+    name_offsets = array('I', bytes(4 * (size + 1)))
+    names = bytearray()
+    for taxid in range(size):
+        name_offsets[taxid] = len(names)
+        if taxid in nodes:
+            parent[taxid] = nodes[taxid][0]
+            rank[taxid] = rank_codes[nodes[taxid][1]]
+            names += sci_names.get(taxid, "").encode('utf-8')
+    name_offsets[size] = len(names)
+
+    print("build_snapshot: Building name index...")
+    # scientific names sort ahead of synonyms sharing the same key
+    entries = sorted({(name.lower().encode('utf-8'), 0, taxid)
+                      for taxid, name in sci_names.items()}
+                     | {(name.lower().encode('utf-8'), 1, taxid) for name, taxid in synonyms})
+    key_offsets = array('I', [0])
+    key_taxids = array('I')
+    key_synonym = array('B')
+    keys = bytearray()
+    for key, synonym, taxid in entries:
+        keys += key
+        key_offsets.append(len(keys))
+        key_taxids.append(taxid)
+        key_synonym.append(synonym)
+
+    merged_old = array('I', sorted(merged))
+    merged_new = array('I', [merged[m] for m in merged_old])
+
+    sections = [("parent", parent), ("rank", rank), ("name_offsets", name_offsets),
+                ("names", names), ("key_offsets", key_offsets), ("key_taxids", key_taxids),
+                ("key_synonym", key_synonym), ("keys", keys),
+                ("merged_old", merged_old), ("merged_new", merged_new)]
+    write_snapshot(outfile, sections, {"format": SNAPSHOT_FORMAT, "size": size, "ranks": ranks,
+                                       "byteorder": sys.byteorder, "taxdump_sha256": checksum})
+    print("build_snapshot: Wrote snapshot with {:,} taxa and {:,} names to {}.".format(
+        len(nodes), len(entries), outfile))
+
+def write_snapshot(outfile, sections, header):
+    """
+    Write the magic string, a JSON header describing the byte offset,
+    length and type code of every section, and then the 8-byte aligned
+    sections themselves.
+
+    :param outfile: name of snapshot file to write
+    :param sections: list of (name, array or bytearray) tuples
+    :param header: dict of metadata to store in the header
+    """
+    layout, offset = {}, 0
+    for name, data in sections:
+        typecode = data.typecode if isinstance(data, array) else 'B'
+        nbytes = len(data) * (data.itemsize if isinstance(data, array) else 1)
+        layout[name] = [offset, nbytes, typecode]
+        offset += nbytes + (-nbytes % 8)
+    header = dict(header, sections=layout)
+    encoded = json.dumps(header, sort_keys=True).encode('utf-8')
+    encoded += b" " * (-(len(MAGIC) + 4 + len(encoded)) % 8)
+
+    tmpfile = "{}.tmp.{}".format(outfile, os.getpid())
+    with open(tmpfile, 'wb') as fh:
+        fh.write(MAGIC)
+        fh.write(len(encoded).to_bytes(4, 'little'))
+        fh.write(encoded)
+        for name, data in sections:
+            raw = data.tobytes() if isinstance(data, array) else bytes(data)
+            fh.write(raw)
+            fh.write(b"\0" * (-len(raw) % 8))
+    os.replace(tmpfile, outfile)
+
+class TaxonomySnapshot:
+    """
+    Read-only view of a snapshot file written by build_snapshot().
+
+    The file is memory-mapped, so every converter process running on a
+    node shares the same page cache, and lineage resolution is a walk
+    over the parent array. The methods below follow the ete3 NCBITaxa
+    methods used by the converters, so an instance can be passed
+    anywhere an NCBITaxa object was used.
+    """
+
+    def __init__(self, snapshot):
+        self.path = snapshot
+        with open(snapshot, 'rb') as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a taxonomy snapshot file.".format(snapshot))
+        hlen = int.from_bytes(self._mm[len(MAGIC):len(MAGIC) + 4], 'little')
+        start = len(MAGIC) + 4
+        self.header = json.loads(self._mm[start:start + hlen].decode('utf-8'))
+        if self.header["format"] != SNAPSHOT_FORMAT or self.header["byteorder"] != sys.byteorder:
+            raise ValueError("{} was built with an incompatible snapshot format.".format(snapshot))
+        self.ranks = self.header["ranks"]
+        self.size = self.header["size"]
+        view = memoryview(self._mm)[start + hlen:]
+        for name, (offset, nbytes, typecode) in self.header["sections"].items():
+            setattr(self, "_" + name, view[offset:offset + nbytes].cast(typecode))
+
+    @property
+    def version(self):
+        """
+        Taxonomy version of the snapshot, taken from the checksum of the
+        taxdump it was built from (None for snapshots without one).
+        """
+        if "taxdump_sha256" not in self.header:
+            return None
+        return "NCBI taxdump sha256:{}".format(self.header["taxdump_sha256"][:16])
+
+    def _translate_merged(self, taxid):
+        i = bisect.bisect_left(self._merged_old, taxid)
+        if i < len(self._merged_old) and self._merged_old[i] == taxid:
+            return self._merged_new[i]
+        return taxid
+
+    def _valid(self, taxid):
+        return 0 < taxid < self.size and self._rank[taxid] != 0
+
+    def _name(self, taxid):
+        return bytes(self._names[self._name_offsets[taxid]:self._name_offsets[taxid + 1]]).decode('utf-8')
+
+    def _key(self, i):
+        return bytes(self._keys[self._key_offsets[i]:self._key_offsets[i + 1]])
+
+    def _find_key(self, key):
+        lo, hi = 0, len(self._key_taxids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get_lineage(self, taxid):
+        """
+        Return the list of taxids from the root (1) down to taxid.
+        Merged taxids are translated to their current taxid.
+        """
+        taxid = int(taxid)
+        if not self._valid(taxid):
+            taxid = self._translate_merged(taxid)
+            if not self._valid(taxid):
+                raise ValueError("{} taxid not found".format(taxid))
+        lineage = [taxid]
+        while taxid != 1:
+            taxid = self._parent[taxid]
+            lineage.append(taxid)
+        return lineage[::-1]
+
+    def get_rank(self, taxids):
+        """
+        Return a dict of taxid: rank name for all known taxids.
+        """
+        return {t: self.ranks[self._rank[int(t)]] for t in taxids if self._valid(int(t))}
+
+    def get_taxid_translator(self, taxids):
+        """
+        Return a dict of taxid: scientific name for all known taxids.
+        Merged taxids are reported under the taxid that was requested.
+        """
+        translated = {}
+        for t in taxids:
+            current = self._translate_merged(int(t)) if not self._valid(int(t)) else int(t)
+            if self._valid(current):
+                translated[t] = self._name(current)
+        return translated
+
+    def get_name_translator(self, names):
+        """
+        Return a dict of name: list of taxids for all names found. As in
+        ete3, matching is case-insensitive and synonyms are only used for
+        names that are not a scientific name. Homonyms return every
+        matching taxid in ascending order.
+        """
+        name2taxid = {}
+        for name in names:
+            key = name.lower().encode('utf-8')
+            i = self._find_key(key)
+            synonym = None
+            while i < len(self._key_taxids) and self._key(i) == key:
+                if synonym is None:
+                    synonym = self._key_synonym[i]
+                if self._key_synonym[i] != synonym:
+                    break
+                name2taxid.setdefault(name, []).append(self._key_taxids[i])
+                i += 1
+        return name2taxid
+
+def main():
+    args = get_args()
+    build_snapshot(args.taxdump, args.outfile)
+    print("\nDone!\n")
+
+if __name__ == '__main__':
+    main()
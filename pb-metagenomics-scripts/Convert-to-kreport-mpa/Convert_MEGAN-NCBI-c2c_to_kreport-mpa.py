@@ -3,6 +3,8 @@ import os
 import ete3
 import pandas as pd
 from ete3 import NCBITaxa
+from taxonomy_snapshot import TaxonomySnapshot
+from taxonomy_cache import CachedTaxonomy, DEFAULT_CACHE_SIZE
 
 def get_args():
     """
@@ -34,15 +36,44 @@ def get_args():
                         required=False,
                         action='store_true',
                         help="Including this flag will cause NCBITaxa to update the taxonomy database.")
+    parser.add_argument("-t", "--taxonomy",
+                        required=False,
+                        default=None,
+                        help="A taxonomy snapshot file built with taxonomy_snapshot.py. If provided, "
+                             "it is used instead of the ete3 NCBITaxa database (--update is ignored).")
+    parser.add_argument("--cache",
+                        required=False,
+                        default=None,
+                        help="An on-disk cache file of taxonomy lookups (created if it does not exist). "
+                             "Names and lineages found in the cache for the same taxonomy version are "
+                             "not looked up again.")
+    parser.add_argument("--cache-size",
+                        required=False,
+                        type=int,
+                        default=DEFAULT_CACHE_SIZE,
+                        help="Maximum number of entries kept in the cache, the least recently used "
+                             "entries are removed first (default: {}).".format(DEFAULT_CACHE_SIZE))
+    parser.add_argument("--intermediate",
+                        required=False,
+                        action='store_true',
+                        help="Including this flag will also write the intermediate names and taxids "
+                             "files (LABEL.intermediate.names.txt, LABEL.intermediate.taxid.txt).")
 
     return parser.parse_args()
 
-def activate_ncbi(update=False):
-    print("\nActivating NCBI taxonomy database...")
-    ncbi = NCBITaxa()
-    if update is True:
-        print("\tUpdating database...")
-        ncbi.update_taxonomy_database()
+def activate_ncbi(update=False, snapshot=None, cache=None, cache_size=DEFAULT_CACHE_SIZE):
+    if snapshot is not None:
+        print("\nLoading taxonomy snapshot {}...".format(snapshot))
+        ncbi = TaxonomySnapshot(snapshot)
+    else:
+        print("\nActivating NCBI taxonomy database...")
+        ncbi = NCBITaxa()
+        if update is True:
+            print("\tUpdating database...")
+            ncbi.update_taxonomy_database()
+    if cache is not None:
+        print("Using taxonomy lookup cache {}...".format(cache))
+        ncbi = CachedTaxonomy(ncbi, cache, cache_size)
     return ncbi
 
 def get_taxon_dict(ncbi, df):
@@ -67,56 +98,92 @@ def add_ranks(ncbi, k, v):
             temp_dict[r] = {'taxid': 'NA', 'name': 'NA'}
     return temp_dict
 
-def write_intermediate_output(taxon_dict, output, label):
-    print("Writing intermediate output using {}s...".format(label))
-    with open(output, 'a') as fh:
-        fh.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}"
-                 "\t{6}\t{7}\t{8}\t{9}\t{10}\t{11}\n".format('Taxon', 'Count', 'superkingdom',
-                                                     'kingdom', 'clade', 'phylum', 'class',
-                                                     'order', 'family', 'genus', 'species', 'strain'))
+def add_counts(taxon_dict, df):
+    """
+    Add read counts to taxon_dict. The counts of all taxa are summed
+    with a single groupby, so duplicate names are aggregated and each
+    taxon is a dictionary lookup instead of a scan of the table.
+
+    :param taxon_dict: dict of taxa from get_taxon_dict
+    :param df: pandas dataframe of input counts
+    """
+    counts = df.groupby('Name')['Count'].sum().to_dict()
+    for k, v in taxon_dict.items():
+        v['Count'] = int(counts[k])
+
+def write_intermediate_output(taxon_dict, names_output, taxids_output):
+    """
+    Write the intermediate names and taxids files in a single pass over
+    taxon_dict. These files are only written on request, the lineages
+    are built directly from taxon_dict.
+
+    :param taxon_dict: dict of taxa with counts and ranks from add_ranks
+    :param names_output: name of the intermediate file to write using names
+    :param taxids_output: name of the intermediate file to write using taxids
+    """
+    print("Writing intermediate output using names and taxids...")
+    ranks = ['superkingdom', 'kingdom', 'clade', 'phylum', 'class', 'order', 'family', 'genus', 'species', 'strain']
+    header = "\t".join(['Taxon', 'Count'] + ranks) + "\n"
+    with open(names_output, 'a') as fh_names, open(taxids_output, 'a') as fh_taxids:
+        fh_names.write(header)
+        fh_taxids.write(header)
         for k, v in taxon_dict.items():
-            fh.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}"
-                     "\t{6}\t{7}\t{8}\t{9}\t{10}\t{11}\n".format(k, v['Count'], v['superkingdom'][label],
-                                                           v['kingdom'][label], v['clade'][label],
-                                                           v['phylum'][label], v['class'][label],
-                                                           v['order'][label], v['family'][label],
-                                                           v['genus'][label], v['species'][label],
-                                                           v['strain'][label]))
-
-def make_lineage_dict(infile):
-    print("\nReading intermediate ranks file...")
+            fh_names.write("\t".join([k, str(v['Count'])] + [str(v[r]['name']) for r in ranks]) + "\n")
+            fh_taxids.write("\t".join([k, str(v['Count'])] + [str(v[r]['taxid']) for r in ranks]) + "\n")
+
+def make_lineage_dict(taxon_dict):
+    """
+    Build lineages directly from taxon_dict. Each lineage also keeps the
+    taxids of its ranks ('taxids', ordered like the lineage), so the
+    kreport can be written without translating names back into taxids.
+
+    :param taxon_dict: dict of taxa with counts and ranks from add_ranks
+    :return lineage_dict: dict of lineage: {'level_count': INT, 'cumulative_count': INT, 'taxids': LIST}
+    """
+    print("\nBuilding lineages...")
     lineage_dict = {}
-    with open(infile, 'r') as fh:
-        next(fh)
-        for line in fh:
-            parts = line.strip().split('\t')
-            badnames = ["k__NA", "p__NA", "c__NA", "o__NA", "f__NA", "g__NA", "s__NA", "ss__NA"]
-            relabeled = ["k__{}".format(parts[2]), "p__{}".format(parts[5]),
-                         "c__{}".format(parts[6]), "o__{}".format(parts[7]),
-                         "f__{}".format(parts[8]), "g__{}".format(parts[9]),
-                         "s__{}".format(parts[10]), "ss__{}".format(parts[11])]
-            lineage = "|".join([l for l in relabeled if l not in badnames])
-            if lineage:
-                if lineage in lineage_dict:
-                    lineage_dict[lineage]['level_count'] += int(parts[1])
-                else:
-                    lineage_dict[lineage] = {'level_count': int(parts[1]), 'cumulative_count': int(0)}
+    prefixes = [("superkingdom", "k__"), ("phylum", "p__"), ("class", "c__"), ("order", "o__"),
+                ("family", "f__"), ("genus", "g__"), ("species", "s__"), ("strain", "ss__")]
+    for k, v in taxon_dict.items():
+        ranked = [(p, v[r]) for r, p in prefixes if v[r]['name'] != "NA"]
+        lineage = "|".join(["{}{}".format(p, t['name']) for p, t in ranked])
+        if lineage:
+            if lineage in lineage_dict:
+                lineage_dict[lineage]['level_count'] += int(v['Count'])
+            else:
+                lineage_dict[lineage] = {'level_count': int(v['Count']), 'cumulative_count': int(0),
+                                         'taxids': [t['taxid'] for p, t in ranked]}
     return lineage_dict
 
 def fill_out_lineages(lineage_dict):
+    """
+    Add any missing higher-rank lineages, then calculate cumulative counts
+    with a single bottom-up pass over the lineage tree. The parent of a
+    lineage is the lineage with its last rank removed, so each node adds
+    its cumulative count to exactly one parent (deepest ranks first).
+
+    :param lineage_dict: dict of lineage: {'level_count': INT, 'cumulative_count': INT, 'taxids': LIST}
+    :return expanded_dict: lineage_dict plus all missing parent lineages
+    """
     print("Filling out lineage gaps...")
     expanded_dict = {k: v for (k, v) in lineage_dict.items()}
     for k, v in lineage_dict.items():
-        expanded_dict[k] = v
-        label = ""
-        for i in k.split('|'):
-            label += i
-            if label not in expanded_dict:
-                expanded_dict[label] = {'level_count': int(0), 'cumulative_count': int(0)}
-            label += "|"
+        label = k
+        while '|' in label:
+            label = label.rsplit('|', 1)[0]
+            if label in expanded_dict:
+                break
+            expanded_dict[label] = {'level_count': int(0), 'cumulative_count': int(0),
+                                    'taxids': v['taxids'][:label.count('|') + 1]}
     print("Calculating cumulative counts...")
-    for key in expanded_dict.keys():
-        expanded_dict[key]['cumulative_count'] = sum([expanded_dict[k]['level_count'] for k in expanded_dict.keys() if k.startswith(key)])
+    depths = {}
+    for key, v in expanded_dict.items():
+        v['cumulative_count'] = v['level_count']
+        depths.setdefault(key.count('|'), []).append(key)
+    for depth in sorted(depths, reverse=True):
+        if depth > 0:
+            for key in depths[depth]:
+                expanded_dict[key.rsplit('|', 1)[0]]['cumulative_count'] += expanded_dict[key]['cumulative_count']
     return expanded_dict
 
 def write_mpa(expanded_dict, outname):
@@ -126,33 +193,36 @@ def write_mpa(expanded_dict, outname):
         for k, v in sorted(expanded_dict.items()):
             fh.write("{}\t{}\n".format(k.replace(" ","_"), v['cumulative_count']))
 
-def write_kreport(expanded_dict, outname, reads, ncbi):
+def write_kreport(expanded_dict, outname, reads, version=None):
+    """
+    Write the kreport rows. The rank, name and taxid of each row come
+    from the lineage itself, so no taxonomy lookups are needed here.
+    If the taxonomy version is known, it is recorded in a comment line
+    at the top of the file.
+    """
     print("Writing kreport output file...")
     # headers for kreport
     # proportion + cumulative_count + level_count + rank + taxid + name
+    indent_rules = {"K":"", "P":"  ", "C":"    ",
+                    "O":"      ", "F":"        ",
+                    "G":"          ", "S":"            ",
+                    "SS":"              "}
     with open(outname, 'a') as fh:
+        if version is not None:
+            fh.write("# taxonomy: {}\n".format(version))
         for k, v in sorted(expanded_dict.items()):
-            indent_rules = {"K":"", "P":"  ", "C":"    ",
-                            "O":"      ", "F":"        ",
-                            "G":"          ", "S":"            ",
-                            "SS":"              "}
-            if '|' in k:
-                rank = k.split('|')[-1].split('__')[0].upper()
-                name = k.split('|')[-1].split('__')[-1]
-            else:
-                rank = k.split('__')[0].upper()
-                name = k.split('__')[-1]
-            taxid = ncbi.get_name_translator([name])[name][0]
-            name = indent_rules[rank] + name
+            last = k.rsplit('|', 1)[-1]
+            rank = last.split('__')[0].upper()
+            name = indent_rules[rank] + last.split('__')[-1]
             if rank == "SS":
                 rank = "S1"
-            row_data = [round((float(v['cumulative_count'])/float(reads))*100, 2), v['cumulative_count'], v['level_count'], rank, taxid, name]
-            row_string = "\t".join([str(i) for i in row_data])
-            fh.write("{}\n".format(row_string))
+            fh.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(round((float(v['cumulative_count'])/float(reads))*100, 2),
+                                                       v['cumulative_count'], v['level_count'],
+                                                       rank, v['taxids'][-1], name))
 
 def main():
     args = get_args()
-    ncbi = activate_ncbi(args.update)
+    ncbi = activate_ncbi(args.update, args.taxonomy, args.cache, args.cache_size)
     print("\nReading in c2c file...")
     if args.columns == 'three':
         df = pd.read_csv(args.input, sep='\t', names=['Level', 'Name', 'Count'], header=None)
@@ -163,14 +233,17 @@ def main():
     for k, v in taxon_dict.items():
         # add lineage ranks and names
         v.update(add_ranks(ncbi, k, v))
-        # add read counts
-        v['Count'] = int((df.loc[df['Name'] == k])['Count'])
-    write_intermediate_output(taxon_dict, "{}.intermediate.names.txt".format(args.label), 'name')
-    write_intermediate_output(taxon_dict, "{}.intermediate.taxid.txt".format(args.label), 'taxid')
-    lineage_dict = make_lineage_dict("{}.intermediate.names.txt".format(args.label))
+    if args.cache is not None:
+        ncbi.close()
+    add_counts(taxon_dict, df)
+    if args.intermediate:
+        write_intermediate_output(taxon_dict, "{}.intermediate.names.txt".format(args.label),
+                                  "{}.intermediate.taxid.txt".format(args.label))
+    lineage_dict = make_lineage_dict(taxon_dict)
     expanded_dict = fill_out_lineages(lineage_dict)
     write_mpa(expanded_dict, "{}.megan-c2c.mpa.txt".format(args.label))
-    write_kreport(expanded_dict, "{}.megan-c2c.kreport.txt".format(args.label), args.readcount, ncbi)
+    write_kreport(expanded_dict, "{}.megan-c2c.kreport.txt".format(args.label), args.readcount,
+                  getattr(ncbi, 'version', None))
     print("\nDone!\n")
 
 if __name__ == '__main__':
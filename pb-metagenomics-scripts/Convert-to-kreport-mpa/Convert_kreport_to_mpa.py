@@ -3,6 +3,7 @@ import os
 import ete3
 import pandas as pd
 from ete3 import NCBITaxa
+from taxonomy_snapshot import TaxonomySnapshot
 
 def get_args():
     """
@@ -27,10 +28,18 @@ def get_args():
                         required=False,
                         action='store_true',
                         help="Including this flag will cause NCBITaxa to update the taxonomy database.")
+    parser.add_argument("-t", "--taxonomy",
+                        required=False,
+                        default=None,
+                        help="A taxonomy snapshot file built with taxonomy_snapshot.py. If provided, "
+                             "it is used instead of the ete3 NCBITaxa database (--update is ignored).")
 
     return parser.parse_args()
 
-def activate_ncbi(update=False):
+def activate_ncbi(update=False, snapshot=None):
+    if snapshot is not None:
+        print("\nLoading taxonomy snapshot {}...".format(snapshot))
+        return TaxonomySnapshot(snapshot)
     print("\nActivating NCBI taxonomy database...")
     ncbi = NCBITaxa()
     if update is True:
@@ -71,14 +80,24 @@ def make_lineage_dict(df, ncbi):
     return lineage_dict
 
 def write_mpa(df, lineage_dict, outname):
-    print("Writing kreport file...")
+    """
+    Join the lineages to the cumulative counts of the kreport and write
+    them. The counts are summed per taxid with a single groupby, so
+    duplicate taxids are aggregated rather than scanned for one by one.
+
+    :param df: pandas dataframe of the filtered kreport
+    :param lineage_dict: dict of taxid: lineage
+    :param outname: name of the mpa output file
+    """
+    print("Writing mpa file...")
+    counts = df.groupby('taxid')['cumulative_count'].sum()
+    table = pd.Series(lineage_dict, name='lineage').to_frame().join(counts)
     with open(outname, 'a') as fh:
-        for k, v in lineage_dict.items():
-            fh.write("{}\t{}\n".format(v, int((df.loc[df['taxid'] == k])['cumulative_count'])))
+        table.to_csv(fh, sep='\t', header=False, index=False, columns=['lineage', 'cumulative_count'])
 
 def main():
     args = get_args()
-    ncbi = activate_ncbi(args.update)
+    ncbi = activate_ncbi(args.update, args.taxonomy)
     df = make_filtered_df(args.input, args.format)
     lineage_dict = make_lineage_dict(df, ncbi)
     write_mpa(df, lineage_dict, "{}.mpa.txt".format(args.label))
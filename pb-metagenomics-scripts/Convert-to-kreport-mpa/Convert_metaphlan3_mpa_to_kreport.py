@@ -3,6 +3,7 @@ import os
 import ete3
 import pandas as pd
 from ete3 import NCBITaxa
+from taxonomy_snapshot import TaxonomySnapshot
 
 def get_args():
     """
@@ -32,10 +33,23 @@ def get_args():
                         required=False,
                         action='store_true',
                         help="Including this flag will cause NCBITaxa to update the taxonomy database.")
+    parser.add_argument("-t", "--taxonomy",
+                        required=False,
+                        default=None,
+                        help="A taxonomy snapshot file built with taxonomy_snapshot.py. If provided, "
+                             "it is used instead of the ete3 NCBITaxa database (--update is ignored).")
+    parser.add_argument("--intermediate",
+                        required=False,
+                        action='store_true',
+                        help="Including this flag will also write the intermediate names, taxids and "
+                             "kreport files (LABEL.intermediate.*.txt).")
 
     return parser.parse_args()
 
-def activate_ncbi(update=False):
+def activate_ncbi(update=False, snapshot=None):
+    if snapshot is not None:
+        print("\nLoading taxonomy snapshot {}...".format(snapshot))
+        return TaxonomySnapshot(snapshot)
     print("\nActivating NCBI taxonomy database...")
     ncbi = NCBITaxa()
     if update is True:
@@ -58,10 +72,12 @@ def create_df(infile, mappedreads):
 
 def get_taxon_dict(ncbi, df):
     print("Translating taxon names...")
+    taxids = [int(taxid) for taxid in df['taxid'].unique() if taxid != 0]
+    # translate all taxids with a single lookup
+    taxid2name = ncbi.get_taxid_translator(taxids)
     taxon_dict = {}
-    for taxid in list(df['taxid'].unique()):
-        if taxid != 0:
-            taxon_dict[ncbi.get_taxid_translator([int(taxid)])[int(taxid)]] = {'taxid': int(taxid)}
+    for taxid in taxids:
+        taxon_dict[taxid2name[taxid]] = {'taxid': taxid}
     return taxon_dict
 
 def add_ranks(ncbi, k, v):
@@ -78,49 +94,71 @@ def add_ranks(ncbi, k, v):
             temp_dict[r] = {'taxid': 'NA', 'name': 'NA'}
     return temp_dict
 
-def write_intermediate_output(taxon_dict, output, label):
-    with open(output, 'a') as fh:
-        fh.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}"
-                 "\t{6}\t{7}\t{8}\t{9}\t{10}\t{11}\n".format('Taxon', 'Count', 'superkingdom',
-                                                     'kingdom', 'clade', 'phylum', 'class',
-                                                     'order', 'family', 'genus', 'species', 'strain'))
+def add_counts(taxon_dict, df):
+    """
+    Add read counts to taxon_dict. The counts of all taxa are summed
+    with a single groupby, so duplicate taxids are aggregated and each
+    taxon is a dictionary lookup instead of a scan of the table.
+
+    :param taxon_dict: dict of taxa from get_taxon_dict
+    :param df: pandas dataframe of input counts
+    """
+    counts = df.groupby('taxid')['Count'].sum().to_dict()
+    for k, v in taxon_dict.items():
+        v['Count'] = int(counts[str(v['taxid'])])
+
+def write_intermediate_output(taxon_dict, names_output, taxids_output):
+    """
+    Write the intermediate names and taxids files in a single pass over
+    taxon_dict. These files are only written on request, the lineages
+    are built directly from taxon_dict.
+
+    :param taxon_dict: dict of taxa with counts and ranks from add_ranks
+    :param names_output: name of the intermediate file to write using names
+    :param taxids_output: name of the intermediate file to write using taxids
+    """
+    print("Writing intermediate output using names and taxids...")
+    ranks = ['superkingdom', 'kingdom', 'clade', 'phylum', 'class', 'order', 'family', 'genus', 'species', 'strain']
+    header = "\t".join(['Taxon', 'Count'] + ranks) + "\n"
+    with open(names_output, 'a') as fh_names, open(taxids_output, 'a') as fh_taxids:
+        fh_names.write(header)
+        fh_taxids.write(header)
         for k, v in taxon_dict.items():
-            fh.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}"
-                     "\t{6}\t{7}\t{8}\t{9}\t{10}\t{11}\n".format(k, v['Count'], v['superkingdom'][label],
-                                                           v['kingdom'][label], v['clade'][label],
-                                                           v['phylum'][label], v['class'][label],
-                                                           v['order'][label], v['family'][label],
-                                                           v['genus'][label], v['species'][label],
-                                                           v['strain'][label]))
-
-def make_lineage_dict(infile):
-    print("\nReading intermediate ranks file...")
+            fh_names.write("\t".join([k, str(v['Count'])] + [str(v[r]['name']) for r in ranks]) + "\n")
+            fh_taxids.write("\t".join([k, str(v['Count'])] + [str(v[r]['taxid']) for r in ranks]) + "\n")
+
+def make_lineage_dict(taxon_dict):
+    """
+    Build lineages directly from taxon_dict. Each lineage also keeps the
+    taxids of its ranks ('taxids', ordered like the lineage), so the
+    kreport can be written without translating names back into taxids.
+
+    :param taxon_dict: dict of taxa with counts and ranks from add_ranks
+    :return lineage_dict: dict of lineage: {'level_count': '-', 'cumulative_count': INT, 'taxids': LIST}
+    """
+    print("\nBuilding lineages...")
     lineage_dict = {}
-    with open(infile, 'r') as fh:
-        next(fh)
-        for line in fh:
-            parts = line.strip().split('\t')
-            badnames = ["k__NA", "p__NA", "c__NA", "o__NA", "f__NA", "g__NA", "s__NA", "ss__NA"]
-            relabeled = ["k__{}".format(parts[2]), "p__{}".format(parts[5]),
-                         "c__{}".format(parts[6]), "o__{}".format(parts[7]),
-                         "f__{}".format(parts[8]), "g__{}".format(parts[9]),
-                         "s__{}".format(parts[10]), "ss__{}".format(parts[11])]
-            lineage = "|".join([l for l in relabeled if l not in badnames])
-            if lineage:
-                lineage_dict[lineage] = {'level_count': '-', 'cumulative_count': int(parts[1])}
+    prefixes = [("superkingdom", "k__"), ("phylum", "p__"), ("class", "c__"), ("order", "o__"),
+                ("family", "f__"), ("genus", "g__"), ("species", "s__"), ("strain", "ss__")]
+    for k, v in taxon_dict.items():
+        ranked = [(p, v[r]) for r, p in prefixes if v[r]['name'] != "NA"]
+        lineage = "|".join(["{}{}".format(p, t['name']) for p, t in ranked])
+        if lineage:
+            lineage_dict[lineage] = {'level_count': '-', 'cumulative_count': int(v['Count']),
+                                     'taxids': [t['taxid'] for p, t in ranked]}
     return lineage_dict
 
 def fill_out_lineages(lineage_dict):
     print("Filling out lineage gaps...")
     expanded_dict = {k: v for (k, v) in lineage_dict.items()}
     for k, v in lineage_dict.items():
-        expanded_dict[k] = v
-        label = ""
-        for i in k.split('|'):
-            label += i
-            if label not in expanded_dict:
-                expanded_dict[label] = {'level_count': '-', 'cumulative_count': int(0)}
-            label += "|"
+        label = k
+        while '|' in label:
+            label = label.rsplit('|', 1)[0]
+            if label in expanded_dict:
+                break
+            expanded_dict[label] = {'level_count': '-', 'cumulative_count': int(0),
+                                    'taxids': v['taxids'][:label.count('|') + 1]}
     return expanded_dict
 
 def write_mpa(expanded_dict, outname):
@@ -130,64 +168,80 @@ def write_mpa(expanded_dict, outname):
         for k, v in sorted(expanded_dict.items()):
             fh.write("{}\t{}\n".format(k.replace(" ","_"), v['cumulative_count']))
 
-def write_intermediate_kreport(expanded_dict, outname, reads, ncbi):
+def make_kreport_rows(expanded_dict, reads):
+    """
+    Create the kreport rows (before level counts are calculated), sorted
+    by lineage. The rank and taxid of each row come from the lineage
+    itself, so no taxonomy lookups are needed here.
+
+    :param expanded_dict: dict of lineages from fill_out_lineages
+    :param reads: total number of reads
+    :return rows: list of [proportion, cumulative_count, level_count, rank, taxid, lineage]
+    """
+    rows = []
+    for k, v in sorted(expanded_dict.items()):
+        rank = k.rsplit('|', 1)[-1].split('__')[0].upper()
+        rows.append([round((float(v['cumulative_count'])/float(reads))*100, 2), v['cumulative_count'],
+                     v['level_count'], rank, v['taxids'][-1], k.replace(" ","_")])
+    return rows
+
+def write_intermediate_kreport(rows, outname):
     print("Writing intermediate kreport file...")
     # headers for kreport
     # proportion + cumulative_count + level_count + rank + taxid + name
     with open(outname, 'a') as fh:
-        for k, v in sorted(expanded_dict.items()):
-            indent_rules = {"K":"", "P":"  ", "C":"    ",
-                            "O":"      ", "F":"        ",
-                            "G":"          ", "S":"            ",
-                            "SS":"              "}
-            if '|' in k:
-                rank = k.split('|')[-1].split('__')[0].upper()
-                name = k.split('|')[-1].split('__')[-1]
-            else:
-                rank = k.split('_')[0].upper()
-                name = k.split('_')[-1]
-            taxid = ncbi.get_name_translator([name])[name][0]
-            row_data = [round((float(v['cumulative_count'])/float(reads))*100, 2), v['cumulative_count'], v['level_count'], rank, taxid, k.replace(" ","_")]
-            row_string = "\t".join([str(i) for i in row_data])
-            fh.write("{}\n".format(row_string))
+        for row in rows:
+            fh.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(*row))
 
-def calculate_level_counts(infile):
-    ranks = ["K", "P", "C", "O", "F", "G", "S"]
-    rows = []
-    with open(infile, 'r') as fh:
-        for line in fh:
-            cols = [l.strip() for l in line.strip().split('\t')]
-            rows.append(cols)
-    for r in rows:
-        r[1] = int(r[1])
-        if r[3] == 'S':
-            r[2] = r[1]
-        else:
-            r[2] = int(0)
-    for i, rank in enumerate(ranks[::-1]):
-        if rank == 'S':
-            pass
-        else:
-            for row in rows:
-                if row[3] == rank:
-                    #print(row[3], row[-1])
-                    #nested = [r for r in rows if r[-1].startswith(row[-1]) and r[-1] != row[-1] and r[3] == ranks[::-1][i-1]]
-                    #for n in nested:
-                        #print('\t', n[3], n[-1])
-                    if row[1] == int(0):
-                        row[1] = sum([r[1] for r in rows if r[-1].startswith(row[-1]) and r[-1] != row[-1] and r[3] == ranks[::-1][i-1]])
-                    subcount = sum([r[2] for r in rows if r[-1].startswith(row[-1]) and r[-1] != row[-1]])
-                    if subcount == int(0):
-                        row[2] = int(0)
-                    else:
-                        row[2] = row[1] - subcount
+def calculate_level_counts(rows):
+    """
+    Calculate level counts (and any missing cumulative counts) with a
+    single bottom-up pass over the lineage tree. The parent of a row is
+    the row whose lineage is this lineage with the last rank removed.
+    Species level counts equal their cumulative counts, a missing (zero)
+    cumulative count is the sum of the cumulative counts of the children,
+    and the level count of a higher rank is its cumulative count minus
+    the level counts of all of its descendants (or zero if they sum to zero).
+
+    :param rows: list of rows from make_kreport_rows
+    :return rows: the same rows with level counts filled in
+    """
+    print("Calculating level counts...")
+    ranks = ["K", "P", "C", "O", "F", "G"]
+    children, depths = {}, {}
+    for row in rows:
+        row[1] = int(row[1])
+        depth = row[-1].count('|')
+        depths.setdefault(depth, []).append(row)
+        if depth > 0:
+            children.setdefault(row[-1].rsplit('|', 1)[0], []).append(row)
+    # sum of the level counts of all descendants of each lineage
+    subcounts = {}
+    for depth in sorted(depths, reverse=True):
+        for row in depths[depth]:
+            nested = children.get(row[-1], [])
+            subcount = sum([subcounts[r[-1]] + r[2] for r in nested])
+            if row[3] == 'S':
+                row[2] = row[1]
+            elif row[3] in ranks:
+                if row[1] == int(0):
+                    row[1] = sum([r[1] for r in nested])
+                if subcount == int(0):
+                    row[2] = int(0)
+                else:
+                    row[2] = row[1] - subcount
+            else:
+                row[2] = int(0)
+            subcounts[row[-1]] = subcount
     return rows
 
-def write_kreport(rows, outname):
+def write_kreport(rows, outname, version=None):
     print("Writing kreport output file...")
     # headers for kreport
     # proportion + cumulative_count + level_count + rank + taxid + name
     with open(outname, 'a') as fh:
+        if version is not None:
+            fh.write("# taxonomy: {}\n".format(version))
         indent_rules = {"K":"", "P":"  ", "C":"    ",
                         "O":"      ", "F":"        ",
                         "G":"          ", "S":"            ",
@@ -206,24 +260,25 @@ def write_kreport(rows, outname):
 
 def main():
     args = get_args()
-    ncbi = activate_ncbi(args.update)
+    ncbi = activate_ncbi(args.update, args.taxonomy)
     df = create_df(args.input, args.mappedreads)
     taxon_dict = get_taxon_dict(ncbi, df)
     print("Getting lineage information for all taxa...")
     for k, v in taxon_dict.items():
         # add lineage ranks and names
         v.update(add_ranks(ncbi, k, v))
-        # add read counts
-        v['Count'] = int((df.loc[df['taxid'] == str(v['taxid'])])['Count'])
-    write_intermediate_output(taxon_dict, "{}.intermediate.names.txt".format(args.label), 'name')
-    lineage_dict = make_lineage_dict("{}.intermediate.names.txt".format(args.label))
-    os.remove("{}.intermediate.names.txt".format(args.label))
+    add_counts(taxon_dict, df)
+    if args.intermediate:
+        write_intermediate_output(taxon_dict, "{}.intermediate.names.txt".format(args.label),
+                                  "{}.intermediate.taxid.txt".format(args.label))
+    lineage_dict = make_lineage_dict(taxon_dict)
     expanded_dict = fill_out_lineages(lineage_dict)
     #write_mpa(expanded_dict, "{}.metaphlan-mpa.mpa.txt".format(args.label))
-    write_intermediate_kreport(expanded_dict, "{}.intermediate.kreport.txt".format(args.label), args.readcount, ncbi)
-    rows = calculate_level_counts("{}.intermediate.kreport.txt".format(args.label))
-    write_kreport(rows, "{}.kreport.txt".format(args.label))
-    os.remove("{}.intermediate.kreport.txt".format(args.label))
+    rows = make_kreport_rows(expanded_dict, args.readcount)
+    if args.intermediate:
+        write_intermediate_kreport(rows, "{}.intermediate.kreport.txt".format(args.label))
+    rows = calculate_level_counts(rows)
+    write_kreport(rows, "{}.kreport.txt".format(args.label), getattr(ncbi, 'version', None))
     print("\nDone!\n")
 
 if __name__ == '__main__':
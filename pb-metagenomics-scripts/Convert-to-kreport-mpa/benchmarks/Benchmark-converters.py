@@ -0,0 +1,418 @@
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_DIR = os.path.join(BENCHMARK_DIR, "..")
+PIPELINES_DIR = os.path.join(BENCHMARK_DIR, "..", "..", "..")
+
+# converter name: (path to script, benchmark function name)
+CONVERTERS = {
+    "Convert_MEGAN-NCBI-c2c_to_kreport-mpa.py":
+        (os.path.join(SCRIPT_DIR, "Convert_MEGAN-NCBI-c2c_to_kreport-mpa.py"), "bench_megan_c2c"),
+    "Convert_metamaps-WIMP_to_kreport-mpa.py":
+        (os.path.join(SCRIPT_DIR, "Convert_metamaps-WIMP_to_kreport-mpa.py"), "bench_wimp"),
+    "Convert_metaphlan3_mpa_to_kreport.py":
+        (os.path.join(SCRIPT_DIR, "Convert_metaphlan3_mpa_to_kreport.py"), "bench_metaphlan"),
+    "Convert_kreport_to_mpa.py":
+        (os.path.join(SCRIPT_DIR, "Convert_kreport_to_mpa.py"), "bench_kreport_to_mpa"),
+    "Adjust-kreport-taxonomy.py":
+        (os.path.join(SCRIPT_DIR, "Adjust-kreport-taxonomy.py"), "bench_adjust_kreport"),
+    "Minimap-Megan/Convert_MEGAN_RMA_NCBI_c2c-snake.py":
+        (os.path.join(PIPELINES_DIR, "Taxonomic-Profiling-Minimap-Megan", "scripts",
+                      "Convert_MEGAN_RMA_NCBI_c2c-snake.py"), "bench_pipeline_c2c"),
+    "Diamond-Megan/Convert_MEGAN_RMA_NCBI_c2c-snake.py":
+        (os.path.join(PIPELINES_DIR, "Taxonomic-Profiling-Diamond-Megan", "scripts",
+                      "Convert_MEGAN_RMA_NCBI_c2c-snake.py"), "bench_pipeline_c2c"),
+}
+
+# rank, kraken rank code, mpa prefix, number of taxa per species
+RANKS = [("superkingdom", "D", "k__", None), ("phylum", "P", "p__", 10000), ("class", "C", "c__", 2000),
+         ("order", "O", "o__", 500), ("family", "F", "f__", 100), ("genus", "G", "g__", 10),
+         ("species", "S", "s__", 1)]
+
+def get_args():
+    """
+    Get arguments from command line with argparse.
+    """
+    parser = argparse.ArgumentParser(
+        prog='Benchmark-converters.py',
+        description="""Time each stage of the kreport/mpa converter scripts and the MEGAN
+        pipeline copies on synthetic c2c, MetaPhlAn mpa, WIMP and kreport inputs, using a
+        synthetic taxonomy built from this script (no network is needed). Peak memory of
+        each run is recorded, and results are compared against stored baselines.""")
+
+    parser.add_argument("-s", "--sizes",
+                        required=False,
+                        nargs='+',
+                        type=int,
+                        default=[1000, 10000, 100000],
+                        help="The numbers of species-level taxa to benchmark [1000 10000 100000]. "
+                             "Sizes up to 1000000 are supported.")
+    parser.add_argument("-c", "--converters",
+                        required=False,
+                        nargs='+',
+                        choices=sorted(CONVERTERS),
+                        default=sorted(CONVERTERS),
+                        help="The converters to benchmark [all].")
+    parser.add_argument("-b", "--baseline",
+                        required=False,
+                        default=os.path.join(BENCHMARK_DIR, "baselines.json"),
+                        help="The baseline file to compare against [benchmarks/baselines.json].")
+    parser.add_argument("--save-baseline",
+                        required=False,
+                        action='store_true',
+                        help="Including this flag will write the results to the baseline file "
+                             "instead of comparing against it.")
+    parser.add_argument("-t", "--tolerance",
+                        required=False,
+                        type=float,
+                        default=3.0,
+                        help="Fail if a stage takes more than this many times its baseline time, "
+                             "or a run uses more than this many times its baseline memory [3.0].")
+    parser.add_argument("--min_seconds",
+                        required=False,
+                        type=float,
+                        default=0.25,
+                        help="Ignore slowdowns smaller than this many seconds, which are within "
+                             "timing noise [0.25].")
+    parser.add_argument("-w", "--workdir",
+                        required=False,
+                        default=None,
+                        help="Directory for synthetic inputs and outputs, removed afterwards "
+                             "[a temporary directory].")
+
+    return parser.parse_args()
+
+def load_converter(path):
+    """
+    Import a converter script as a module, since the script names
+    are not valid python module names. The script directory is added
+    to the path so its own imports (taxonomy_snapshot) resolve.
+
+    :param path: path to converter script
+    :return: module object
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    spec = importlib.util.spec_from_file_location("converter", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def make_taxonomy(n):
+    """
+    Build a synthetic taxonomy with n species. Each rank above species has
+    a fixed fraction of the taxa of the rank below (see RANKS), and names
+    are unique within the taxonomy. The same n always gives the same tree.
+
+    :param n: number of species
+    :return: list of taxon dicts {'taxid', 'parent', 'rank', 'name', 'path'},
+             parents listed before their children
+    """
+    taxa, previous, taxid = [], [], 2
+    for rank, code, prefix, per_species in RANKS:
+        count = 2 if per_species is None else max(1, n // per_species)
+        current = []
+        for i in range(count):
+            parent = previous[i % len(previous)] if previous else None
+            if rank == "species":
+                name = "{} species{}".format(parent['name'], i)
+            else:
+                name = "{}{}".format(rank.capitalize(), i)
+            taxon = {'taxid': taxid, 'parent': parent['taxid'] if parent else 1, 'rank': rank,
+                     'name': name, 'path': (parent['path'] if parent else []) + [taxid]}
+            taxid += 1
+            current.append(taxon)
+        taxa.extend(current)
+        previous = current
+    return taxa
+
+def write_taxdump(taxa, outdir):
+    """
+    Write the nodes.dmp, names.dmp and merged.dmp files of a taxonomy.
+
+    :param taxa: list of taxon dicts from make_taxonomy
+    :param outdir: directory to write the files to
+    """
+    with open(os.path.join(outdir, "nodes.dmp"), 'w') as fh_nodes, \
+            open(os.path.join(outdir, "names.dmp"), 'w') as fh_names:
+        fh_nodes.write("1\t|\t1\t|\tno rank\t|\n")
+        fh_names.write("1\t|\troot\t|\t\t|\tscientific name\t|\n")
+        for t in taxa:
+            fh_nodes.write("{}\t|\t{}\t|\t{}\t|\n".format(t['taxid'], t['parent'], t['rank']))
+            fh_names.write("{}\t|\t{}\t|\t\t|\tscientific name\t|\n".format(t['taxid'], t['name']))
+    open(os.path.join(outdir, "merged.dmp"), 'w').close()
+
+def write_inputs(taxa, outdir, seed=1):
+    """
+    Write synthetic converter inputs for a taxonomy: a MEGAN c2c file
+    (species and genus counts), a Metamaps WIMP file (species counts), a
+    MetaPhlAn3 mpa file and a kraken-style kreport (all ranks, with
+    cumulative counts), plus a read count file.
+
+    :param taxa: list of taxon dicts from make_taxonomy
+    :param outdir: directory to write the files to
+    :param seed: random seed for the read counts
+    :return: dict of input type: path, plus 'readcount': INT
+    """
+    rng = random.Random(seed)
+    by_taxid = {t['taxid']: t for t in taxa}
+    level = {}
+    for t in taxa:
+        if t['rank'] == "species" or (t['rank'] == "genus" and rng.random() < 0.1):
+            level[t['taxid']] = rng.randint(1, 1000)
+    cumulative = {}
+    for taxid, count in level.items():
+        for ancestor in by_taxid[taxid]['path']:
+            cumulative[ancestor] = cumulative.get(ancestor, 0) + count
+    reads = sum(level.values())
+    inputs = {k: os.path.join(outdir, v) for k, v in [("c2c", "synthetic.c2c.txt"),
+                                                       ("wimp", "synthetic.WIMP"),
+                                                       ("metaphlan", "synthetic.metaphlan.txt"),
+                                                       ("kreport", "synthetic.kreport.txt"),
+                                                       ("readsfile", "synthetic.readcounts.txt")]}
+    codes = {rank: code for rank, code, prefix, per_species in RANKS}
+    prefixes = {rank: prefix for rank, code, prefix, per_species in RANKS}
+    with open(inputs['c2c'], 'w') as fh:
+        for taxid, count in level.items():
+            fh.write("{}\t{}\t{}\n".format(codes[by_taxid[taxid]['rank']], by_taxid[taxid]['name'], count))
+    with open(inputs['wimp'], 'w') as fh:
+        fh.write("AnalysisLevel\ttaxonID\tName\tAbsolute\tEMFrequency\tPotFrequency\n")
+        for taxid, count in level.items():
+            if by_taxid[taxid]['rank'] == "species":
+                fh.write("species\t{}\t{}\t{}\t{}\t{}\n".format(taxid, by_taxid[taxid]['name'], count,
+                                                               count / reads, count / reads))
+    with open(inputs['metaphlan'], 'w') as fh:
+        fh.write("#mpa_v30_CHOCOPhlAn_201901\n#synthetic\n#clade_name\tNCBI_tax_id\trelative_abundance"
+                 "\tadditional_species\n")
+        for t in taxa:
+            if t['taxid'] in cumulative:
+                clade = "|".join(prefixes[by_taxid[p]['rank']] + by_taxid[p]['name'].replace(" ", "_")
+                                 for p in t['path'])
+                fh.write("{}\t{}\t{}\t\n".format(clade, "|".join(str(p) for p in t['path']),
+                                                 round(100.0 * cumulative[t['taxid']] / reads, 5)))
+    with open(inputs['kreport'], 'w') as fh:
+        for t in taxa:
+            if t['taxid'] in cumulative:
+                fh.write("{}\t{}\t{}\t{}\t{}\t{}{}\n".format(round(100.0 * cumulative[t['taxid']] / reads, 2),
+                                                           cumulative[t['taxid']], level.get(t['taxid'], 0),
+                                                           codes[t['rank']], t['taxid'],
+                                                           "  " * (len(t['path']) - 1), t['name']))
+    with open(inputs['readsfile'], 'w') as fh:
+        fh.write("{}\n".format(reads))
+    inputs['readcount'] = reads
+    return inputs
+
+def add_all_ranks(mod, ncbi, taxon_dict):
+    for k, v in taxon_dict.items():
+        v.update(mod.add_ranks(ncbi, k, v))
+
+def bench_lineages(mod, taxon_dict, inputs, outdir, stage):
+    lineage_dict = stage("make_lineage_dict", mod.make_lineage_dict, taxon_dict)
+    expanded_dict = stage("fill_out_lineages", mod.fill_out_lineages, lineage_dict)
+    stage("write_mpa", mod.write_mpa, expanded_dict, os.path.join(outdir, "out.mpa.txt"))
+    stage("write_kreport", mod.write_kreport, expanded_dict, os.path.join(outdir, "out.kreport.txt"),
+          inputs['readcount'])
+
+def bench_megan_c2c(mod, ncbi, inputs, outdir, stage):
+    df = stage("read_input", mod.pd.read_csv, inputs['c2c'], sep='\t', names=['Level', 'Name', 'Count'],
+               header=None)
+    taxon_dict = stage("get_taxon_dict", mod.get_taxon_dict, ncbi, df)
+    stage("add_ranks", add_all_ranks, mod, ncbi, taxon_dict)
+    stage("add_counts", mod.add_counts, taxon_dict, df)
+    bench_lineages(mod, taxon_dict, inputs, outdir, stage)
+
+def bench_wimp(mod, ncbi, inputs, outdir, stage):
+    df = stage("read_input", mod.get_filtered_dataframe, inputs['wimp'])
+    taxon_dict = stage("get_taxon_dict", mod.get_taxon_dict, ncbi, df)
+    stage("add_ranks", add_all_ranks, mod, ncbi, taxon_dict)
+    stage("add_counts", mod.add_counts, taxon_dict, df)
+    bench_lineages(mod, taxon_dict, inputs, outdir, stage)
+
+def bench_adjust_kreport(mod, ncbi, inputs, outdir, stage):
+    df = stage("read_input", mod.create_df, inputs['kreport'])
+    taxon_dict = stage("get_taxon_dict", mod.get_taxon_dict, ncbi, df)
+    stage("add_ranks", add_all_ranks, mod, ncbi, taxon_dict)
+    stage("add_counts", mod.add_counts, taxon_dict, df)
+    bench_lineages(mod, taxon_dict, inputs, outdir, stage)
+
+def bench_metaphlan(mod, ncbi, inputs, outdir, stage):
+    df = stage("read_input", mod.create_df, inputs['metaphlan'], inputs['readcount'])
+    taxon_dict = stage("get_taxon_dict", mod.get_taxon_dict, ncbi, df)
+    stage("add_ranks", add_all_ranks, mod, ncbi, taxon_dict)
+    stage("add_counts", mod.add_counts, taxon_dict, df)
+    lineage_dict = stage("make_lineage_dict", mod.make_lineage_dict, taxon_dict)
+    expanded_dict = stage("fill_out_lineages", mod.fill_out_lineages, lineage_dict)
+    rows = stage("make_kreport_rows", mod.make_kreport_rows, expanded_dict, inputs['readcount'])
+    rows = stage("calculate_level_counts", mod.calculate_level_counts, rows)
+    stage("write_kreport", mod.write_kreport, rows, os.path.join(outdir, "out.kreport.txt"))
+
+def bench_kreport_to_mpa(mod, ncbi, inputs, outdir, stage):
+    df = stage("read_input", mod.make_filtered_df, inputs['kreport'], "kraken")
+    lineage_dict = stage("make_lineage_dict", mod.make_lineage_dict, df, ncbi)
+    stage("write_mpa", mod.write_mpa, df, lineage_dict, os.path.join(outdir, "out.mpa.txt"))
+
+def bench_pipeline_c2c(mod, ncbi, inputs, outdir, stage):
+    df = stage("read_input", mod.pd.read_csv, inputs['c2c'], sep='\t', names=['Level', 'Name', 'Count'],
+               header=None)
+    taxon_dict = stage("get_taxon_dict", mod.get_taxon_dict, ncbi, df)
+    stage("add_ranks", add_all_ranks, mod, ncbi, taxon_dict)
+    mod.set_shared_taxa(taxon_dict)
+    # counts, lineages and both writers for one sample
+    stage("convert_sample", mod.convert_sample, df, os.path.join(outdir, "out.mpa.txt"),
+          os.path.join(outdir, "out.kreport.txt"), inputs['readsfile'])
+
+def run_converter(name, snapshot, inputs, outdir, queue):
+    """
+    Run the benchmark of one converter and put its stage times and peak
+    memory on the queue. This runs in its own process, so the peak memory
+    of one converter does not carry over to the next.
+
+    :param name: converter name (key of CONVERTERS)
+    :param snapshot: path to taxonomy snapshot
+    :param inputs: dict of inputs from write_inputs
+    :param outdir: directory for output files
+    :param queue: multiprocessing queue for the results
+    """
+    path, bench = CONVERTERS[name]
+    times = {}
+
+    def stage(label, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        times[label] = round(time.perf_counter() - start, 4)
+        return result
+
+    # each converter imports the taxonomy modules from its own directory
+    for module in ["taxonomy_snapshot", "taxonomy_cache"]:
+        sys.modules.pop(module, None)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            mod = load_converter(path)
+            ncbi = stage("load_taxonomy", mod.TaxonomySnapshot, snapshot)
+            globals()[bench](mod, ncbi, inputs, outdir, stage)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        queue.put({'stages': times, 'peak_rss_mb': round(peak, 1)})
+    except Exception as e:
+        queue.put({'error': "{}: {}".format(type(e).__name__, e)})
+
+def benchmark_size(n, converters, workdir):
+    """
+    Build the taxonomy and inputs for n species, and benchmark each
+    converter on them in a separate process.
+
+    :param n: number of species
+    :param converters: list of converter names
+    :param workdir: directory for synthetic inputs and outputs
+    :return: dict of converter name: results
+    """
+    sys.path.insert(0, SCRIPT_DIR)
+    from taxonomy_snapshot import build_snapshot
+    sizedir = os.path.join(workdir, str(n))
+    os.makedirs(sizedir, exist_ok=True)
+    taxa = make_taxonomy(n)
+    write_taxdump(taxa, sizedir)
+    snapshot = os.path.join(sizedir, "synthetic.snapshot")
+    with contextlib.redirect_stdout(io.StringIO()):
+        build_snapshot(sizedir, snapshot)
+    inputs = write_inputs(taxa, sizedir)
+    del taxa
+    results = {}
+    context = multiprocessing.get_context("fork")
+    for name in converters:
+        outdir = os.path.join(sizedir, name.replace("/", "_"))
+        os.makedirs(outdir, exist_ok=True)
+        queue = context.Queue()
+        proc = context.Process(target=run_converter, args=(name, snapshot, inputs, outdir, queue))
+        proc.start()
+        results[name] = queue.get()
+        proc.join()
+        print_result(n, name, results[name])
+    return results
+
+def print_result(n, name, result):
+    if 'error' in result:
+        print("{:>9,}  {:<52} FAILED: {}".format(n, name, result['error']))
+        return
+    stages = ", ".join("{} {:.3f}".format(k, v) for k, v in result['stages'].items())
+    print("{:>9,}  {:<52} {:>8.3f} s  {:>8.1f} MB  ({})".format(
+        n, name, sum(result['stages'].values()), result['peak_rss_mb'], stages))
+
+def compare_to_baseline(results, baseline, tolerance, min_seconds):
+    """
+    Compare results to the baseline, and list every stage that became
+    slower, or run that used more memory, than allowed by the tolerance.
+
+    :param results: dict of size: converter name: results
+    :param baseline: dict with the same layout as results
+    :param tolerance: allowed ratio of current to baseline values
+    :param min_seconds: slowdowns smaller than this are ignored
+    :return: list of regression messages
+    """
+    regressions = []
+    for size, converters in results.items():
+        for name, result in converters.items():
+            base = baseline.get(size, {}).get(name)
+            if base is None or 'error' in base:
+                continue
+            if 'error' in result:
+                regressions.append("{} ({} taxa) failed: {}".format(name, size, result['error']))
+                continue
+            for label, seconds in result['stages'].items():
+                expected = base['stages'].get(label)
+                if expected is not None and seconds > expected * tolerance and seconds - expected > min_seconds:
+                    regressions.append("{} ({} taxa) {}: {:.3f} s, baseline {:.3f} s".format(
+                        name, size, label, seconds, expected))
+            if result['peak_rss_mb'] > base['peak_rss_mb'] * tolerance:
+                regressions.append("{} ({} taxa) peak memory: {:.1f} MB, baseline {:.1f} MB".format(
+                    name, size, result['peak_rss_mb'], base['peak_rss_mb']))
+    return regressions
+
+def main():
+    args = get_args()
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix="converter-benchmarks.")
+    print("Benchmarking {} converters on {} synthetic taxa sizes\n".format(len(args.converters), len(args.sizes)))
+    results = {}
+    try:
+        for n in sorted(args.sizes):
+            results[str(n)] = benchmark_size(n, args.converters, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline, 'r') as fh:
+                baseline = json.load(fh)
+        for size, converters in results.items():
+            baseline.setdefault(size, {}).update(converters)
+        with open(args.baseline, 'w') as fh:
+            json.dump(baseline, fh, indent=2, sort_keys=True)
+        print("\nSaved results to baseline file {}".format(args.baseline))
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as fh:
+            baseline = json.load(fh)
+        regressions = compare_to_baseline(results, baseline, args.tolerance, args.min_seconds)
+        if regressions:
+            raise SystemExit("\nPerformance regressions against {}:\n\t{}".format(
+                args.baseline, "\n\t".join(regressions)))
+        print("\nNo regressions against baseline file {}".format(args.baseline))
+    else:
+        print("\nNo baseline file found ({}), use --save-baseline to create one.".format(args.baseline))
+    failed = [name for converters in results.values() for name, r in converters.items() if 'error' in r]
+    if failed:
+        raise SystemExit("\nBenchmarks failed for: {}".format(", ".join(sorted(set(failed)))))
+    print("\nDone!\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import contextlib
+import importlib.util
+import io
+import os
+import sys
+import time
+
+def get_args():
+    """
+    Get arguments from command line with argparse.
+    """
+    parser = argparse.ArgumentParser(
+        prog='Benchmark-fill-out-lineages.py',
+        description="""Time fill_out_lineages() from a converter script on synthetic
+        lineage sets of increasing size, to confirm the cumulative count rollup
+        scales linearly with the number of lineages.""")
+
+    parser.add_argument("-c", "--converter",
+                        required=False,
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                                             "Convert_MEGAN-NCBI-c2c_to_kreport-mpa.py"),
+                        help="The converter script containing fill_out_lineages() "
+                             "[Convert_MEGAN-NCBI-c2c_to_kreport-mpa.py].")
+    parser.add_argument("-s", "--sizes",
+                        required=False,
+                        nargs='+',
+                        type=int,
+                        default=[1000, 10000, 100000, 1000000],
+                        help="The numbers of species-level lineages to benchmark [1000 10000 100000 1000000].")
+    parser.add_argument("-m", "--max_ratio",
+                        required=False,
+                        type=float,
+                        default=3.0,
+                        help="Fail if the time per lineage of the largest size is more than this "
+                             "many times the time per lineage of the smallest size [3.0].")
+
+    return parser.parse_args()
+
+def load_converter(path):
+    """
+    Import a converter script as a module, since the script names
+    are not valid python module names. The script directory is added
+    to the path so its own imports (taxonomy_snapshot) resolve.
+
+    :param path: path to converter script
+    :return: module object
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    spec = importlib.util.spec_from_file_location("converter", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def make_lineages(n):
+    """
+    Build n species-level lineages spread over a fixed-shape tree,
+    including sibling names that share a prefix (G1 vs G10) to exercise
+    the prefix-matching pitfall of the old implementation.
+
+    :param n: number of species-level lineages
+    :return: dict of lineage: {'level_count': INT, 'cumulative_count': INT, 'taxids': LIST}
+    """
+    lineage_dict = {}
+    for i in range(n):
+        lineage = "k__K{}|p__P{}|c__C{}|o__O{}|f__F{}|g__G{}|s__S{}".format(
+            i % 3, i % 50, i % 200, i % 1000, i % 5000, i % 20000, i)
+        taxids = [i % 3, i % 50, i % 200, i % 1000, i % 5000, i % 20000, i]
+        lineage_dict[lineage] = {'level_count': 1, 'cumulative_count': int(0), 'taxids': taxids}
+    return lineage_dict
+
+def main():
+    args = get_args()
+    converter = load_converter(args.converter)
+    print("Benchmarking fill_out_lineages from {}\n".format(args.converter))
+    print("{:>12}\t{:>12}\t{:>10}\t{:>14}".format("lineages", "nodes", "seconds", "usec/lineage"))
+    per_lineage = []
+    for n in sorted(args.sizes):
+        lineage_dict = make_lineages(n)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            expanded_dict = converter.fill_out_lineages(lineage_dict)
+        elapsed = time.perf_counter() - start
+        root_total = sum(v['cumulative_count'] for k, v in expanded_dict.items() if '|' not in k)
+        if root_total != n:
+            raise ValueError("Cumulative counts are incorrect: expected {:,}, found {:,}.".format(n, root_total))
+        per_lineage.append(elapsed / n)
+        print("{:>12,}\t{:>12,}\t{:>10.3f}\t{:>14.3f}".format(n, len(expanded_dict), elapsed,
+                                                             elapsed / n * 1e6))
+    ratio = per_lineage[-1] / per_lineage[0]
+    print("\nTime per lineage ratio (largest/smallest): {:.2f}".format(ratio))
+    if ratio > args.max_ratio:
+        raise SystemExit("fill_out_lineages does not scale linearly (ratio {:.2f} > {}).".format(
+            ratio, args.max_ratio))
+    print("\nDone!\n")
+
+if __name__ == '__main__':
+    main()